@@ -0,0 +1,319 @@
+'''Offline benchmark of the player jobs against local stand-ins of tracker.gg and the CV.
+
+Every roster size runs in its own process, so caches, connections and the peak RSS
+of one size don't leak into the next one. Examples:
+
+    python -m benchmarks.run --players 100 1000 10000 --output benchmarks/results/baseline.json
+    python -m benchmarks.run --players 1000 --error-rate 0.05 --rate-limit 600
+    python -m benchmarks.run --compare benchmarks/results/baseline.json benchmarks/results/new.json
+'''
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+from yarl import URL
+
+from benchmarks.stubs import CvStub, StubConfig, TrackerStub, make_roster
+
+# The jobs in the order they run, each one works on the data of the previous ones
+JOBS = ['get_members', 'update_player_data',
+        'upload_player_data', 'get_player_weekly_xp_as_message']
+
+
+def percentile(values, share):
+    '''Nearest rank percentile, None for no values.'''
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Without /proc only the peak of the whole process is known
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Recorder(object):
+    '''Collects request latencies, SQLite writes and the RSS while a job runs.'''
+
+    def __init__(self, database):
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.Counter()
+        self.writes = 0
+        self.commits = 0
+        self.peak_rss = 0
+        self.lock = threading.Lock()
+
+        # The jobs write from the writer thread, so the counters are updated under a lock
+        execute_sql = database.execute_sql
+        commit = database.commit
+
+        def counting_execute_sql(sql, *args, **kwargs):
+            if sql.lstrip()[:7].upper().startswith(('INSERT', 'UPDATE', 'DELETE', 'REPLACE')):
+                with self.lock:
+                    self.writes += 1
+            return execute_sql(sql, *args, **kwargs)
+
+        def counting_commit(*args, **kwargs):
+            with self.lock:
+                self.commits += 1
+            return commit(*args, **kwargs)
+
+        database.execute_sql = counting_execute_sql
+        database.commit = counting_commit
+
+    def trace_config(self):
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.started = time.monotonic()
+
+        async def on_request_end(session, context, params):
+            host = URL(str(params.url)).host
+            self.latencies[host].append(time.monotonic() - context.started)
+            self.statuses[str(params.response.status)] += 1
+
+        async def on_request_exception(session, context, params):
+            self.statuses[type(params.exception).__name__] += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+
+    def reset(self):
+        self.latencies.clear()
+        self.statuses.clear()
+        with self.lock:
+            self.writes = 0
+            self.commits = 0
+        self.peak_rss = current_rss_mb()
+
+    async def sample_rss(self, interval=0.05):
+        while True:
+            self.peak_rss = max(self.peak_rss, current_rss_mb())
+            await asyncio.sleep(interval)
+
+    def report(self, size, duration):
+        requests = {}
+        for host, latencies in self.latencies.items():
+            requests[host] = {'count': len(latencies),
+                              'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+                              'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)}
+        all_latencies = [latency for latencies in self.latencies.values()
+                         for latency in latencies]
+
+        return {'duration_s': round(duration, 3),
+                'players_per_s': round(size / duration, 1) if duration > 0 else None,
+                'requests': sum(len(latencies) for latencies in self.latencies.values()),
+                'p50_ms': round(percentile(all_latencies, 0.5) * 1000, 2) if len(all_latencies) > 0 else None,
+                'p99_ms': round(percentile(all_latencies, 0.99) * 1000, 2) if len(all_latencies) > 0 else None,
+                'hosts': requests,
+                'statuses': dict(self.statuses),
+                'db_writes': self.writes,
+                'db_commits': self.commits,
+                'peak_rss_mb': round(self.peak_rss, 1)}
+
+
+async def run_roster(size, args):
+    '''Runs all jobs once against a fresh database and fresh stubs, returns the report of the roster.'''
+    from models.BaseModel import Migrations
+    from models.BaseModel.BaseModel import database
+    from models.Limit.Limit import Limit
+    from models.Player import Player
+    from models.Tools import Database, Http
+
+    import models.Message
+    import models.SyncState
+    import models.UploadOutbox
+    import models.XpHistory
+
+    roster = make_roster(size, seed=args.seed)
+    config = StubConfig(latency=args.latency, jitter=args.jitter,
+                        error_rate=args.error_rate, rate_limit=args.rate_limit)
+    tracker = await TrackerStub(roster, config).start()
+    cv = await CvStub(roster, config).start()
+
+    os.environ.update({'tracker_base_url': tracker.base_url, 'cv_base_url': cv.base_url,
+                       'TRN_API': 'benchmark', 'member_username': 'benchmark', 'member_pw': 'benchmark',
+                       'enable_name_warning': 'false'})
+
+    # The limiter of the real hosts doesn't apply to the stubs, they get their own buckets
+    client_rate = args.client_rate or args.rate_limit
+    if client_rate != None:
+        Limit.get_bucket(tracker.host, calls=client_rate, period=60)
+        Limit.get_bucket(cv.host, calls=client_rate, period=60)
+
+    directory = tempfile.mkdtemp(prefix='tpa-benchmark-')
+    database.init(os.path.join(directory, 'tpa.db'), timeout=10)
+    database.connect()
+    Migrations.setup_schema(database, models=[Player, models.Message.Message, models.SyncState.SyncState,
+                                              models.UploadOutbox.UploadOutbox, models.XpHistory.XpHistory])
+
+    recorder = Recorder(database)
+    session = Http.create_session(trace_configs=[recorder.trace_config()])
+    sampler = asyncio.ensure_future(recorder.sample_rss())
+
+    def seed_week_start():
+        # A week start below the tracked xp, so the upload has xp to send
+        Player.update(player_xp=1).execute()
+
+    jobs = {'get_members': lambda: Player.get_members(session, full=True),
+            'update_player_data': lambda: Player.update_player_data(bot=None, session=session),
+            'upload_player_data': lambda: Player.upload_player_data(session),
+            'get_player_weekly_xp_as_message': lambda: Player.get_player_weekly_xp_as_message(player_limit=-1)}
+
+    report = {'players': size, 'jobs': {}}
+    try:
+        for name in JOBS:
+            if name == 'update_player_data':
+                await Database.run_write(seed_week_start)
+
+            recorder.reset()
+            started = time.monotonic()
+            await jobs[name]()
+            report['jobs'][name] = recorder.report(size, time.monotonic() - started)
+            logging.warning(
+                f"{size} players, {name}: {report['jobs'][name]['duration_s']}s")
+    finally:
+        sampler.cancel()
+        await session.close()
+        await tracker.stop()
+        await cv.stop()
+        Database.shutdown()
+
+    report['uploads_received'] = len(cv.uploads)
+    report['peak_rss_mb'] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
+
+
+def run_in_process(size, argv):
+    '''Runs one roster size in a child process and returns its report.'''
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--single', str(size)] + argv,
+                            stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    '''Prints the change of throughput, p99 latency, writes and RSS between two result files.'''
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    def change(before, after):
+        if before in (None, 0) or after == None:
+            return f'{before} -> {after}'
+        return f'{before} -> {after} ({(after - before) / before * 100:+.1f}%)'
+
+    print(f"{old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    for size, roster in new['rosters'].items():
+        if size not in old['rosters']:
+            continue
+        for name, job in roster['jobs'].items():
+            before = old['rosters'][size]['jobs'].get(name)
+            if before == None:
+                continue
+            print(f'{size:>6} {name:<32} players/s {change(before["players_per_s"], job["players_per_s"])}, '
+                  f'p99 ms {change(before["p99_ms"], job["p99_ms"])}, '
+                  f'writes {change(before["db_writes"], job["db_writes"])}, '
+                  f'rss MB {change(before["peak_rss_mb"], job["peak_rss_mb"])}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the player jobs against local tracker.gg and CV stubs.')
+    parser.add_argument('--players', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='roster sizes, default 100 1000 10000')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='base response latency of the stubs in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='random latency added on top in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests answered with 503')
+    parser.add_argument('--rate-limit', type=int, default=None,
+                        help='requests per minute the stubs allow, announced in X-RateLimit headers')
+    parser.add_argument('--client-rate', type=int, default=None,
+                        help='requests per minute of the client side buckets, defaults to --rate-limit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='result file, default benchmarks/results/<time>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compares two result files instead of running')
+    parser.add_argument('--single', type=int, default=None,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s', stream=sys.stderr)
+
+    if args.compare != None:
+        compare(*args.compare)
+        return
+
+    if args.single != None:
+        print(json.dumps(asyncio.run(run_roster(args.single, args))))
+        return
+
+    # The children get the stub settings, not the sizes or the output
+    argv = ['--latency', str(args.latency), '--jitter', str(args.jitter),
+            '--error-rate', str(args.error_rate), '--seed', str(args.seed)]
+    if args.rate_limit != None:
+        argv += ['--rate-limit', str(args.rate_limit)]
+    if args.client_rate != None:
+        argv += ['--client-rate', str(args.client_rate)]
+
+    results = {'meta': {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                        'commit': git_commit(),
+                        'python': platform.python_version(),
+                        'settings': {key: value for key, value in vars(args).items()
+                                     if key not in ('output', 'compare', 'single')}},
+               'rosters': {}}
+    for size in args.players:
+        results['rosters'][str(size)] = run_in_process(size, argv)
+
+    output = args.output or os.path.join(
+        'benchmarks', 'results', datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as result_file:
+        json.dump(results, result_file, indent=2)
+
+    for size, roster in results['rosters'].items():
+        for name, job in roster['jobs'].items():
+            print(f'{size:>6} {name:<32} {job["duration_s"]:>8}s {job["players_per_s"]:>9} players/s '
+                  f'p50 {job["p50_ms"]} ms, p99 {job["p99_ms"]} ms, {job["db_writes"]} writes, '
+                  f'{job["peak_rss_mb"]} MB')
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import asyncio
+import collections
+import random
+import time
+
+from aiohttp import web
+
+
+class StubConfig(object):
+    '''Behaviour of a stub server.
+
+    latency is the base delay of a response in seconds, jitter is added at random on top.
+    error_rate is the share of requests answered with 503. With rate_limit, at most that many
+    requests per minute are answered, the remaining ones get a 429 with Retry-After, and every
+    response announces the limit in X-RateLimit headers like tracker.gg does.'''
+
+    def __init__(self, latency=0.02, jitter=0.01, error_rate=0.0, rate_limit=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+
+
+class StubServer(object):
+    '''Base class of the stubs, serves an aiohttp application on a free local port.'''
+
+    def __init__(self, host, config):
+        self.host = host
+        self.config = config
+        self.runner = None
+        self.port = None
+        # Times of the answered requests of the last minute, for the rate limit
+        self.window = collections.deque()
+        self.requests = 0
+
+    def routes(self):
+        raise NotImplementedError
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.add_routes(self.routes())
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.runner != None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def rate_limit_headers(self, now):
+        while len(self.window) > 0 and now - self.window[0] > 60:
+            self.window.popleft()
+
+        limit = self.config.rate_limit
+        remaining = max(0, limit - len(self.window))
+        headers = {'X-RateLimit-Limit-minute': str(limit),
+                   'X-RateLimit-Remaining-minute': str(max(0, remaining - 1))}
+        if remaining == 0:
+            headers['Retry-After'] = str(max(1, int(60 - (now - self.window[0])) + 1))
+        return headers, remaining > 0
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests += 1
+        await asyncio.sleep(self.config.latency + random.uniform(0, self.config.jitter))
+
+        headers = {}
+        if self.config.rate_limit != None:
+            now = time.monotonic()
+            headers, allowed = self.rate_limit_headers(now)
+            if not allowed:
+                return web.Response(status=429, headers=headers)
+            self.window.append(now)
+
+        if random.random() < self.config.error_rate:
+            return web.Response(status=503, headers=headers)
+
+        response = await handler(request)
+        response.headers.update(headers)
+        return response
+
+
+class TrackerStub(StubServer):
+    '''Imitates the tracker.gg Division 2 profile endpoint, the clan xp of a player grows with every call.'''
+
+    def __init__(self, roster, config, host='localhost'):
+        super().__init__(host, config)
+        self.xp = {member['name']: member['xp'] for member in roster}
+
+    def routes(self):
+        return [web.get('/v2/division-2/standard/profile/uplay/{name}', self.profile)]
+
+    async def profile(self, request):
+        name = request.match_info['name']
+        if name not in self.xp:
+            return web.json_response({'errors': [{'code': 'CollectorResultStatus::NotFound'}]}, status=404)
+
+        self.xp[name] += random.randint(0, 5000)
+        return web.json_response({'data': {'segments': [{'stats': {'xPClan': {'value': self.xp[name]}}}]}})
+
+
+class CvStub(StubServer):
+    '''Imitates the AllMember, Member and Activity endpoints of the CV.'''
+
+    def __init__(self, roster, config, host='127.0.0.1', modified_share=0.02):
+        super().__init__(host, config)
+        self.roster = roster
+        # Share of the roster returned by an incremental AllMember request
+        self.modified_share = modified_share
+        self.uploads = []
+
+    def routes(self):
+        return [web.post('/BotRequest/AllMember', self.all_member),
+                web.post('/BotRequest/Member', self.member),
+                web.post('/BotRequest/Activity', self.activity)]
+
+    @staticmethod
+    def entry(member):
+        return {'Ubisoft': {'nickname': member['name'],
+                            'officialAccountId': member['ubi_id'],
+                            'games': {'1': {'characters': {'1': {'isMember': True}}}}},
+                'Discord': {'officialAccountId': member['discord_id']}}
+
+    async def all_member(self, request):
+        body = await request.json()
+        members = self.roster
+        if 'lastModified' in body:
+            members = members[:int(len(members) * self.modified_share)]
+        return web.json_response([CvStub.entry(member) for member in members])
+
+    async def member(self, request):
+        body = await request.json()
+        for member in self.roster:
+            if member['ubi_id'] == body.get('officialAccountId'):
+                return web.json_response([CvStub.entry(member)])
+        return web.json_response([{'Ubisoft': {'games': {}}}])
+
+    async def activity(self, request):
+        self.uploads.append(await request.json())
+        return web.Response(text='OK')
+
+
+def make_roster(size, seed=0):
+    '''Returns size synthetic members with unique names, ubi and Discord ids.'''
+    rand = random.Random(seed)
+    return [{'name': f'Agent_{i:05d}',
+             'ubi_id': f'{rand.getrandbits(128):032x}',
+             'discord_id': 10 ** 17 + i,
+             'xp': rand.randint(0, 10 ** 7)} for i in range(size)]
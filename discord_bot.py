@@ -1,30 +1,113 @@
+import time
+
+# Start of the bot, for the startup timing report
+startup_started = time.monotonic()
+
+import asyncio
+import datetime
 import logging
 import os
+import signal
 import sys
-from pathlib import Path
 
 import discord
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from discord.ext import commands
 from dotenv import load_dotenv
-from gcsa.google_calendar import GoogleCalendar
-from peewee import SqliteDatabase
-from dateutil import parser
 
+import models.CalendarEvent
+import models.GuildConfig
 import models.Message
 import models.Player
+import models.SyncState
+import models.UploadOutbox
+import models.XpHistory
+from models.BaseModel import Migrations
+from models.BaseModel.BaseModel import database as db
+from models.Tools import Database, Http, Metrics, Profiling
+from models.Tools.ComboRoles import ComboRoleEngine
+from models.Tools.LogSink import LogChannelSink
+from models.Tools.LoopLag import LoopLagMonitor
+from models.Tools.MemberQueue import MemberEventQueue
+from models.Tools.Pipeline import Pipeline, Step
+from models.Tools.TimerWheel import TimerWheel
+
+
+class TPABot(commands.AutoShardedBot):
+    '''Sharded bot which owns the application wide HTTP session.
+
+    Without shard_count Discord recommends the number of shards, with shard_ids
+    the shards can be split across several processes.'''
+
+    metrics_server = None
+    config_watcher = None
+    closing = False
+
+    async def start(self, *args, **kwargs):
+        # Open the shared session before connecting to the gateway
+        await Http.open_session()
+
+        # The metrics are only served if a port is configured
+        if os.getenv('metrics_port') != None:
+            self.metrics_server = Metrics.MetricsServer(
+                int(os.getenv('metrics_port')), host=os.getenv('metrics_host', '127.0.0.1'))
+            await self.metrics_server.start()
+
+        if Profiling.enabled:
+            Profiling.enable_slow_callbacks(asyncio.get_event_loop(), db,
+                                            threshold=float(os.getenv('slow_callback_ms', 100)) / 1000)
+
+        loop_lag.start()
+        member_events.start()
+        reminders.start()
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        # Closed by a signal and again when start_bot returns, the cleanup runs once
+        if self.closing:
+            return
+        self.closing = True
+
+        # Send buffered log messages while the connection is still open
+        await LogChannelSink.flush_all()
+        await super().close()
+        member_events.stop()
+        reminders.stop()
+        loop_lag.stop()
+        if self.config_watcher != None:
+            self.config_watcher.cancel()
+        if self.metrics_server != None:
+            await self.metrics_server.stop()
+        await Http.close_session()
+        Database.shutdown()
+
 
 intents = discord.Intents().all()
 intents.members = True
 
+# Role and membership events, handled debounced per member
+member_events = MemberEventQueue(handlers={})
+
+# Measures how long the event loop is blocked
+loop_lag = LoopLagMonitor()
+
 # Bot command prefix
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = TPABot(command_prefix='!', intents=intents)
 
-# Database setting
-db = SqliteDatabase('tpa.db')
+# Cached Google calendar, see get_calendar
+calendar_cache = None
 
-# Global list for saving the roles to this later
-role_list = list()
+# Reminders of the calendar events
+reminders = TimerWheel()
+
+# Combo role engines by guild id, see get_combo_roles
+combo_roles = {}
+
+# Set once the tables exist, the gateway may be ready before
+database_ready = asyncio.Event()
+
+# Duration of the startup stages in seconds, see report_startup
+startup_timings = {}
+login_started = None
 
 
 @bot.event
@@ -33,144 +116,349 @@ async def on_ready():
 
     logging.info('Logged in as {0.user}'.format(bot))
 
+    if 'gateway' not in startup_timings and login_started != None:
+        startup_timings['gateway'] = time.monotonic() - login_started
+        report_startup()
 
-@bot.event
-async def on_member_join(member):
-    if os.getenv('enable_member_join_messages') == 'true':
-        # Get the discord channel id from local environment
-        channel_id = os.getenv('log_channel_id')
-        discord_log_channel = bot.get_channel(int(channel_id))
+    # The guild configs are loaded with the database
+    await database_ready.wait()
 
-        if discord_log_channel != None:
-            logging.debug(f'Logging channel id {channel_id} found.')
+    # Without guild_id, e.g. a deployment from before the guild configs, the old
+    # environment variables belong to the only guild of the bot
+    GuildConfig = models.GuildConfig.GuildConfig
+    if len(GuildConfig.cache) == 0 and len(bot.guilds) == 1:
+        await Database.run_write(GuildConfig.seed, bot.guilds[0].id)
 
-            message = f':new:<@{member.id}> `{member.name}#{member.discriminator}` ist dem Server beigetreten.'
+    unconfigured = [str(guild.id)
+                    for guild in bot.guilds if GuildConfig.for_guild(guild.id) == None]
+    if len(unconfigured) > 0:
+        logging.error(f"Guilds {', '.join(unconfigured)} have no config, their channels and combo roles "
+                      'are disabled. Set guild_id or use the config command.')
 
-            await discord_log_channel.send(message)
-        else:
-            logging.error(f'Logging channel id {channel_id} NOT found.')
+    # Index the combo roles of all guilds
+    for guild in bot.guilds:
+        get_combo_roles(guild)
+
+    # Warm up the calendar cache, so the first termine command doesn't wait for it
+    if os.getenv('calendar_credentials_path') != None:
+        asyncio.ensure_future(get_calendar().refresh_safely())
+
+    # The reminders are sent by the process which polls the calendar
+    if os.getenv('enable_calendar_feed') == 'true' and runs_jobs():
+        await load_reminders()
 
-        # Send welcome message to player
-        if os.getenv('enable_welcome_msg') == 'true':
-            await member.send(f'''
-Hallo {member.name},
+
+async def watch_guild_configs(interval):
+    '''Reloads the guild configs every interval seconds. The config command only updates the
+    cache of its own process, with the shards split across processes the others see it here.'''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = await Database.run_read(models.GuildConfig.GuildConfig.reload)
+        except Exception:
+            logging.exception('Reloading the guild configs failed')
+            continue
+
+        # The combo role engines are built from the configs
+        for guild_id in changed:
+            combo_roles.pop(guild_id, None)
+        if len(changed) > 0:
+            logging.info(f'Reloaded the configs of {len(changed)} guilds')
+
+
+def get_combo_roles(guild):
+    '''Returns the combo role engine of a guild, None if the guild has no combo roles.'''
+    # The configs are loaded with the database, nothing is cached before
+    if not database_ready.is_set():
+        return None
+
+    if guild.id not in combo_roles:
+        config = models.GuildConfig.GuildConfig.for_guild(guild.id)
+        role_list = config.get_combo_roles() if config != None else []
+
+        combo_roles[guild.id] = None
+        if len(role_list) > 0:
+            combo_roles[guild.id] = ComboRoleEngine(role_list)
+            combo_roles[guild.id].index_guild(guild)
+    return combo_roles[guild.id]
+
+
+def welcome_message(name, guild_id):
+    '''Returns the welcome message, the channels are the ones of the guild.'''
+    def channel(setting):
+        return models.GuildConfig.GuildConfig.channel_id(guild_id, setting)
+
+    return f'''
+Hallo {name},
 Willkommen auf dem Discord Server der The Penguin Army!
-Bitte lies unbedingt den Kanal <#{channel_id_info}> unter Allgemeines!
-Um The Penguin Army beizutreten ist eine Bestätigung der <#{channel_id_regeln}> erforderlich!
+Bitte lies unbedingt den Kanal <#{channel('info_channel_id')}> unter Allgemeines!
+Um The Penguin Army beizutreten ist eine Bestätigung der <#{channel('rules_channel_id')}> erforderlich!
 
-Falls Du Dich als Mitglied bewerben möchtest, schreibe Deine Bewerbung an die entsprechende Person. Siehe Infos dazu im Kanal <#{channel_id_bewerben}>.
+Falls Du Dich als Mitglied bewerben möchtest, schreibe Deine Bewerbung an die entsprechende Person. Siehe Infos dazu im Kanal <#{channel('apply_channel_id')}>.
 
-Ansonsten wünschen wir Dir viel Spaß bei der The Penguin Army.''')
+Ansonsten wünschen wir Dir viel Spaß bei der The Penguin Army.'''
 
 
 @bot.event
-async def on_member_remove(member):
-    if os.getenv('enable_member_join_messages') == 'true':
-        # Get the discord channel id from local environment
-        channel_id = os.getenv('log_channel_id')
-        discord_log_channel = bot.get_channel(int(channel_id))
+async def on_member_join(member):
+    member_events.push('join', member)
 
-        if discord_log_channel != None:
-            logging.debug(f'Logging channel id {channel_id} found.')
 
-            message = f':door:<@{member.id}> `{member.name}#{member.discriminator}` hat den Server verlassen.'
+async def handle_member_join(member):
+    # The log channel of the guild, the sink sends the messages in batches
+    channel_id = models.GuildConfig.GuildConfig.channel_id(
+        member.guild.id, 'log_channel_id')
+    if os.getenv('enable_member_join_messages') == 'true' and channel_id != None:
+        message = f':new:<@{member.id}> `{member.name}#{member.discriminator}` ist dem Server beigetreten.'
+        LogChannelSink.for_channel(bot, channel_id).add(message)
 
-            await discord_log_channel.send(message)
-        else:
-            logging.error(f'Logging channel id {channel_id} NOT found.')
+    # Send welcome message to player, also in guilds without log channel
+    if os.getenv('enable_welcome_msg') == 'true':
+        await member.send(welcome_message(member.name, member.guild.id))
+
+
+@bot.event
+async def on_member_remove(member):
+    member_events.push('remove', member)
+
+
+async def handle_member_remove(member):
+    channel_id = models.GuildConfig.GuildConfig.channel_id(
+        member.guild.id, 'log_channel_id')
+    if os.getenv('enable_member_join_messages') == 'true' and channel_id != None:
+        message = f':door:<@{member.id}> `{member.name}#{member.discriminator}` hat den Server verlassen.'
+        LogChannelSink.for_channel(bot, channel_id).add(message)
 
 
 @bot.event
 async def on_member_update(before, after):
     if os.getenv('enable_combo_roles') == 'true':
-        await assign_combo_role(before, after, role_list)
+        # Only role changes can change the combo roles
+        if before.roles != after.roles:
+            member_events.push('update', after)
 
 
-# Assign the role
-async def assign_combo_role(before, after, comb_role_list):
-    message = ''
-    logging.debug(f'Editing roles for {before.name}')
-    for role_list in comb_role_list:
-        required_roles = []
-        for role in role_list[1]:
-            required_role = discord.utils.get(after.guild.roles, id=role)
-            logging.debug(
-                f'Found role: {required_role.name} ({required_role.id})')
+async def handle_member_update(member):
+    # Use the latest cached state of the member
+    member = member.guild.get_member(member.id) or member
+    engine = get_combo_roles(member.guild)
+    if engine != None:
+        await engine.apply(member)
 
-            logging.debug(
-                f'Adding player {before.name} role: {required_role.name} ({required_role.id})')
-            required_roles.append(required_role)
 
-        combo_role = discord.utils.get(after.guild.roles, id=role_list[0])
+member_events.handlers.update({
+    'join': handle_member_join,
+    'remove': handle_member_remove,
+    'update': handle_member_update})
 
-        # Compares the length of roles from before with after
-        if len(before.roles) != len(after.roles):
 
-            if set(required_roles).issubset(after.roles):
-                logging.debug(
-                    f'Adding combo role {combo_role.name} for player {before.name}')
-                await after.add_roles(combo_role)
+@bot.event
+async def on_guild_role_create(role):
+    engine = get_combo_roles(role.guild)
+    if engine != None:
+        engine.on_role_changed(role)
 
-                # Create a log channel message
-                message = f':information_source:<@{before.id}> hat die Komborolle {combo_role.name} zugewiesen bekommen.'
-            else:
-                logging.debug(
-                    f'Removing combo role {combo_role.name} for player {before.name}')
-                await after.remove_roles(combo_role)
 
-                # Create a log channel message
-                message = f':information_source:<@{before.id}> hat die Komborolle {combo_role.name} entfernt bekommen.'
-            logging.debug(
-                f'Done with editing roles for player {before.name}')
+@bot.event
+async def on_guild_role_update(before, after):
+    engine = get_combo_roles(after.guild)
+    if engine != None:
+        engine.on_role_changed(after)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    engine = get_combo_roles(role.guild)
+    if engine != None:
+        engine.on_role_deleted(role)
+
+
+# Player limit of the leaderboard views by message description
+xp_message_views = {'member_clan_xp': 10, 'admin_clan_xp': -1}
+
+
+async def render_xp_messages(messages):
+    '''Renders every leaderboard view once per guild, all messages of a run share these embeds.
+
+    The embeds are keyed by (guild id, description).'''
+    embeds = {}
+    for msg in messages:
+        key = (msg.guild_id, msg.description)
+        if key not in embeds and msg.description in xp_message_views:
+            embeds[key] = await models.Player.Player.get_player_weekly_xp_as_message(
+                player_limit=xp_message_views[msg.description], guild_id=msg.guild_id)
+    return embeds
+
+
+async def edit_embed(channel_id, message_id, embed):
+    '''Edits a message of the bot. Channels of guilds on the shards of other processes
+    aren't cached, their messages are edited through the REST API.'''
+    channel = bot.get_channel(channel_id)
+    if channel != None:
+        await channel.get_partial_message(message_id).edit(embed=embed, content=None)
+    else:
+        await bot.http.edit_message(channel_id, message_id, embed=embed.to_dict(), content=None)
+
+
+async def send_embed(channel_id, embed):
+    '''Sends an embed and returns the id of the message, see edit_embed.'''
+    channel = bot.get_channel(channel_id)
+    if channel != None:
+        return (await channel.send(embed=embed)).id
+
+    data = await bot.http.send_message(channel_id, None, embed=embed.to_dict())
+    return int(data['id'])
+
+
+async def send_text(channel_id, content):
+    '''Sends a text message and returns the id of the message, see edit_embed.'''
+    channel = bot.get_channel(channel_id)
+    if channel != None:
+        return (await channel.send(content)).id
+
+    data = await bot.http.send_message(channel_id, content)
+    return int(data['id'])
+
+
+async def add_reaction(channel_id, message_id, emoji):
+    '''Adds a reaction of the bot to a message, see edit_embed.'''
+    channel = bot.get_channel(channel_id)
+    if channel != None:
+        await channel.get_partial_message(message_id).add_reaction(emoji)
+    else:
+        await bot.http.add_reaction(channel_id, message_id, emoji)
 
 
 async def update_xp_messages():
-    # Edit message: https://stackoverflow.com/a/55711759
-    for msg in models.Message.Message.select():
-        channel = bot.get_channel(msg.discord_channel_id)
+    '''Edits the stored leaderboard messages, messages which already show the current embed are skipped.'''
+    messages = await Database.select(models.Message.Message.select())
+    embeds = await render_xp_messages(messages)
+    hashes = {key: models.Message.Message.hash_embed(embed)
+              for key, embed in embeds.items()}
+
+    counts = {'edited': 0, 'skipped': 0, 'failed': 0}
+    edited = []
+
+    # discord.py waits for the rate limit of each channel itself, the semaphore keeps the bursts small
+    semaphore = asyncio.Semaphore(
+        int(os.getenv('xp_message_edit_concurrency', 3)))
+
+    async def edit_message(msg):
+        key = (msg.guild_id, msg.description)
+        if key not in embeds:
+            return
 
-        try:
-            xp_message = await channel.fetch_message(msg.discord_message_id)
-        except:
-            logging.error(f'Failed to parse the msg id')
-        else:
-            if msg.description == 'member_clan_xp':
-                xp_msg = await models.Player.Player.get_player_weekly_xp_as_message()
-                await xp_message.edit(embed=xp_msg, content=None)
-            elif msg.description == 'admin_clan_xp':
-                xp_msg = await models.Player.Player.get_player_weekly_xp_as_message(player_limit=-1)
-                await xp_message.edit(embed=xp_msg, content=None)
+        if msg.content_hash == hashes[key]:
+            counts['skipped'] += 1
+            return
+
+        # Edit message: https://stackoverflow.com/a/55711759
+        # A partial message saves fetching the message before editing it
+        async with semaphore:
+            try:
+                await edit_embed(msg.discord_channel_id, msg.discord_message_id, embeds[key])
+            except discord.HTTPException as edit_error:
+                logging.error(f'Failed to edit message {msg}: {edit_error}')
+                counts['failed'] += 1
+                return
+
+        msg.content_hash = hashes[key]
+        edited.append(msg)
+        counts['edited'] += 1
+
+    await asyncio.gather(*[edit_message(msg) for msg in messages])
+    await Database.run_write(models.Message.Message.save_hashes, edited)
+
+    logging.info(
+        f"XP messages: {counts['edited']} edited, {counts['skipped']} skipped, {counts['failed']} failed")
 
 
 async def new_xp_messages():
-    for msg in models.Message.Message.select():
-        channel = bot.get_channel(msg.discord_channel_id)
-        if msg.description == 'member_clan_xp':
-            xp_msg = await models.Player.Player.get_player_weekly_xp_as_message()
-            sent_message = await channel.send(embed=xp_msg)
+    messages = await Database.select(models.Message.Message.select())
+    embeds = await render_xp_messages(messages)
+
+    for msg in messages:
+        key = (msg.guild_id, msg.description)
+        if key not in embeds:
+            continue
+
+        try:
+            message_id = await send_embed(msg.discord_channel_id, embeds[key])
+        except discord.HTTPException as send_error:
+            logging.error(f'Failed to send message {msg}: {send_error}')
+            continue
+
+        # Save the message id to the database, so we can edit it later
+        msg.discord_message_id = message_id
+        msg.content_hash = models.Message.Message.hash_embed(embeds[key])
+        await Database.run_write(msg.save)
+
+
+# Steps of the player pipelines, results holds the results of the previous steps
+async def sync_members_step(results):
+    return await models.Player.Player.get_members(session=Http.get_session())
+
+
+async def check_memberships_step(results):
+    players, deleted = await models.Player.Player.check_memberships(session=Http.get_session())
+    return players
 
-        elif msg.description == 'admin_clan_xp':
-            xp_msg = await models.Player.Player.get_player_weekly_xp_as_message(player_limit=-1)
-            sent_message = await channel.send(embed=xp_msg)
 
-        if sent_message != None:
-            # Save the message id to the database, so we can edit it later
-            msg.discord_message_id = sent_message.id
-            msg.save()
+async def refresh_xp_step(results):
+    return await models.Player.Player.refresh_players(
+        bot=bot, session=Http.get_session(), players=results['membership'])
+
+
+async def upload_step(results):
+    # The players of the membership check carry the xp of this run
+    await models.Player.Player.upload_player_data(session=Http.get_session(), players=results['membership'])
+
+
+async def drain_uploads():
+    await models.UploadOutbox.UploadOutbox.drain(session=Http.get_session())
+
+
+async def rollup_xp_history():
+    await Database.run_write(models.XpHistory.XpHistory.rollup)
+
+
+async def rollover_step(results):
+    return await Database.run_write(models.Player.Player.rollover_weekly_xp)
+
+
+async def update_xp_messages_step(results):
+    await update_xp_messages()
+
+
+async def new_xp_messages_step(results):
+    await new_xp_messages()
+
+
+# All player pipelines share one lock, a run is skipped while another one works on the players
+player_update_pipeline = Pipeline('player_update', [
+    Step('membership', check_memberships_step),
+    Step('xp', refresh_xp_step, requires=['membership']),
+    Step('render', update_xp_messages_step, requires=['xp'])], lock='players')
+
+member_sync_pipeline = Pipeline('member_sync', [
+    Step('member_sync', sync_members_step)], lock='players')
+
+# Thursday: the xp are fetched once, uploaded to the CV and then the new week starts.
+# Nothing else uploads or starts the week, so a running player update is waited for, not skipped.
+weekly_pipeline = Pipeline('weekly', [
+    Step('member_sync', sync_members_step),
+    Step('membership', check_memberships_step, requires=['member_sync']),
+    Step('xp', refresh_xp_step, requires=['membership']),
+    Step('upload', upload_step, requires=['xp']),
+    Step('rollover', rollover_step, requires=['upload']),
+    Step('render', new_xp_messages_step, requires=['rollover'])], lock='players', wait=True)
 
 
 @bot.command()
 async def joinmsg(ctx, *args):
     if os.getenv('enable_welcome_debug_msg') == 'true':
-        message = f'''
-Hallo {ctx.author.display_name},
-Willkommen auf dem Discord Server der The Penguin Army!
-Bitte lies unbedingt den Kanal <#{channel_id_info}> unter Allgemeines!
-Um The Penguin Army beizutreten ist eine Bestätigung der <#{channel_id_regeln}> erforderlich!
-
-Falls Du Dich als Mitglied bewerben möchtest, schreibe Deine Bewerbung an die entsprechende Person. Siehe Infos dazu im Kanal <#{channel_id_bewerben}>.
-
-Ansonsten wünschen wir Dir viel Spaß bei der The Penguin Army.'''
+        message = welcome_message(
+            ctx.author.display_name, ctx.guild.id if ctx.guild != None else None)
         await ctx.author.send(message)
     else:
         message = "Currently not in debugging mode, command not available!"
@@ -187,48 +475,138 @@ async def xpmessage(ctx, *args):
         await ctx.author.send(message)
 
 
-@bot.command()
-async def termine(ctx, *args):
-    # Retrieve the calender settings
-    logging.debug(
-        f"Parsing calender credentials from {Path(os.getenv('calendar_credentials_path'))}")
+def get_calendar():
+    '''Returns the calendar cache, it is created on first use.'''
+    global calendar_cache
+
+    if calendar_cache == None:
+        # The Google client stack is only imported if the calendar is used
+        from models.Tools.Calendar import CalendarCache
+        calendar_cache = CalendarCache(
+            calendar=os.getenv('kalender_mail'),
+            credentials_path=os.getenv('calendar_credentials_path'),
+            token_path=os.getenv('calendar_token_path'),
+            max_age=int(os.getenv('calendar_cache_seconds', 900)))
+    return calendar_cache
+
+
+async def send_with_reactions(channel_id, embeds, reactions=('✅', '🤷')):
+    '''Sends the embeds in order and adds the reactions to all messages concurrently.
+    Returns the ids of the messages.'''
+    message_ids = []
+    for embed in embeds:
+        message_ids.append(await send_embed(channel_id, embed))
+
+    async def add_reactions(message_id):
+        # The order of the reactions has to stay the same
+        for reaction in reactions:
+            await add_reaction(channel_id, message_id, reaction)
+
+    await asyncio.gather(*[add_reactions(message_id) for message_id in message_ids])
+    return message_ids
+
+
+def schedule_reminder(row):
+    '''Schedules the reminder of a stored calendar event on the timer wheel.'''
+    remind_at = row.start - \
+        datetime.timedelta(minutes=int(os.getenv('calendar_reminder_minutes', 60)))
+
+    if row.reminded or row.start < datetime.datetime.now():
+        reminders.cancel(row.event_id)
+        return
+
+    reminders.schedule(row.event_id, max(time.time(), remind_at.timestamp()),
+                       lambda: send_reminder(row.event_id, row.summary, row.start))
+
 
-    calendar = GoogleCalendar(
-        calendar=os.getenv('kalender_mail'),
-        credentials_path=Path(os.getenv('calendar_credentials_path')),
-        token_path=Path(os.getenv('calendar_token_path')))
+def calendar_channel_id(guild_id=None):
+    '''Returns the id of the calendar channel of a guild, the calendar feed posts to the one of the
+    default guild. Its guild may be on the shards of another process, so it is sent to by id.'''
+    return models.GuildConfig.GuildConfig.channel_id(guild_id, 'calendar_channel_id')
 
-    # Parse the channel id and convert it to integer
-    channel_id = os.getenv('calender_channel_id')
-    discord_channel = bot.get_channel(int(channel_id))
 
-    if discord_channel != None:
-        logging.debug(f'Calender channel id {channel_id} found.')
+async def send_reminder(event_id, summary, start):
+    channel_id = calendar_channel_id()
+    if channel_id == None:
+        logging.error('Calender channel for the reminder NOT found.')
+        return
 
-        logging.debug('Preparing the download of the calendar events...')
+    await send_text(channel_id, f':alarm_clock: Erinnerung: **{summary}** beginnt am {start.strftime("%d.%m.%Y um %H:%M")} Uhr.')
+    await Database.run_write(models.CalendarEvent.CalendarEvent.mark_reminded, event_id)
 
-        for event in calendar:
-            # New Embed formatting
-            embed = discord.Embed(title=f":calendar_spiral: {event.summary}\n")
 
-            # Prepare datetime formatting
-            time_format = "%d.%m.%Y %H:%M"
-            dt = event.start  # Contains the start time of the event
+async def load_reminders():
+    '''Puts the reminders of all stored future events on the timer wheel.'''
+    for row in await Database.run_read(models.CalendarEvent.CalendarEvent.pending_reminders):
+        schedule_reminder(row)
+    logging.debug(f'{len(reminders)} calendar reminders scheduled')
 
-            # Add beginning time as field
-            embed.add_field(name="Beginn",
-                            value=dt.strftime(time_format), inline=False)
 
-            # Add a description
-            embed.add_field(name="Beschreibung",
-                            value=event.description, inline=False)
+async def poll_calendar():
+    '''Posts new and changed calendar events, only the changes since the last poll are processed.'''
+    calendar = get_calendar()
+    await calendar.refresh()
+    changes = calendar.take_changes()
 
-            # Send the embed
-            embed_msg = await discord_channel.send(embed=embed)
+    # The first poll only fills the table, otherwise the whole calendar would be posted. An empty
+    # table doesn't mean the first poll, all events may have been deleted since.
+    SyncState = models.SyncState.SyncState
+    seed = await Database.run_read(SyncState.get_value, 'calendar_seeded') == None
+    if seed and not await Database.run_read(models.CalendarEvent.CalendarEvent.is_empty):
+        # Stored by a version without the flag
+        seed = False
 
-            # Add reactions for yes and maybe.
-            await embed_msg.add_reaction('✅')
-            await embed_msg.add_reaction('🤷')
+    changed, deleted = [], []
+    if len(changes) > 0:
+        changed, deleted = await Database.run_write(models.CalendarEvent.CalendarEvent.store_changes, changes)
+    if seed:
+        await Database.run_write(SyncState.set_value, 'calendar_seeded', '1')
+    if len(changes) == 0:
+        return
+
+    for event_id in deleted:
+        reminders.cancel(event_id)
+
+    channel_id = calendar_channel_id()
+    now = datetime.datetime.now()
+    posted = []
+    for row, event in changed:
+        schedule_reminder(row)
+
+        if seed or row.start < now or channel_id == None:
+            continue
+
+        embed = get_calendar().create_embed(event)
+        try:
+            if row.discord_message_id != None:
+                # Changed events are updated in place, so the reactions are kept
+                await edit_embed(channel_id, row.discord_message_id, embed)
+            else:
+                row.discord_message_id = (await send_with_reactions(channel_id, [embed]))[0]
+                posted.append(row)
+        except discord.HTTPException as err:
+            logging.error(f'Posting calendar event {row} failed: {err}')
+
+    for row in posted:
+        await Database.run_write(row.save)
+
+    logging.info(
+        f'Calendar feed: {len(changed)} changed, {len(deleted)} deleted, {len(posted)} posted')
+
+
+@bot.command()
+async def termine(ctx, *args):
+    channel_id = calendar_channel_id(
+        ctx.guild.id if ctx.guild != None else None)
+
+    if channel_id != None:
+        logging.debug(f'Calender channel {channel_id} found.')
+
+        # The embeds are prepared by the calendar cache
+        embeds = await get_calendar().get_embeds()
+
+        # Send the embeds, add reactions for yes and maybe.
+        await send_with_reactions(channel_id, embeds)
 
 
 @ bot.event
@@ -245,95 +623,257 @@ async def on_message(message):
             return
 
 
-if __name__ == '__main__':
+# Jobs of the scheduler by name, they can be profiled with the profile command
+scheduled_jobs = {
+    'weekly': weekly_pipeline.run,
+    'player_update': player_update_pipeline.run,
+    'member_sync': member_sync_pipeline.run,
+    'poll_calendar': poll_calendar,
+    'drain_uploads': drain_uploads,
+    'xp_history_rollup': rollup_xp_history,
+}
 
-    # Load environmental variables
-    load_dotenv(override=True)
-    log_level = os.getenv('log_level').upper()
-    enable_crons = os.getenv('enable_crons')
+# Jobs the profile command may run. An extra run of these only does early what their schedule does anyway,
+# the weekly pipeline uploads to the CV, starts a new week and posts new leaderboards, so it is never run by hand.
+profiled_jobs = [name for name in scheduled_jobs if name != 'weekly']
 
-    # Role Setup for server roles
-    combi_role_idDiv = int(os.getenv('combi_role_idDiv'))
-    combi_role_idBF = int(os.getenv('combi_role_idBF'))
-    combi_role_idNW = int(os.getenv('combi_role_idNW'))
 
-    # TPA default role id
-    role_id_TPA = int(os.getenv('role_id_TPA'))
+def job(name):
+    '''Returns a scheduled job with metrics and, in profiling mode, profiling.'''
+    return Metrics.job(name, Profiling.job(name, scheduled_jobs[name]))
 
-    # Game roles
-    role_id_Div = int(os.getenv('role_id_Div'))
-    role_id_BF = int(os.getenv('role_id_BF'))
-    role_id_NW = int(os.getenv('role_id_NW'))
 
-    role_list = [
-        [combi_role_idDiv, [role_id_TPA, role_id_Div]],
-        [combi_role_idBF, [role_id_TPA, role_id_BF]],
-        [combi_role_idNW, [role_id_TPA, role_id_NW]]
-    ]
+async def start_command_profile(ctx):
+    # The profile command runs its own profile
+    if ctx.command.qualified_name != 'profile':
+        ctx.profile = Profiling.start(f'command-{ctx.command.qualified_name}')
 
-    # Required Channel IDs for the welcome message
-    channel_id_info = int(os.getenv('channel_id_info'))
-    channel_id_regeln = int(os.getenv('channel_id_regeln'))
-    channel_id_bewerben = int(os.getenv('channel_id_bewerben'))
 
-    # Logging configuration
-    log_file = 'bot.log'
-    log_encoding = 'utf-8'
+async def stop_command_profile(ctx):
+    Profiling.stop(getattr(ctx, 'profile', None))
 
-    # Create the logging handler
-    my_handler = logging.StreamHandler(sys.stdout)
 
-    # Set the logging level
-    my_handler.setLevel(log_level)
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def profile(ctx, name=None, *args):
+    '''Profiles one run of a scheduled job, "profile slow on|off" switches the slow callback report.'''
+    if name == 'slow':
+        loop = asyncio.get_event_loop()
+        if len(args) > 0 and args[0] == 'off':
+            Profiling.disable_slow_callbacks(loop, db)
+            await ctx.send('Slow callback report disabled')
+        else:
+            Profiling.enable_slow_callbacks(
+                loop, db, threshold=float(os.getenv('slow_callback_ms', 100)) / 1000)
+            await ctx.send('Slow callback report enabled, see the log')
+        return
+
+    if name not in profiled_jobs:
+        await ctx.send(f"Available jobs: {', '.join(sorted(profiled_jobs))}, or slow on|off")
+        return
+
+    await ctx.send(f'Profiling job {name}...')
+    _, path = await Profiling.run_profiled(name, scheduled_jobs[name])
+    if path == None:
+        await ctx.send(f'Job {name} ran without profile, another profile was running')
+    else:
+        await ctx.send(f'Profile of job {name} saved to {path}')
 
-    # Create the config with the file handler from above
-    logging.basicConfig(level=log_level,
-                        handlers=[my_handler],
-                        format='[%(levelname)s]%(asctime)s: %(message)s', datefmt='%d.%m.%Y %H:%M:%S')
 
-    # Connect to the database and create missing tables
+@bot.command()
+@commands.guild_only()
+@commands.has_permissions(administrator=True)
+async def config(ctx, setting=None, channel_id: int = None):
+    '''Shows the channel settings of the server, "config <setting> <channel id>" changes one.'''
+    GuildConfig = models.GuildConfig.GuildConfig
+    if setting == None:
+        guild_config = GuildConfig.for_guild(ctx.guild.id)
+        lines = [f'{name}: {getattr(guild_config, name) if guild_config != None else None}'
+                 for name in GuildConfig.SETTINGS]
+        await ctx.send('\n'.join(lines))
+        return
+
+    if setting not in GuildConfig.SETTINGS:
+        await ctx.send(f"Available settings: {', '.join(GuildConfig.SETTINGS)}")
+        return
+
+    await Database.run_write(GuildConfig.set_value, ctx.guild.id, setting, channel_id)
+    await ctx.send(f'{setting} set to {channel_id}')
+
+
+def setup_database():
+    '''Connects to the database, creates or migrates the tables and loads the guild configs, runs on the writer thread.'''
     logging.debug('Creating connection to database...')
-    db.connect()
-    logging.debug('Creating missing tables...')
-    db.create_tables(models=[models.Player.Player, models.Message.Message])
+    db.connect(reuse_if_open=True)
+    Migrations.setup_schema(db, models=[models.Player.Player, models.Message.Message,
+                                        models.SyncState.SyncState, models.CalendarEvent.CalendarEvent,
+                                        models.UploadOutbox.UploadOutbox, models.XpHistory.XpHistory,
+                                        models.GuildConfig.GuildConfig])
+    models.GuildConfig.GuildConfig.load()
+
+
+def runs_jobs():
+    '''With the shards split across processes only the process of shard 0 runs the scheduled jobs
+    and sends the calendar reminders.'''
+    return bot.shard_ids == None or 0 in bot.shard_ids
+
+
+def create_scheduler():
+    '''Creates the scheduler with all jobs, apscheduler is imported here to keep the bot import fast.'''
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
     # Scheduler for timing events
     # how to add jobs: https://apscheduler.readthedocs.io/en/stable/userguide.html#adding-jobs
     # https://cron.help/
-    scheduler = AsyncIOScheduler()
-    # https://cron.help/#15_10_*_*_4
+    # Missed runs are coalesced into one, a job never runs twice at the same time
+    scheduler = AsyncIOScheduler(job_defaults={
+        'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 300})
 
     # Feature toggle disable_crons: Disables all cronjobs to better test settings and dont get into problems
-    # with production.
-    if enable_crons == 'true':
+    # with production. With the shards split across processes only the process of shard 0 runs them.
+    if enable_crons == 'true' and not runs_jobs():
+        logging.info('Cronjobs run in the process of shard 0')
+    elif enable_crons == 'true':
         logging.info('Enabling cronjobs...')
 
-        scheduler.add_job(new_xp_messages, 'cron',
-                          day_of_week='thu', minute=15, hour=10)
+        # Weekly pipeline: member sync, membership check, xp, upload to CV, new week and new xp messages
+        # Runs at 10 o'clock, so the new messages show the new week. https://cron.help/#0_10_*_*_4
+        scheduler.add_job(job('weekly'), 'cron',
+                          day_of_week='thu', hour=10)
 
-        # https://cron.help/#*/30_0-9,11_*_*_*
-        scheduler.add_job(update_xp_messages, 'cron',
-                          minute='*/30', hour='0-9,11-23')
+        # Update player data and the xp messages, https://cron.help/#15/30_*_*_*_*
+        scheduler.add_job(job('player_update'),
+                          trigger='cron', minute='15/30')
 
-        # Update player data, https://cron.help/#15/30_*_*_*_*
-        scheduler.add_job(models.Player.Player.update_player_data, kwargs={
-            'bot': bot}, trigger='cron', minute='15/30')
+        # Post new and changed calendar events
+        if os.getenv('enable_calendar_feed') == 'true':
+            scheduler.add_job(job('poll_calendar'), 'interval',
+                              minutes=int(os.getenv('calendar_poll_minutes', 10)))
 
         # Retrieve new members
-        scheduler.add_job(models.Player.Player.get_members,
-                          'cron', minute=55)
+        scheduler.add_job(job('member_sync'), 'cron', minute=55)
 
-        # Update weekly xp
-        scheduler.add_job(models.Player.Player.update_player_data, kwargs={
-            'update_weekly_xp': True, 'bot': bot}, trigger='cron',  day_of_week='thu', hour=10)
+        # Retry weekly xp uploads which failed, https://cron.help/#*/10_*_*_*_*
+        scheduler.add_job(job('drain_uploads'), 'cron', minute='*/10')
 
-        # Upload weekly xp to CV
-        scheduler.add_job(models.Player.Player.upload_player_data,
-                          trigger='cron',  day_of_week='thu', hour=9, minute='40')
+        # Roll up and expire the xp history, https://cron.help/#40_4_*_*_*
+        scheduler.add_job(job('xp_history_rollup'), 'cron', hour=4, minute=40)
 
     else:
         logging.info('Starting with disabled cronjobs...')
 
-    scheduler.start()
+    return scheduler
+
+
+def report_startup():
+    '''Logs the duration of the startup stages once all of them finished.'''
+    stages = ['imports', 'database', 'scheduler', 'gateway']
+    if 'reported' in startup_timings or any(stage not in startup_timings for stage in stages):
+        return
+
+    startup_timings['reported'] = True
+    logging.info('Startup finished in {:.1f}s: '.format(time.monotonic() - startup_started) +
+                 ', '.join(f'{stage} {startup_timings[stage]:.2f}s' for stage in stages) +
+                 ' (the gateway login runs parallel to database and scheduler)')
+
+
+async def start_bot(token):
+    '''Logs in to the gateway while the database and the scheduler are set up, runs until the bot closes.'''
+    global login_started
+
+    login_started = time.monotonic()
+    login = asyncio.ensure_future(bot.start(token))
+
+    try:
+        started = time.monotonic()
+        await Database.run_write(setup_database)
+        startup_timings['database'] = time.monotonic() - started
+        database_ready.set()
+
+        interval = float(os.getenv('guild_config_reload_seconds', 60))
+        if interval > 0:
+            bot.config_watcher = asyncio.ensure_future(
+                watch_guild_configs(interval))
+
+        started = time.monotonic()
+        create_scheduler().start()
+        startup_timings['scheduler'] = time.monotonic() - started
+    except Exception:
+        logging.exception('Startup failed, closing the bot')
+        await bot.close()
+        login.cancel()
+        raise
+
+    report_startup()
+    try:
+        await login
+    finally:
+        # Like bot.run, close the connections and threads however the login ends
+        await bot.close()
+
+
+if __name__ == '__main__':
+    startup_timings['imports'] = time.monotonic() - startup_started
+
+    # Load environmental variables
+    load_dotenv(override=True)
+    log_level = os.getenv('log_level').upper()
+    enable_crons = os.getenv('enable_crons')
+
+    # Shards of this process, e.g. shard_count=4 and shard_ids=0,1 for the first of two processes.
+    # The roles and channels of the guilds are stored in the guild configs.
+    # The bot is created on import, so the check of AutoShardedBot for shard_ids without
+    # shard_count is repeated here
+    if os.getenv('shard_ids') != None and os.getenv('shard_count') == None:
+        sys.exit('shard_ids requires shard_count')
+    if os.getenv('shard_count') != None:
+        bot.shard_count = int(os.getenv('shard_count'))
+    if os.getenv('shard_ids') != None:
+        bot.shard_ids = [int(shard_id)
+                         for shard_id in os.getenv('shard_ids').split(',')]
+
+    # Debounce window and workers of the member event queue
+    member_events.debounce = float(os.getenv('member_event_debounce', 2))
+    member_events.workers = int(os.getenv('member_event_workers', 2))
+
+    # Logging configuration
+    log_file = 'bot.log'
+    log_encoding = 'utf-8'
+
+    # Create the logging handler
+    my_handler = logging.StreamHandler(sys.stdout)
 
-    bot.run(os.getenv('discord_bot_key'))
+    # Set the logging level
+    my_handler.setLevel(log_level)
+
+    # Create the config with the file handler from above
+    logging.basicConfig(level=log_level,
+                        handlers=[my_handler],
+                        format='[%(levelname)s]%(asctime)s: %(message)s', datefmt='%d.%m.%Y %H:%M:%S')
+
+    # Profiling mode wraps the jobs and the commands in cProfile sessions
+    Profiling.setup()
+    if Profiling.enabled:
+        bot.before_invoke(start_command_profile)
+        bot.after_invoke(stop_command_profile)
+
+    # Close the bot on SIGTERM and SIGINT, e.g. docker stop
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            bot.loop.add_signal_handler(
+                stop_signal, lambda: asyncio.ensure_future(bot.close()))
+        except NotImplementedError:
+            pass
+
+    try:
+        bot.loop.run_until_complete(start_bot(os.getenv('discord_bot_key')))
+    except KeyboardInterrupt:
+        bot.loop.run_until_complete(bot.close())
+    finally:
+        # Cancel the tasks which are still running, e.g. the jobs of the scheduler, as bot.run does
+        pending = [task for task in asyncio.all_tasks(bot.loop) if not task.done()]
+        for task in pending:
+            task.cancel()
+        bot.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        bot.loop.run_until_complete(bot.loop.shutdown_asyncgens())
+        bot.loop.close()
@@ -1,7 +1,15 @@
 from peewee import Model, SqliteDatabase
 
 
-database = SqliteDatabase('tpa.db')
+# The one database handle of the bot.
+# WAL lets the leaderboard read while a refresh writes, synchronous = NORMAL is safe with WAL.
+database = SqliteDatabase('tpa.db', timeout=10, pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 1,
+    'cache_size': -16 * 1024,  # 16 MB
+    'mmap_size': 64 * 1024 * 1024,
+    'busy_timeout': 10000,
+    'temp_store': 'memory'})
 
 
 class BaseModel(Model):
@@ -0,0 +1,122 @@
+import logging
+import os
+
+from peewee import DateTimeField, IntegerField, TextField
+from playhouse.migrate import SqliteMigrator, migrate
+
+# Stored as PRAGMA user_version inside the database
+SCHEMA_VERSION = 4
+
+
+def add_weekly_delta(database):
+    '''Version 1: index on the Discord ID and the stored weekly xp delta for the leaderboard.
+
+    The index names match the ones peewee generates for index=True fields.'''
+    if 'players' not in database.get_tables():
+        return
+
+    columns = [column.name for column in database.get_columns('players')]
+    if 'player_weekly_delta' not in columns:
+        migrator = SqliteMigrator(database)
+        migrate(migrator.add_column('players', 'player_weekly_delta',
+                                    IntegerField(null=True)))
+
+    database.execute_sql(
+        'UPDATE players SET player_weekly_delta = player_weekly_xp - player_xp')
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS player_player_discord_id ON players (player_discord_id)')
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS player_player_weekly_delta ON players (player_weekly_delta)')
+
+
+def add_message_hash(database):
+    '''Version 2: content hash of the last embed sent for a leaderboard message.'''
+    if 'discord_messages' not in database.get_tables():
+        return
+
+    columns = [column.name for column in database.get_columns('discord_messages')]
+    if 'content_hash' not in columns:
+        migrator = SqliteMigrator(database)
+        migrate(migrator.add_column('discord_messages', 'content_hash',
+                                    TextField(null=True)))
+
+
+def add_guild_ids(database):
+    '''Version 3: guild of players and leaderboard messages.
+
+    Existing rows belong to the guild of the environment variable guild_id, if it is set.'''
+    guild_id = os.getenv('guild_id')
+    for table, index in [('players', 'player_guild_id'), ('discord_messages', 'message_guild_id')]:
+        if table not in database.get_tables():
+            continue
+
+        columns = [column.name for column in database.get_columns(table)]
+        if 'guild_id' not in columns:
+            migrator = SqliteMigrator(database)
+            migrate(migrator.add_column(table, 'guild_id',
+                                        IntegerField(null=True)))
+
+        if guild_id != None:
+            database.execute_sql(
+                f'UPDATE {table} SET guild_id = ? WHERE guild_id IS NULL', (int(guild_id),))
+        database.execute_sql(
+            f'CREATE INDEX IF NOT EXISTS {index} ON {table} (guild_id)')
+
+
+def add_outbox_failed_at(database):
+    '''Version 4: time an upload of the outbox was given up.'''
+    if 'upload_outbox' not in database.get_tables():
+        return
+
+    columns = [column.name for column in database.get_columns('upload_outbox')]
+    if 'failed_at' not in columns:
+        migrator = SqliteMigrator(database)
+        migrate(migrator.add_column('upload_outbox', 'failed_at',
+                                    DateTimeField(null=True)))
+
+
+# Version and migration function, in order
+MIGRATIONS = [
+    (1, add_weekly_delta),
+    (2, add_message_hash),
+    (3, add_guild_ids),
+    (4, add_outbox_failed_at),
+]
+
+
+def get_schema_version(database):
+    return database.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_schema_version(database, version):
+    database.execute_sql(f'PRAGMA user_version = {int(version)}')
+
+
+def setup_schema(database, models):
+    '''Migrates existing tables to SCHEMA_VERSION and creates missing tables.'''
+    version = get_schema_version(database)
+    tables = database.get_tables()
+
+    # The version is only set after all tables were created, so a current version means nothing to do
+    if version == SCHEMA_VERSION and all(model._meta.table_name in tables for model in models):
+        logging.debug(f'Database schema version {version} is current')
+        return
+
+    # Tables of a new database are created with the current schema right away
+    if len(tables) > 0:
+        for migration_version, migration in MIGRATIONS:
+            if version < migration_version:
+                logging.info(
+                    f'Migrating database to schema version {migration_version}...')
+                with database.atomic():
+                    migration(database)
+                    set_schema_version(database, migration_version)
+
+    logging.debug('Creating missing tables...')
+    # create_tables uses the database of the models, so they are bound to this one meanwhile
+    with database.bind_ctx(models):
+        database.create_tables(models=models)
+    set_schema_version(database, SCHEMA_VERSION)
+
+    # Let the query planner know about the new indexes
+    database.execute_sql('ANALYZE')
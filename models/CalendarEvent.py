@@ -0,0 +1,91 @@
+import datetime
+import hashlib
+import json
+
+from peewee import (AutoField, BooleanField, DateTimeField, IntegerField,
+                    TextField)
+from models.BaseModel import BaseModel
+
+
+class CalendarEvent(BaseModel.BaseModel):
+    calendar_event_id = AutoField(null=True)
+    event_id = TextField(unique=True)
+    summary = TextField(null=True)
+    description = TextField(null=True)
+    # Local time of the start
+    start = DateTimeField(null=True, index=True)
+    # Hash of summary, description and start, changed events are posted again
+    content_hash = TextField(null=True)
+    discord_message_id = IntegerField(null=True)
+    reminded = BooleanField(default=False)
+
+    class Meta:
+        table_name = 'calendar_events'
+
+    def __str__(self):
+        return f'Calendar event: {self.summary}, start {self.start}'
+
+    @staticmethod
+    def hash_event(summary, description, start):
+        content = json.dumps([summary, description, start.isoformat()])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def store_changes(events):
+        '''Stores changed API events in one transaction.
+
+        Returns the rows which are new or whose content changed, each with its API
+        event, and the ids of the deleted events.'''
+        # The calendar and its Google client are only imported when the calendar is used
+        from models.Tools.Calendar import CalendarCache
+
+        changed = []
+        deleted = []
+
+        with CalendarEvent._meta.database.atomic():
+            for event in events:
+                if event.get('status') == 'cancelled' or 'start' not in event:
+                    if CalendarEvent.delete().where(CalendarEvent.event_id == event['id']).execute() > 0:
+                        deleted.append(event['id'])
+                    continue
+
+                start = CalendarCache.get_start(event).replace(tzinfo=None)
+                summary = event.get('summary')
+                description = event.get('description')
+                content_hash = CalendarEvent.hash_event(
+                    summary, description, start)
+
+                row = CalendarEvent.get_or_none(
+                    CalendarEvent.event_id == event['id'])
+                if row == None:
+                    row = CalendarEvent(event_id=event['id'])
+                elif row.content_hash == content_hash:
+                    continue
+
+                # A moved event gets a new reminder
+                if row.start != start:
+                    row.reminded = False
+
+                row.summary = summary
+                row.description = description
+                row.start = start
+                row.content_hash = content_hash
+                row.save()
+                changed.append((row, event))
+
+        return changed, deleted
+
+    @staticmethod
+    def pending_reminders():
+        '''Returns all future events without a sent reminder.'''
+        return list(CalendarEvent.select().where(
+            (CalendarEvent.start > datetime.datetime.now()) & (CalendarEvent.reminded == False)))
+
+    @staticmethod
+    def is_empty():
+        return not CalendarEvent.select().exists()
+
+    @staticmethod
+    def mark_reminded(event_id):
+        CalendarEvent.update(reminded=True).where(
+            CalendarEvent.event_id == event_id).execute()
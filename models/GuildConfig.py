@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+
+from peewee import AutoField, IntegerField, TextField
+from models.BaseModel import BaseModel
+
+
+# Warning channel of the single server deployment, used if warning_channel_id isn't set
+DEFAULT_WARNING_CHANNEL_ID = 797970880089161758
+
+
+class GuildConfig(BaseModel.BaseModel):
+    '''Settings of a Discord server, the rows are cached in memory by load.'''
+    guild_config_id = AutoField(null=True)
+    guild_id = IntegerField(unique=True)
+    log_channel_id = IntegerField(null=True)
+    # Warnings about players, e.g. name changes
+    warning_channel_id = IntegerField(null=True)
+    calendar_channel_id = IntegerField(null=True)
+    # Channels mentioned by the welcome message
+    info_channel_id = IntegerField(null=True)
+    rules_channel_id = IntegerField(null=True)
+    apply_channel_id = IntegerField(null=True)
+    # JSON list of [combo role id, [required role ids]]
+    combo_roles = TextField(null=True)
+
+    class Meta:
+        table_name = 'guild_configs'
+
+    # Settings which can be changed with the config command
+    SETTINGS = ['log_channel_id', 'warning_channel_id', 'calendar_channel_id',
+                'info_channel_id', 'rules_channel_id', 'apply_channel_id']
+
+    # Configs by guild id, see load
+    cache = {}
+
+    def __str__(self):
+        return f'Guild config of {self.guild_id}'
+
+    def get_combo_roles(self):
+        if self.combo_roles == None:
+            return []
+        return json.loads(self.combo_roles)
+
+    @staticmethod
+    def default_guild_id():
+        '''Returns the guild of a single server deployment, the environment variable guild_id
+        or else the only guild with a config.'''
+        guild_id = os.getenv('guild_id')
+        if guild_id != None:
+            return int(guild_id)
+        if len(GuildConfig.cache) == 1:
+            return next(iter(GuildConfig.cache))
+        return None
+
+    @staticmethod
+    def from_env(guild_id):
+        '''Builds the config of a single server deployment from the old environment variables.'''
+        def env_int(name):
+            value = os.getenv(name)
+            return int(value) if value != None else None
+
+        combo_roles = []
+        for game in ['Div', 'BF', 'NW']:
+            combo_role_id = env_int(f'combi_role_id{game}')
+            if combo_role_id != None:
+                combo_roles.append(
+                    [combo_role_id, [env_int('role_id_TPA'), env_int(f'role_id_{game}')]])
+
+        return GuildConfig(guild_id=guild_id,
+                           log_channel_id=env_int('log_channel_id'),
+                           warning_channel_id=env_int(
+                               'warning_channel_id') or DEFAULT_WARNING_CHANNEL_ID,
+                           calendar_channel_id=env_int('calender_channel_id'),
+                           info_channel_id=env_int('channel_id_info'),
+                           rules_channel_id=env_int('channel_id_regeln'),
+                           apply_channel_id=env_int('channel_id_bewerben'),
+                           combo_roles=json.dumps(combo_roles))
+
+    @staticmethod
+    def seed(guild_id):
+        '''Creates the config of a guild from the environment if it has none, returns the config.'''
+        config = GuildConfig.get_or_none(GuildConfig.guild_id == guild_id)
+        if config == None:
+            logging.info(
+                f'Creating the config of guild {guild_id} from the environment')
+            config = GuildConfig.from_env(guild_id)
+            config.save()
+
+        GuildConfig.cache[guild_id] = config
+        return config
+
+    @staticmethod
+    def load():
+        '''Loads all configs into the cache. The guild of guild_id gets a config from the environment if it has none.'''
+        GuildConfig.cache = {
+            config.guild_id: config for config in GuildConfig.select()}
+
+        guild_id = os.getenv('guild_id')
+        if guild_id != None:
+            GuildConfig.seed(int(guild_id))
+        return GuildConfig.cache
+
+    @staticmethod
+    def reload():
+        '''Reads all configs again, they may be changed by the config command of another process.
+
+        The cache is replaced as a whole, returns the ids of the guilds whose config changed.'''
+        configs = {config.guild_id: config for config in GuildConfig.select()}
+
+        def values(config):
+            return config.__data__ if config != None else None
+
+        changed = [guild_id for guild_id in set(configs) | set(GuildConfig.cache)
+                   if values(configs.get(guild_id)) != values(GuildConfig.cache.get(guild_id))]
+        GuildConfig.cache = configs
+        return changed
+
+    @staticmethod
+    def for_guild(guild_id):
+        '''Returns the cached config of a guild, None if it has none.'''
+        return GuildConfig.cache.get(guild_id)
+
+    @staticmethod
+    def channel_id(guild_id, setting):
+        '''Returns a channel id of a guild, the default guild is used if guild_id is None.'''
+        if guild_id == None:
+            guild_id = GuildConfig.default_guild_id()
+
+        config = GuildConfig.cache.get(guild_id)
+        if config == None:
+            return None
+        return getattr(config, setting)
+
+    @staticmethod
+    def set_value(guild_id, setting, value):
+        '''Stores a setting of a guild and updates the cache, returns the config.'''
+        if setting not in GuildConfig.SETTINGS:
+            raise ValueError(f'Unknown setting {setting}')
+
+        GuildConfig.insert(guild_id=guild_id, **{setting: value}).on_conflict(
+            conflict_target=[GuildConfig.guild_id],
+            update={getattr(GuildConfig, setting): value}).execute()
+
+        config = GuildConfig.get(GuildConfig.guild_id == guild_id)
+        GuildConfig.cache[guild_id] = config
+        return config
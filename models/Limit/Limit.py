@@ -1,32 +1,118 @@
-import time
 import asyncio
+import email.utils
+import logging
+import time
 
 
-class Limit(object):
+class TokenBucket(object):
+    '''Token bucket for a single host. All coroutines talking to the host share one bucket.'''
+
     def __init__(self, calls=5, period=1):
-        self.calls = calls
-        self.period = period
+        self.capacity = calls
+        self.rate = calls / period
+        self.tokens = calls
         self.clock = time.monotonic
-        self.last_reset = 0
-        self.num_calls = 0
+        self.updated = self.clock()
+        self.blocked_until = 0
+        self.lock = None
+
+    def __refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        '''Returns the number of seconds until the next call may be sent.'''
+        self.__refill()
+        blocked = max(0, self.blocked_until - self.clock())
+
+        if self.tokens >= 1:
+            return blocked
+        return max(blocked, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        '''Waits until a token is available and takes it.'''
+        # The lock is created lazily, so it is bound to the running event loop
+        if self.lock == None:
+            self.lock = asyncio.Lock()
+
+        # Waiting callers are served one after another in arrival order
+        async with self.lock:
+            delay = self.wait_time()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.wait_time()
+
+            self.tokens -= 1
+
+    def update_from_headers(self, headers):
+        '''Adjusts the bucket with the rate limit headers of a response.'''
+        self.__refill()
+
+        # The server side limit per minute, if announced, replaces the configured rate
+        limit = headers.get('X-RateLimit-Limit-minute')
+        if limit != None and limit.isdigit() and int(limit) > 0:
+            self.capacity = int(limit)
+            self.rate = int(limit) / 60
+
+        # Never assume more remaining calls than the server reports
+        remaining = headers.get('X-RateLimit-Remaining-minute')
+        if remaining != None and remaining.isdigit():
+            self.tokens = min(self.tokens, int(remaining))
+
+        retry_after = headers.get('Retry-After')
+        if retry_after != None:
+            delay = Limit.parse_retry_after(retry_after)
+            if delay != None and delay > 0:
+                logging.warning(
+                    f'Server asked to retry after {delay:.1f} seconds, pausing requests')
+                self.blocked_until = max(
+                    self.blocked_until, self.clock() + delay)
+                self.tokens = min(self.tokens, 0)
+
+
+class Limit(object):
+    '''Registry of the shared token buckets, one per host.
 
-    def __call__(self, func):
-        async def wrapper(*args, **kwargs):
-            if self.num_calls >= self.calls:
-                await asyncio.sleep(self.__period_remaining())
+    The buckets are created once with the limit of their host, e.g.
+    Limit.get_bucket('cv.thepenguinarmy.de', calls=20, period=60), and Network.request
+    takes a token from the bucket of the host before every request.'''
 
-            period_remaining = self.__period_remaining()
+    buckets = {}
 
-            if period_remaining <= 0:
-                self.num_calls = 0
-                self.last_reset = self.clock()
+    @classmethod
+    def get_bucket(cls, host, calls=5, period=1):
+        '''Returns the bucket of a host and creates it if necessary.'''
+        if host not in cls.buckets:
+            cls.buckets[host] = TokenBucket(calls=calls, period=period)
+        return cls.buckets[host]
 
-            self.num_calls += 1
+    @classmethod
+    def wait_time(cls, host):
+        '''Returns the seconds a caller for host would have to wait right now.'''
+        if host not in cls.buckets:
+            return 0
+        return cls.buckets[host].wait_time()
 
-            return await func(*args, **kwargs)
+    @classmethod
+    def update_from_headers(cls, host, headers):
+        '''Feeds the response headers of a host into its bucket, if there is one.'''
+        if host in cls.buckets:
+            cls.buckets[host].update_from_headers(headers)
 
-        return wrapper
+    @staticmethod
+    def parse_retry_after(value):
+        '''Parses a Retry-After header (seconds or HTTP date) into seconds.'''
+        try:
+            return float(value)
+        except ValueError:
+            pass
 
-    def __period_remaining(self):
-        elapsed = self.clock() - self.last_reset
-        return self.period - elapsed
+        try:
+            retry_date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_date == None:
+            return None
+        return retry_date.timestamp() - time.time()
@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 from peewee import AutoField, IntegerField, TextField
 from models.BaseModel import BaseModel
 
@@ -7,9 +10,29 @@ class Message(BaseModel.BaseModel):
     discord_message_id = IntegerField(null=True)
     description = TextField(null=True)
     discord_channel_id = IntegerField(null=True)
+    # Hash of the embed currently shown, unchanged embeds are not sent again
+    content_hash = TextField(null=True)
+    # Guild whose players the leaderboard shows, None shows all players
+    guild_id = IntegerField(null=True, index=True)
 
     class Meta:
         table_name = 'discord_messages'
 
     def __str__(self):
         return f'Discord Message ID: {self.discord_message_id}, Description {self.description}'
+
+
+    @staticmethod
+    def hash_embed(embed):
+        '''Returns a stable hash of the content of an embed.'''
+        content = json.dumps(embed.to_dict(), sort_keys=True)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def save_hashes(messages):
+        '''Writes the content hash of the given messages in one transaction.'''
+        if len(messages) == 0:
+            return
+
+        with Message._meta.database.atomic():
+            Message.bulk_update(messages, fields=[Message.content_hash])
@@ -1,16 +1,34 @@
+import asyncio
 import datetime
 import json
 import logging
 import os
+import time
 from json.decoder import JSONDecodeError
 
 import aiohttp
 import discord
-from peewee import SQL, AutoField, IntegerField, PeeweeException, TextField
+from peewee import (EXCLUDED, AutoField, IntegerField, IntegrityError,
+                    TextField, chunked)
 
 from models.BaseModel import BaseModel
+from models.GuildConfig import GuildConfig
 from models.Limit.Limit import Limit
-from models.Tools.Network import fetch
+from models.SyncState import SyncState
+from models.Tools.CircuitBreaker import CircuitOpenError
+from models.Tools.Database import run_read, run_write, select
+from models.Tools.LogSink import LogChannelSink
+from models.Tools.Network import NetworkError, cv_url, fetch, post, tracker_url
+from models.UploadOutbox import UploadOutbox
+from models.XpHistory import XpHistory
+
+# Hosts with their own shared rate limit
+TRACKER_HOST = 'public-api.tracker.gg'
+CV_HOST = 'cv.thepenguinarmy.de'
+
+# Every request to these hosts takes a token from their bucket, including retries
+Limit.get_bucket(TRACKER_HOST, calls=20, period=60)
+Limit.get_bucket(CV_HOST, calls=20, period=60)
 
 
 class Player(BaseModel.BaseModel):
@@ -19,7 +37,19 @@ class Player(BaseModel.BaseModel):
     player_xp = IntegerField(null=True)
     player_ubi_id = TextField(null=True, unique=True)
     player_weekly_xp = IntegerField(null=True)
-    player_discord_id = IntegerField(null=True)
+    player_discord_id = IntegerField(null=True, index=True)
+    # player_weekly_xp - player_xp, stored for the indexed leaderboard sort
+    player_weekly_delta = IntegerField(null=True, index=True)
+    # Discord server of the player's clan
+    guild_id = IntegerField(null=True, index=True)
+
+    # Version of the player data and the rankings loaded for it by guild id, see get_ranking
+    data_version = 0
+    ranking_cache = {}
+
+    # Cached AllMember list of the CV, see get_member_snapshot
+    member_snapshot = None
+    member_snapshot_time = 0
 
     class Meta:
         table_name = 'players'
@@ -28,22 +58,23 @@ class Player(BaseModel.BaseModel):
         return f'Player: {self.player_name}, ID {self.player_id}'
 
     @staticmethod
-    @Limit(calls=20, period=60)
     async def call_api(session, url, headers):
-        try:
-            html = await fetch(session=session, url=url, headers=headers)
-            return html
-        except LookupError as player_error:
-            raise player_error
+        # Rate limiting, retries and the circuit breaker are handled by fetch
+        return await fetch(session=session, url=url, headers=headers)
+
+    async def update_player_xp(self, session):
+        '''Retrieves the current amount of xp of a player.
 
-    async def update_player_xp(self, session, update_weekly_xp=False):
-        '''Retrieves the current amount of xp of a player'''
+        The values are only set on the instance, the caller writes them with save_xp.
+        An answer which isn't JSON raises the JSONDecodeError, the xp stays unchanged.'''
 
         # Pass the API key to the header
         headers = {'TRN-Api-Key': os.getenv('TRN_API')}
 
-        url = f'https://public-api.tracker.gg/v2/division-2/standard/profile/uplay/{self.player_name}'
+        url = tracker_url(
+            f'/v2/division-2/standard/profile/uplay/{self.player_name}')
 
+        value_clan_xp = None
         try:
             # Parse the output, required attribute: xPClan
             raw_json = await Player.call_api(session, url, headers)
@@ -51,6 +82,7 @@ class Player(BaseModel.BaseModel):
         except JSONDecodeError as json_decode_error:
             logging.error(
                 f'Error while decoding content for player {self.player_name}. Error: {json_decode_error}')
+            raise
 
         except LookupError as player_error:
             raise player_error
@@ -83,163 +115,213 @@ class Player(BaseModel.BaseModel):
                 Weekly XP: Clan XP earned so far this
                 Player XP: Total XP earned by a player
                 '''
-                # Calculate the XP difference and update the value inside the DB
+                # Calculate the XP difference and update the value inside the DB.
+                # The new week starts in rollover_weekly_xp.
                 self.player_weekly_xp = value_clan_xp
 
-                # Overwrite the weekly XP if update_weekly_xp = True -> this only occurs on Thursdays
-                if update_weekly_xp == True:
-                    logging.debug(
-                        f'Updating weekly xp for player {self.player_name}')
-
-                    # Only Update the player's total xp if the value is > 0
-                    if value_clan_xp > 0:
-                        logging.debug(
-                            f'Value for clan xp for player {self.player_name} is bigger than 0, actual value: {value_clan_xp} ')
-                        self.player_xp = value_clan_xp
-
-                # Write the XP to database
-                self.save()
-
-    @Limit(calls=20, period=60)
-    async def upload_player_weekly_xp(self, session, xp_value):
-        '''
-        Upload player's weekly XP data to TPA community site.
-        '''
-        # Requireded Configuration
-        upload_url = "http://cv.thepenguinarmy.de/BotRequest/Activity"
+    @classmethod
+    async def upload_player_data(cls, session, players=None):
+        '''Queues the weekly xp of all players, or of the given players, in the upload outbox and sends it to the CV.
+
+        Uploads which fail stay in the outbox and are retried by the next drain.'''
+        if players == None:
+            players = await select(Player.select())
+
+        uploads = []
+        for player in players:
+            # New members whose xp couldn't be fetched yet have no xp to upload
+            if player.player_weekly_xp == None or player.player_xp == None:
+                logging.debug(
+                    f'Player {player.player_name} has no xp yet, so skipping')
+                continue
+
+            # Calculate the player's xp. If it is negative it may not be uploaded.
+            xp_value = player.player_weekly_xp - player.player_xp
+            logging.debug(
+                f'Calculated XP value for player {player.player_name}: {xp_value}')
+
+            if(xp_value > 0):
+                uploads.append((player, xp_value))
+            else:
+                logging.debug(
+                    f'XP value for player {player.player_name} is negative, so skipping')
+
+        queued = await run_write(UploadOutbox.enqueue, uploads)
+        logging.info(
+            f'Queued {queued} weekly XP uploads, {len(uploads) - queued} were already queued this week')
+
+        return await UploadOutbox.drain(session)
+
+    @staticmethod
+    async def fetch_all_members(session, last_modified=None):
+        '''Returns the parsed AllMember list of the CV, optionally only members modified since last_modified.'''
+        url = cv_url('/BotRequest/AllMember')
+
         # Basic Auth from env file
         auth = aiohttp.BasicAuth(login=os.getenv('member_username'),
                                  password=os.getenv('member_pw'))
-        t = datetime.datetime.now()
+
+        # Game IDs:
+        # gameId = 1: Division 2
+        # gameID = 2: TemTem
+
+        # Limit time:
+        # lastModified = 0000-00-00 00:00:00 (YYYY-MM-DD)
 
         # Create the JSON dict
+        game_id = {'gameId': 1}
+        if last_modified != None:
+            game_id['lastModified'] = last_modified
 
-        # Required Parameters:
-        # Value: Weekly XP Value
-        # GameID: 1
-        # accountTypName: Ubisoft
-        # officialAccountId: Account ID
-        # Accountname: Name of the account, but not necessary
-
-        if(xp_value > 0):
-            json_upload_content = {
-                'gameId': 1,
-                'officialAccountId': self.player_ubi_id,
-                'accountTypName': 'Ubisoft',
-                'value': xp_value,
-                'dateTime':  t.strftime("%Y-%m-%d %H:%M:%S")
-            }
+        # Send a POST request with HTTP basic auth to the url and ask for members
+        data = await post(session, url, json=game_id, auth=auth)
+        return json.loads(data)
 
-            logging.debug(
-                f'Trying to upload weekly XP stats for user {self.player_name} with ubi id {self.player_ubi_id}. JSON Content: {json_upload_content}')
+    @staticmethod
+    async def get_members(session, full=None):
+        '''Synchronizes the players with the member list of the CV.
 
-            # Try to submit data
-            try:
-                async with session.post(upload_url, json=json_upload_content, auth=auth) as resp:
-                    # Await the reponse
-                    return_msg = await resp.text()
+        Normally only members modified since the last sync are requested. A full sync runs if full
+        is True, if there is no watermark yet or if the last full sync is older than
+        member_full_sync_hours (default 24). Its list is kept as snapshot for check_memberships,
+        which removes the players that are no longer members.'''
+        time_format = '%Y-%m-%d %H:%M:%S'
 
-                    # If the HTTP Status code is different from 200 log it
-                    if resp.status != 200:
-                        logging.error(return_msg)
+        watermark = await run_read(SyncState.get_value, 'members_last_modified')
+        last_full_sync = await run_read(SyncState.get_value, 'members_last_full_sync')
 
-            except aiohttp.client_exceptions.ServerDisconnectedError as server_disconnect:
-                logging.error(
-                    f'Server disconnected session for player {self.player_name} with error: {server_disconnect}')
+        if full == None:
+            full_sync_interval = datetime.timedelta(
+                hours=int(os.getenv('member_full_sync_hours', 24)))
+            full = watermark == None or last_full_sync == None or \
+                datetime.datetime.strptime(last_full_sync, time_format) + full_sync_interval < datetime.datetime.now()
 
-    @classmethod
-    async def upload_player_data(cls):
-        async with aiohttp.ClientSession() as session:
-            for player in Player.select():
-                logging.debug(
-                    f'Checking CV XP upload for player {player.player_name}...')
+        # The next watermark overlaps a bit with this sync, so changes made while it runs are not lost
+        sync_started = datetime.datetime.now()
+        next_watermark = (sync_started - datetime.timedelta(minutes=5)).strftime(time_format)
 
-                # Calculate the player's xp. If it is negative it may not be uploaded so there is no need to call the method.
-                xp_value = player.player_weekly_xp - player.player_xp
-                logging.debug(
-                    f'Calculated XP value for player {player.player_name}: {xp_value}')
-
-                if(xp_value > 0):
-                    logging.debug(
-                        f'Uploading weekly XP data for player {player.player_name}')
-                    await player.upload_player_weekly_xp(session, xp_value)
-                    logging.debug(
-                        f'Upload of xp data for player {player.player_name} finished.')
-                else:
-                    logging.debug(
-                        f'XP value for player {player.player_name} is negative, so skipping')
+        logging.debug(
+            f"Starting {'full' if full else 'incremental'} member sync, last modified: {watermark}")
+
+        try:
+            members = await Player.fetch_all_members(session, last_modified=None if full else watermark)
+        except (NetworkError, CircuitOpenError, JSONDecodeError) as member_error:
+            logging.error(
+                f'Retrieving the member list failed with error: {member_error}')
+            return
+
+        # A full list can be reused by the membership check
+        if full:
+            Player.store_member_snapshot(members)
+
+        counts = await run_write(Player.sync_members, members)
+
+        # Only move the watermark forward if the sync worked
+        await run_write(SyncState.set_value, 'members_last_modified', next_watermark)
+        if full:
+            await run_write(SyncState.set_value, 'members_last_full_sync',
+                            sync_started.strftime(time_format))
+        return counts
 
     @staticmethod
-    async def get_members():
-        url = 'http://cv.thepenguinarmy.de/BotRequest/AllMember'
+    def sync_members(members):
+        '''Upserts the AllMember payload of the CV in one transaction.
+
+        Name, Discord ID and ubi ID corrections are computed in a single pass, only new and
+        changed rows are written. Players missing from the payload are kept, check_memberships
+        decides about them. Returns the number of inserted, updated and unchanged rows.'''
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        # One query for all known players instead of one per member
+        existing = {player.player_ubi_id: player for player in Player.select(
+            Player.player_id, Player.player_name, Player.player_ubi_id, Player.player_discord_id)}
+
+        # Rows to upsert, keyed by ubi id so duplicates in the payload are written once
+        rows = {}
+        for user in members:
+            nickname = user['Ubisoft']['nickname']
+            ubi_id = user['Ubisoft']['officialAccountId']
+            discord_id = user['Discord']['officialAccountId']
+
+            if ubi_id == None:
+                logging.warning(f'Skipping member {nickname} without ubi id')
+                continue
+
+            # The CV knows a single clan, so all members belong to the default guild.
+            # Other guilds can have configs and leaderboards, but no players of their own.
+            player = existing.get(ubi_id)
+            if player == None:
+                rows[ubi_id] = ('inserted', {'player_name': nickname, 'player_ubi_id': ubi_id,
+                                             'player_xp': 0, 'player_discord_id': discord_id,
+                                             'guild_id': GuildConfig.default_guild_id()})
+                continue
+
+            player_discord_id = player.player_discord_id
+
+            # Check if the Discord id is empty
+            if player_discord_id == None:
+                player_discord_id = discord_id
+
+            # Check if the Discord id is of type int. If it's not, somebody entered garbage and it has to be changed in the CV.
+            elif isinstance(player_discord_id, int) == False:
+                # Log the player name and the ID
+                logging.warning(
+                    f'Discord ID of player {player.player_name}, ID {player.player_id} is not int: {player_discord_id}.')
+                logging.warning(
+                    f'Overwriting discord id of player {player.player_name}, ID {player.player_id}')
+                logging.debug(
+                    f'Overwriting the discord id of player {player.player_name} (ID:{player.player_id}) from {player_discord_id} to {discord_id}')
+
+                # Change the discord id
+                player_discord_id = discord_id
+
+            if player.player_name == nickname and player.player_discord_id == player_discord_id:
+                rows.pop(ubi_id, None)
+                counts['unchanged'] += 1
+                continue
+
+            # The guild only applies if the row is inserted, the upsert keeps the guild of existing players
+            rows[ubi_id] = ('updated', {'player_name': nickname, 'player_ubi_id': ubi_id,
+                                        'player_xp': 0, 'player_discord_id': player_discord_id,
+                                        'guild_id': GuildConfig.default_guild_id()})
+
+        def upsert(batch):
+            # The xp of existing players is never touched by the member sync
+            Player.insert_many(batch).on_conflict(
+                conflict_target=[Player.player_ubi_id],
+                update={Player.player_name: EXCLUDED.player_name,
+                        Player.player_discord_id: EXCLUDED.player_discord_id}).execute()
+
+        database = Player._meta.database
+        with database.atomic():
+            for batch in chunked(list(rows.values()), 100):
+                try:
+                    with database.atomic():
+                        upsert([row for _, row in batch])
+                except IntegrityError:
+                    # A conflicting player name fails the whole chunk, retry it row by row
+                    for result, row in batch:
+                        try:
+                            with database.atomic():
+                                upsert([row])
+                        except IntegrityError as peewee_err:
+                            logging.error(
+                                f"Error occured with player {row['player_name']}, error message: {peewee_err}")
+                            rows.pop(row['player_ubi_id'])
 
-        # Basic Auth from env file
-        auth = aiohttp.BasicAuth(login=os.getenv('member_username'),
-                                 password=os.getenv('member_pw'))
+        for result, _ in rows.values():
+            counts[result] += 1
+
+        if counts['inserted'] + counts['updated'] > 0:
+            Player.mark_changed()
+
+        logging.info(
+            f"Member sync finished: {counts['inserted']} inserted, {counts['updated']} updated, "
+            f"{counts['unchanged']} unchanged")
+        return counts
 
-        # Post request with HTTP basic auth
-        async with aiohttp.ClientSession(auth=auth) as session:
-            # Game IDs:
-            # gameId = 1: Division 2
-            # gameID = 2: TemTem
-
-            # Limit time:
-            # lastModified = 0000-00-00 00:00:00 (YYYY-MM-DD)
-
-            # Create the JSON dict
-            game_id = {'gameId': 1}
-
-            # Send a POST request to the url and ask for members
-            async with session.post(url, json=game_id) as resp:
-                data = await resp.text()
-
-                for user in json.loads(data):
-                    nickname = user['Ubisoft']['nickname']
-                    ubi_id = user['Ubisoft']['officialAccountId']
-                    discord_id = user['Discord']['officialAccountId']
-
-                    # Try to find the user inside the database
-                    try:
-                        player, created = Player.get_or_create(
-                            player_ubi_id=ubi_id,
-                            defaults={'player_name': nickname, 'player_xp': 0, 'player_discord_id': discord_id})
-                    # except peewee.IntegrityError as peewee_integrity_error:
-                    except PeeweeException as peewee_err:
-                        logging.error(
-                            f'Error occured with player {nickname}, error message: {peewee_err}')
-
-                    if created == False:
-                        # Save the Ubisoft ID and if the name has changed also the name.
-                        if player.player_name != nickname:
-                            player.player_name = nickname
-
-                        # Check if the ubi id is different
-                        if player.player_ubi_id == None:
-                            player.player_ubi_id = ubi_id
-
-                        # Check if the Discord id is empty
-                        if player.player_discord_id == None:
-                            player.player_discord_id = discord_id
-
-                        # Check if the Discord id is of type int. If it's not, somebody entered garbage and it has to be changed in the CV.
-                        elif isinstance(player.player_discord_id, int) == False:
-                            # Log the player name and the ID
-                            logging.warning(
-                                f'Discord ID of player {player.player_name}, ID {player.player_id} is not int: {player.player_discord_id}.')
-                            logging.warning(
-                                f'Overwriting discord id of player {player.player_name}, ID {player.player_id}')
-                            logging.debug(
-                                f'Overwriting the discord id of player {player.player_name} (ID:{player.player_id}) from {player.player_discord_id} to {discord}')
-
-                            # Change the discord id
-                            player.player_discord_id = discord_id
-
-                    # Finally save the player to the database
-                    player.save()
-
-    @Limit(calls=20, period=60)
     async def check_player_exit(self, session):
-        url = 'http://cv.thepenguinarmy.de/BotRequest/Member'
+        url = cv_url('/BotRequest/Member')
 
         # Basic Auth from env file
         auth = aiohttp.BasicAuth(login=os.getenv('member_username'),
@@ -255,75 +337,311 @@ class Player(BaseModel.BaseModel):
 
         # Send a POST request to the url and ask for members
         try:
-            async with session.post(url, json=game_id, auth=auth) as resp:
-                data = await resp.text()
+            data = await post(session, url, json=game_id, auth=auth)
+        except CircuitOpenError:
+            raise
+        except NetworkError as member_error:
+            # Keep the player if the CV can't be asked
+            logging.error(
+                f'Member check for player {self.player_name} failed with error: {member_error}')
+            return is_member
 
-                # Parse the raw json into an object
+        # Parse the raw json into an object
+        try:
+            content = json.loads(data)
+        except JSONDecodeError as json_err:
+            logging.debug(
+                f'{json_err} occured while checking player {self.player_name}')
+        else:
+            logging.debug(
+                f'Parsed json data for player {self.player_name}: {content}')
+            try:
+                if '1' in content[0]['Ubisoft']['games']:
+                    # Check if there is a isMember flag inside and loop through the characters
+                    char = list(content[0]['Ubisoft']['games']
+                                ['1']['characters'].keys())
+                    if 'isMember' in content[0]['Ubisoft']['games']['1']['characters'][char[0]]:
+                        is_member = content[0]['Ubisoft']['games']['1']['characters'][char[0]]['isMember']
+                    else:
+                        # Log an error if there is no isMember value inside
+                        logging.error(
+                            f"No isMember value for player {self.player_name}")
+            except (IndexError, KeyError, TypeError) as parse_error:
+                # An empty or unexpected answer says nothing about the membership, keep the player
+                logging.error(
+                    f'Unexpected member data for player {self.player_name}, keeping the player: {parse_error!r}')
+
+            # Continue with the parsed value
+            logging.debug(
+                f'Parsed value for player {self.player_name}: {is_member}')
+        return is_member
+
+    @staticmethod
+    def store_member_snapshot(members):
+        '''Caches a complete AllMember list, keyed by ubi id.'''
+        Player.member_snapshot = {
+            user['Ubisoft']['officialAccountId']: user for user in members}
+        Player.member_snapshot_time = time.monotonic()
+
+    @staticmethod
+    async def get_member_snapshot(session):
+        '''Returns the cached AllMember snapshot, it is fetched again after member_snapshot_ttl seconds (default 300).'''
+        ttl = int(os.getenv('member_snapshot_ttl', 300))
+        if Player.member_snapshot == None or time.monotonic() - Player.member_snapshot_time > ttl:
+            Player.store_member_snapshot(await Player.fetch_all_members(session))
+        return Player.member_snapshot
+
+    @staticmethod
+    def member_status(user):
+        '''Returns the isMember flag of an AllMember entry, None if the entry has no flag.'''
+        games = user['Ubisoft'].get('games') or {}
+        if '1' not in games:
+            return None
+
+        flags = [character['isMember'] for character in (games['1'].get('characters') or {}).values()
+                 if 'isMember' in character]
+        if len(flags) == 0:
+            return None
+        return any(flags)
+
+    @classmethod
+    async def check_memberships(cls, session):
+        '''Resolves the membership of all players from one AllMember snapshot.
+
+        Players listed in the snapshot are decided by it, only players missing from it are
+        checked one by one with check_player_exit. Former members are removed with a single
+        delete. Returns the remaining players and the number of deleted players.'''
+        players = await select(Player.select())
+
+        try:
+            snapshot = await Player.get_member_snapshot(session)
+        except (NetworkError, CircuitOpenError, JSONDecodeError) as member_error:
+            # Without a snapshot nobody is removed in this run
+            logging.error(
+                f'Retrieving the member list failed, keeping all players: {member_error}')
+            return players, 0
+
+        members = []
+        leavers = []
+        for player in players:
+            if player.player_ubi_id == None:
+                members.append(player)
+                continue
+
+            is_member = None
+            if player.player_ubi_id in snapshot:
+                # Listed members without a flag are members
+                is_member = Player.member_status(snapshot[player.player_ubi_id])
+                if is_member == None:
+                    is_member = True
+            else:
+                # Not listed at all, ask the CV for this single player to be sure
                 try:
-                    content = json.loads(data)
-                except JSONDecodeError as json_err:
-                    logging.debug(
-                        f'{json_err} occured while checking player {self.player_name}')
-                else:
-                    logging.debug(
-                        f'Parsed json data for player {self.player_name}: {content}')
-                    if '1' in content[0]['Ubisoft']['games']:
-                        # Check if there is a isMember flag inside and loop through the characters
-                        char = list(content[0]['Ubisoft']['games']
-                                    ['1']['characters'].keys())
-                        if 'isMember' in content[0]['Ubisoft']['games']['1']['characters'][char[0]]:
-                            is_member = content[0]['Ubisoft']['games']['1']['characters'][char[0]]['isMember']
-                        else:
-                            # Log an error if there is no isMember value inside
-                            logging.error(
-                                f"No isMember value for player {self.player_name}")
+                    is_member = await player.check_player_exit(session=session)
+                except CircuitOpenError as err:
+                    logging.error(
+                        f'Keeping player {player.player_name}, membership unknown: {err}')
+                    is_member = True
+
+            if is_member == True:
+                members.append(player)
+            else:
+                logging.debug(
+                    f'Deleting player {player.player_name} from database')
+                leavers.append(player.player_id)
+
+        # Delete the former members from database
+        deleted = await run_write(Player.delete_players, leavers)
+
+        return members, deleted
+
+    @staticmethod
+    def delete_players(player_ids):
+        '''Deletes the players with the given ids and their xp history in one transaction.
+
+        SQLite may give the id of a deleted player to a new one, so no history may be left behind.'''
+        deleted = 0
+        with Player._meta.database.atomic():
+            for batch in chunked(player_ids, 100):
+                XpHistory.delete().where(XpHistory.player_id.in_(batch)).execute()
+                deleted += Player.delete().where(Player.player_id.in_(batch)).execute()
+        if deleted > 0:
+            Player.mark_changed()
+        return deleted
+
+    async def refresh_player(self, bot, session):
+        '''Runs the xp update for a single player.
 
-                    # Continue with the parsed value
-                    logging.debug(
-                        f'Parsed value for player {self.player_name}: {is_member}')
-        except aiohttp.client_exceptions.ServerDisconnectedError as server_disconnect:
+        Returns either 'refreshed' or 'failed'.'''
+        logging.debug(f'Updating player data for {self}')
+
+        try:
+            await self.update_player_xp(session)
+            logging.debug(
+                f'Finished updating player data for player {self}')
+        except LookupError as err:
+            # Log this error
             logging.error(
-                f'Server disconnected session for player {self.player_name} with error: {server_disconnect}')
-            is_member = True
-        finally:
-            return is_member
+                f'Player {self.player_name} probably changed the name: {err}')
+
+            # Only send a warning if this is true
+            enable_name_warning = os.getenv('enable_name_warning')
+            channel_id = GuildConfig.channel_id(
+                self.guild_id, 'warning_channel_id')
+            if enable_name_warning == 'true' and channel_id != None:
+                # Send a message into the warning channel of the player's guild, warnings of one run are sent together
+                LogChannelSink.for_channel(bot, channel_id).add(
+                    f'Warnung: Spieler <@{self.player_discord_id}> ({self.player_name}) hat den Namen geändert!')
+            return 'failed'
+        except (NetworkError, JSONDecodeError) as err:
+            logging.error(
+                f'Updating player data for {self.player_name} failed: {err}')
+            return 'failed'
+        return 'refreshed'
+
+    def update_weekly_delta(self):
+        '''Recalculates the stored weekly xp delta.'''
+        if self.player_weekly_xp == None or self.player_xp == None:
+            self.player_weekly_delta = None
+        else:
+            self.player_weekly_delta = self.player_weekly_xp - self.player_xp
+
+    @staticmethod
+    def save_xp(players, batch_size=100):
+        '''Writes the xp of the given players in one transaction, batch_size rows per UPDATE.'''
+        if len(players) == 0:
+            return 0
+
+        for player in players:
+            player.update_weekly_delta()
+
+        with Player._meta.database.atomic():
+            Player.bulk_update(players, fields=[Player.player_xp, Player.player_weekly_xp, Player.player_weekly_delta],
+                               batch_size=batch_size)
+        Player.mark_changed()
+        return len(players)
 
     @classmethod
-    async def update_player_data(cls, bot, update_weekly_xp=False):
-        async with aiohttp.ClientSession() as session:
-            for player in Player.select():
-
-                # Check if the selected player is still member
-                is_member = await player.check_player_exit(session=session)
-
-                if is_member == True:
-                    logging.debug(f'Updating player data for {player}')
-
-                    try:
-                        await player.update_player_xp(session, update_weekly_xp=update_weekly_xp)
-                        logging.debug(
-                            f'Finished updating player data for player {player}')
-                    except LookupError as err:
-                        # Log this error
-                        logging.error(
-                            f'Player {player.player_name} probably changed the name: {err}')
+    async def update_player_data(cls, bot, session, concurrency=None):
+        '''Checks the membership of all players and refreshes the xp of the remaining ones.'''
+        players, deleted = await Player.check_memberships(session)
+        totals = await Player.refresh_players(bot, session, players, concurrency=concurrency)
+        totals['deleted'] = deleted
+        return totals
 
-                        # Only send a warning if this is true
-                        enable_name_warning = os.getenv('enable_name_warning')
-                        if enable_name_warning == 'true':
-                            # Send a message into the chat
-                            channel = bot.get_channel(797970880089161758)
-                            await channel.send(f'Warnung: Spieler <@{player.player_discord_id}> ({player.player_name}) hat den Namen geändert!')
+    @classmethod
+    async def refresh_players(cls, bot, session, players, concurrency=None):
+        '''Refreshes the xp of players with a bounded number of concurrent workers sharing one session.
+
+        The concurrency defaults to the environment variable player_update_concurrency.
+        The rate limits of tracker.gg and the CV are still enforced by their shared buckets.
+        If the circuit of a host opens, the remaining players are skipped.'''
+        if concurrency == None:
+            concurrency = int(os.getenv('player_update_concurrency', 5))
+        concurrency = max(1, concurrency)
+
+        started = time.monotonic()
+        totals = {'refreshed': 0, 'failed': 0, 'skipped': 0, 'written': 0}
+
+        # Players whose xp changed, they are written together after the refresh
+        changed = []
+        # Every refreshed player gets a history sample
+        refreshed = []
+
+        circuit_open = asyncio.Event()
+        queue = asyncio.Queue()
+        for player in players:
+            queue.put_nowait(player)
+
+        async def worker(session):
+            while True:
+                try:
+                    player = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
 
-                else:
-                    logging.debug(
-                        f'Deleting player {player.player_name} from database')
+                if player.player_name == None or circuit_open.is_set():
+                    logging.debug(f'Skipping player {player}')
+                    totals['skipped'] += 1
+                    continue
 
-                    # Delete the player from database
-                    player.delete_instance()
+                xp_before = (player.player_xp, player.player_weekly_xp)
+                try:
+                    result = await player.refresh_player(bot, session)
+                except CircuitOpenError as err:
+                    # The host is degraded, don't queue more doomed requests
+                    if not circuit_open.is_set():
+                        logging.error(f'Aborting player refresh: {err}')
+                        circuit_open.set()
+                    result = 'skipped'
+                except Exception as err:
+                    logging.exception(
+                        f'Unexpected error while refreshing player {player.player_name}: {err}')
+                    result = 'failed'
+                totals[result] += 1
+
+                if result == 'refreshed':
+                    refreshed.append(player)
+                if result == 'refreshed' and (player.player_xp, player.player_weekly_xp) != xp_before:
+                    changed.append(player)
+
+        await asyncio.gather(*[worker(session) for _ in range(min(concurrency, max(1, len(players))))])
+
+        # Write all changed rows at once instead of one transaction per player
+        totals['written'] = await run_write(Player.save_xp, changed)
+        await run_write(XpHistory.record, refreshed)
+
+        duration = time.monotonic() - started
+        logging.info(
+            f"Player refresh finished in {duration:.1f}s: {totals['refreshed']} refreshed, {totals['failed']} failed, "
+            f"{totals['skipped']} skipped, {totals['written']} written (concurrency {concurrency})")
+
+        totals['duration'] = duration
+        return totals
+
+    @staticmethod
+    def rollover_weekly_xp():
+        '''Starts a new week: the current clan xp becomes the base of the weekly xp.
+
+        Players without clan xp keep their base. Returns the number of updated players.'''
+        with Player._meta.database.atomic():
+            updated = Player.update(player_xp=Player.player_weekly_xp, player_weekly_delta=0).where(
+                Player.player_weekly_xp > 0).execute()
+        Player.mark_changed()
+        return updated
+
+    @staticmethod
+    def mark_changed():
+        '''Invalidates the cached ranking, has to be called after xp or player rows changed.'''
+        Player.data_version += 1
+
+    @staticmethod
+    def load_ranking(guild_id=None):
+        '''Returns name, Discord ID and weekly xp of all players with a Discord ID, ordered by weekly xp.
+
+        With a guild_id only the players of the guild and the players without guild are returned.
+        All CV members belong to the default guild, see sync_members.'''
+        condition = Player.player_discord_id != None
+        if guild_id != None:
+            condition &= (Player.guild_id == guild_id) | Player.guild_id.is_null()
+
+        query = Player.select(Player.player_name, Player.player_discord_id, Player.player_weekly_delta
+                              ).where(condition).order_by(Player.player_weekly_delta.desc()).tuples()
+        return list(query)
+
+    @staticmethod
+    async def get_ranking(guild_id=None):
+        '''Returns the cached ranking of a guild and the time it was loaded, it is reloaded if the data version changed.'''
+        version = Player.data_version
+        cached = Player.ranking_cache.get(guild_id)
+        if cached == None or cached[0] != version:
+            ranking = await run_read(Player.load_ranking, guild_id)
+            cached = (version, ranking, datetime.datetime.now())
+            Player.ranking_cache[guild_id] = cached
+        return cached[1], cached[2]
 
     @classmethod
-    async def get_player_weekly_xp_as_message(cls, player_limit=10):
+    async def get_player_weekly_xp_as_message(cls, player_limit=10, guild_id=None):
         # Get current date and calculate the next thursday https://stackoverflow.com/a/8801197
         today = datetime.date.today()
         d = datetime.date.today()
@@ -348,32 +666,28 @@ class Player(BaseModel.BaseModel):
         embed.set_thumbnail(
             url="https://cdn.discordapp.com/icons/346339932647981057/98ee3738aa3e46b268677972637c4c7b.webp")
 
-        # How many embed fields are necessary?
+        # The ranking is computed once per data version and shared by all views
+        ranking, ranking_time = await Player.get_ranking(guild_id)
+
         if player_limit == -1:
-            number_of_required_fields = round(
-                Player.select().count(database=None) / 10)
+            players = ranking
             player_limit = 'Total'
         else:
-            number_of_required_fields = round(
-                player_limit / 10)
+            players = ranking[:player_limit]
 
-        for field_counter in range(1, number_of_required_fields + 1):
+        # Every field lists 10 players
+        for field_start in range(0, len(players), 10):
 
             field = ''
-            # Get the xp of all the players, limit by the parameter player_limit
-            for player in Player.select(Player.player_name, Player.player_discord_id, Player.player_id, (Player.player_weekly_xp - Player.player_xp).alias('sql_weekly_xp')
-                                        ).where(Player.player_discord_id != None).order_by(SQL('sql_weekly_xp').desc()).paginate(field_counter, paginate_by=10):
+            for player_name, player_discord_id, xp_to_display in players[field_start:field_start + 10]:
 
                 # Added the player's xp to the message
                 # Mention the player: https://stackoverflow.com/a/43991145
                 # Formatting the XP: https://stackoverflow.com/a/48414649
 
-                # XP calculation is done by subtracting the columns player_weekly_xp and player_xp
-                xp_to_display = player.sql_weekly_xp
-
                 # Check the player name for underscores and escape them if necessary
-                if r'_' in player.player_name:
-                    player.player_name = player.player_name.replace('_', r'\_')
+                if r'_' in player_name:
+                    player_name = player_name.replace('_', r'\_')
 
                 # Check if the player's weekly XP is negative, as this can happen if the source server from tracker network
                 # sends weird data.
@@ -383,16 +697,15 @@ class Player(BaseModel.BaseModel):
                     xp_to_display = 0
 
                 # Formatting the embed: https://cog-creators.github.io/discord-embed-sandbox/
-                field += f"**{counter}.** <@{player.player_discord_id}> ({player.player_name})\n{'{:,}'.format(xp_to_display).replace(',', '.')}\n"
+                field += f"**{counter}.** <@{player_discord_id}> ({player_name})\n{'{:,}'.format(xp_to_display).replace(',', '.')}\n"
 
                 counter += 1
-            if field_counter == 1:
+            if field_start == 0:
                 embed.add_field(name=f'Top {player_limit}',
                                 value="\n\u200b" + field, inline=False)
             else:
-                # Only add the fields if its not empty
-                if field != '':
-                    embed.add_field(name=f'\u200b\n',
-                                    value=field, inline=False)
-        embed.set_footer(text=f"Last Update: {t.strftime('%d.%m.%y %H:%M')}")
+                embed.add_field(name=f'\u200b\n',
+                                value=field, inline=False)
+        embed.set_footer(
+            text=f"Last Update: {ranking_time.strftime('%d.%m.%y %H:%M')}")
         return embed
@@ -0,0 +1,28 @@
+from peewee import AutoField, TextField
+from models.BaseModel import BaseModel
+
+
+class SyncState(BaseModel.BaseModel):
+    '''Key value store for watermarks of incremental syncs.'''
+    state_id = AutoField(null=True)
+    key = TextField(unique=True)
+    value = TextField(null=True)
+
+    class Meta:
+        table_name = 'sync_state'
+
+    def __str__(self):
+        return f'Sync state {self.key}: {self.value}'
+
+    @staticmethod
+    def get_value(key, default=None):
+        state = SyncState.get_or_none(SyncState.key == key)
+        if state == None:
+            return default
+        return state.value
+
+    @staticmethod
+    def set_value(key, value):
+        SyncState.insert(key=key, value=value).on_conflict(
+            conflict_target=[SyncState.key],
+            update={SyncState.value: value}).execute()
@@ -0,0 +1,163 @@
+import asyncio
+import datetime
+import logging
+from pathlib import Path
+
+import discord
+from dateutil import parser, tz
+from gcsa.google_calendar import GoogleCalendar
+from googleapiclient.errors import HttpError
+
+
+class CalendarCache(object):
+    '''Keeps the events of the Google calendar in memory.
+
+    The calendar client is created once and all calendar requests run in a
+    background thread. After the first full sync, only changed events are
+    fetched with the sync token of the Calendar API. The embeds of the upcoming
+    events are prepared after every sync.'''
+
+    def __init__(self, calendar, credentials_path, token_path, max_age=900, days_ahead=365):
+        self.calendar = calendar
+        self.credentials_path = credentials_path
+        self.token_path = token_path
+        self.max_age = max_age
+        self.days_ahead = days_ahead
+
+        self.client = None
+        self.sync_token = None
+        # Raw API events by event id
+        self.events = {}
+        # Changed events not taken by the change feed yet, by event id
+        self.pending_changes = {}
+        self.embeds = []
+        self.synced_at = None
+        self.lock = None
+
+    def get_client(self):
+        if self.client == None:
+            logging.debug(
+                f'Parsing calender credentials from {Path(self.credentials_path)}')
+            self.client = GoogleCalendar(
+                calendar=self.calendar,
+                credentials_path=Path(self.credentials_path),
+                token_path=Path(self.token_path))
+        return self.client
+
+    def sync(self):
+        '''Fetches the events changed since the last sync, runs in a thread. Returns the changed events.'''
+        service = self.get_client().service
+        changed = []
+        page_token = None
+
+        while True:
+            params = {'calendarId': self.calendar,
+                      'singleEvents': True, 'maxResults': 250}
+            if page_token != None:
+                params['pageToken'] = page_token
+            if self.sync_token != None:
+                params['syncToken'] = self.sync_token
+
+            try:
+                response = service.events().list(**params).execute()
+            except HttpError as err:
+                # An expired sync token requires a new full sync
+                if err.resp.status == 410 and self.sync_token != None:
+                    logging.info('Calendar sync token expired, running a full sync')
+                    self.sync_token = None
+                    self.events = {}
+                    return self.sync()
+                raise
+
+            for item in response.get('items', []):
+                if item.get('status') == 'cancelled':
+                    self.events.pop(item['id'], None)
+                else:
+                    self.events[item['id']] = item
+                self.pending_changes[item['id']] = item
+                changed.append(item)
+
+            page_token = response.get('nextPageToken')
+            if page_token == None:
+                self.sync_token = response.get('nextSyncToken')
+                return changed
+
+    async def refresh(self):
+        '''Syncs the calendar in a background thread and prepares the embeds. Returns the changed events.'''
+        if self.lock == None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            loop = asyncio.get_event_loop()
+            changed = await loop.run_in_executor(None, self.sync)
+            self.embeds = [CalendarCache.create_embed(event)
+                           for event in self.upcoming()]
+            self.synced_at = datetime.datetime.now()
+
+        logging.debug(
+            f'Calendar synced, {len(changed)} changed events, {len(self.embeds)} upcoming')
+        return changed
+
+    async def refresh_safely(self):
+        try:
+            return await self.refresh()
+        except Exception as err:
+            logging.exception(f'Calendar sync failed: {err}')
+            return []
+
+    def take_changes(self):
+        '''Returns the events changed since the last call, no matter which refresh fetched them.'''
+        changes, self.pending_changes = self.pending_changes, {}
+        return list(changes.values())
+
+    def is_stale(self):
+        return self.synced_at == None or \
+            datetime.datetime.now() - self.synced_at > datetime.timedelta(seconds=self.max_age)
+
+    async def get_embeds(self):
+        '''Returns the prepared embeds of the upcoming events.
+
+        Only the very first call waits for the calendar, later a stale cache is
+        refreshed in the background while the cached embeds are returned.'''
+        if self.synced_at == None:
+            await self.refresh()
+        elif self.is_stale() and (self.lock == None or not self.lock.locked()):
+            asyncio.ensure_future(self.refresh_safely())
+        return self.embeds
+
+    @staticmethod
+    def get_start(event):
+        '''Returns the start of an API event as timezone aware datetime.'''
+        start = event.get('start', {})
+        start = parser.isoparse(start.get('dateTime') or start.get('date'))
+        if start.tzinfo == None:
+            start = start.replace(tzinfo=tz.tzlocal())
+        return start.astimezone(tz.tzlocal())
+
+    def upcoming(self):
+        '''Returns the events of the next days_ahead days ordered by start.'''
+        now = datetime.datetime.now(tz.tzlocal())
+        until = now + datetime.timedelta(days=self.days_ahead)
+
+        events = [event for event in self.events.values()
+                  if 'start' in event and now <= CalendarCache.get_start(event) <= until]
+        return sorted(events, key=CalendarCache.get_start)
+
+    @staticmethod
+    def create_embed(event):
+        # New Embed formatting
+        embed = discord.Embed(
+            title=f":calendar_spiral: {event.get('summary')}\n")
+
+        # Prepare datetime formatting
+        time_format = "%d.%m.%Y %H:%M"
+        dt = CalendarCache.get_start(event)  # Contains the start time of the event
+
+        # Add beginning time as field
+        embed.add_field(name="Beginn",
+                        value=dt.strftime(time_format), inline=False)
+
+        # Add a description
+        embed.add_field(name="Beschreibung",
+                        value=event.get('description') or '-', inline=False)
+        return embed
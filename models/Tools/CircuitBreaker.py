@@ -0,0 +1,80 @@
+import logging
+import time
+
+
+class CircuitOpenError(Exception):
+    '''Raised when a request is refused because the circuit of its host is open.'''
+
+    def __init__(self, host, retry_in):
+        super().__init__(
+            f'Circuit for {host} is open, next try in {retry_in:.0f} seconds')
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker(object):
+    '''Per host circuit breaker.
+
+    After failure_threshold consecutive transient failures the circuit opens and
+    all requests fail immediately. After reset_timeout seconds a single trial
+    request is let through (half open), its outcome closes or reopens the circuit.'''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    breakers = {}
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=60):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = time.monotonic
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_started = None
+
+    @classmethod
+    def for_host(cls, host):
+        '''Returns the breaker of a host and creates it if necessary.'''
+        if host not in cls.breakers:
+            cls.breakers[host] = CircuitBreaker(host)
+        return cls.breakers[host]
+
+    def before_request(self):
+        '''Raises CircuitOpenError if no request may be sent to the host right now.'''
+        if self.state == CircuitBreaker.OPEN:
+            retry_in = self.opened_at + self.reset_timeout - self.clock()
+            if retry_in > 0:
+                raise CircuitOpenError(self.host, retry_in)
+
+            logging.info(f'Circuit for {self.host} is half open, sending a trial request')
+            self.state = CircuitBreaker.HALF_OPEN
+            self.trial_started = None
+
+        if self.state == CircuitBreaker.HALF_OPEN:
+            # Only one trial request at a time, a lost trial expires after reset_timeout
+            now = self.clock()
+            if self.trial_started != None and now - self.trial_started < self.reset_timeout:
+                raise CircuitOpenError(
+                    self.host, self.trial_started + self.reset_timeout - now)
+            self.trial_started = now
+
+    def record_success(self):
+        if self.state != CircuitBreaker.CLOSED:
+            logging.info(f'Circuit for {self.host} is closed again')
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.trial_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_started = None
+
+        if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CircuitBreaker.OPEN:
+                logging.warning(
+                    f'Opening circuit for {self.host} after {self.failures} failures')
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = self.clock()
@@ -0,0 +1,77 @@
+import logging
+
+
+class ComboRoleEngine(object):
+    '''Assigns combo roles to members which have all required roles of the combo.
+
+    role_list contains entries of [combo_role_id, [required_role_id, ...]]. The
+    roles are looked up in an index by id, which is kept up to date with the
+    guild role events.'''
+
+    def __init__(self, role_list):
+        self.combos = {combo_role_id: frozenset(required_role_ids)
+                       for combo_role_id, required_role_ids in role_list}
+        self.combo_role_ids = frozenset(self.combos)
+
+        # Role objects of the combo roles by guild id and role id
+        self.roles = {}
+
+    def index_guild(self, guild):
+        '''Builds the role index of a guild.'''
+        self.roles[guild.id] = {role.id: role for role in guild.roles
+                                if role.id in self.combo_role_ids}
+
+        missing = self.combo_role_ids - set(self.roles[guild.id])
+        if len(missing) > 0:
+            logging.warning(
+                f'Combo roles {sorted(missing)} not found in guild {guild.name}')
+
+    def on_role_changed(self, role):
+        '''Updates the index after a role was created or edited.'''
+        if role.id in self.combo_role_ids:
+            self.roles.setdefault(role.guild.id, {})[role.id] = role
+
+    def on_role_deleted(self, role):
+        '''Removes a deleted role from the index.'''
+        self.roles.get(role.guild.id, {}).pop(role.id, None)
+
+    def desired_combo_roles(self, role_ids):
+        '''Returns the ids of all combo roles a member with role_ids should have.'''
+        return {combo_role_id for combo_role_id, required_role_ids in self.combos.items()
+                if required_role_ids.issubset(role_ids)}
+
+    async def apply(self, member):
+        '''Adds and removes combo roles of a member with a single request, if anything has to change.
+
+        Returns True if the roles of the member were edited.'''
+        if len(self.combos) == 0:
+            return False
+
+        role_ids = {role.id for role in member.roles}
+        desired = self.desired_combo_roles(role_ids)
+        current = role_ids & self.combo_role_ids
+
+        to_add = desired - current
+        to_remove = current - desired
+        if len(to_add) == 0 and len(to_remove) == 0:
+            return False
+
+        if member.guild.id not in self.roles:
+            self.index_guild(member.guild)
+        guild_roles = self.roles[member.guild.id]
+
+        new_roles = [role for role in member.roles
+                     if role.id not in to_remove and not role.is_default()]
+        new_roles += [guild_roles[role_id]
+                      for role_id in to_add if role_id in guild_roles]
+
+        for role_id in to_add:
+            logging.debug(
+                f'Adding combo role {role_id} for player {member.name}')
+        for role_id in to_remove:
+            logging.debug(
+                f'Removing combo role {role_id} for player {member.name}')
+
+        await member.edit(roles=new_roles, reason='Combo roles')
+        logging.debug(f'Done with editing roles for player {member.name}')
+        return True
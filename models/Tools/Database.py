@@ -0,0 +1,69 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from models.Tools import Metrics
+
+# All writes go through a single thread, so they never compete for the SQLite write lock.
+# Reads run concurrently on a small pool. Peewee keeps one connection per thread.
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+# Created on first use, so db_reader_threads can be set by the .env file
+readers = None
+
+DB_QUEUE_WAIT = Metrics.histogram('tpa_db_queue_wait_seconds',
+                                  'Time database work waited for a free thread', ['pool'])
+DB_DURATION = Metrics.histogram('tpa_db_duration_seconds',
+                                'Time spent running database work in a thread', ['pool'])
+
+
+def timed(pool, func):
+    '''Wraps database work, so its waiting and running time are recorded.'''
+    queue_wait = DB_QUEUE_WAIT.labels(pool)
+    duration = DB_DURATION.labels(pool)
+    submitted = time.monotonic()
+
+    def run():
+        started = time.monotonic()
+        queue_wait.observe(started - submitted)
+        try:
+            return func()
+        finally:
+            duration.observe(time.monotonic() - started)
+    return run
+
+
+def get_readers():
+    global readers
+
+    if readers == None:
+        readers = ThreadPoolExecutor(max_workers=int(
+            os.getenv('db_reader_threads', 2)), thread_name_prefix='db-reader')
+    return readers
+
+
+async def run_read(func, *args, **kwargs):
+    '''Runs a reading database function on the reader pool and returns its result.'''
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_readers(), timed('read', functools.partial(func, *args, **kwargs)))
+
+
+async def run_write(func, *args, **kwargs):
+    '''Runs a writing database function on the writer thread and returns its result.
+
+    Functions writing several rows should open their own transaction.'''
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(writer, timed('write', functools.partial(func, *args, **kwargs)))
+
+
+async def select(query):
+    '''Executes a select query on the reader pool and returns its rows as list.'''
+    return await run_read(list, query)
+
+
+def shutdown():
+    '''Waits for pending database work and stops the threads.'''
+    writer.shutdown(wait=True)
+    if readers != None:
+        readers.shutdown(wait=True)
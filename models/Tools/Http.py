@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+# The application wide session, created on bot startup
+session = None
+
+
+def create_session(trace_configs=None):
+    '''Creates a session with a pooled, keep alive connector and a DNS cache.'''
+    connector = aiohttp.TCPConnector(
+        limit=int(os.getenv('http_pool_limit', 30)),
+        limit_per_host=int(os.getenv('http_pool_limit_per_host', 10)),
+        ttl_dns_cache=300,
+        keepalive_timeout=60)
+
+    # Default bounds, single requests may pass their own timeout
+    timeout = aiohttp.ClientTimeout(total=60, connect=10, sock_read=30)
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=trace_configs)
+
+
+async def open_session():
+    '''Opens the shared session if it is not open yet and returns it.'''
+    global session
+
+    if session == None or session.closed:
+        logging.debug('Opening shared HTTP session...')
+        session = create_session()
+    return session
+
+
+def get_session():
+    '''Returns the shared session, open_session has to be awaited before.'''
+    if session == None or session.closed:
+        raise RuntimeError('The shared HTTP session is not open')
+    return session
+
+
+async def close_session():
+    '''Closes the shared session and its connections.'''
+    global session
+
+    if session != None and not session.closed:
+        logging.debug('Closing shared HTTP session...')
+        await session.close()
+
+        # Give SSL connections time to shut down, see
+        # https://docs.aiohttp.org/en/stable/client_advanced.html#graceful-shutdown
+        await asyncio.sleep(0.25)
+    session = None
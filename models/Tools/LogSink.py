@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+
+# Maximum length of a Discord message
+MESSAGE_LIMIT = 2000
+
+
+class LogChannelSink(object):
+    '''Buffers lines for a Discord channel and sends them packed into as few messages as possible.
+
+    The first line starts a window of log_channel_flush_seconds (default 5), all
+    lines added until then are sent together.'''
+
+    sinks = {}
+
+    def __init__(self, bot, channel_id, window=5):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.window = window
+        self.lines = []
+        self.flush_task = None
+
+    @classmethod
+    def for_channel(cls, bot, channel_id):
+        '''Returns the sink of a channel and creates it if necessary.'''
+        if channel_id not in cls.sinks:
+            cls.sinks[channel_id] = LogChannelSink(
+                bot, channel_id, window=float(os.getenv('log_channel_flush_seconds', 5)))
+        return cls.sinks[channel_id]
+
+    @classmethod
+    async def flush_all(cls):
+        '''Sends everything buffered, e.g. on shutdown.'''
+        for sink in cls.sinks.values():
+            await sink.flush()
+
+    def add(self, line):
+        self.lines.append(line)
+
+        if self.flush_task == None:
+            self.flush_task = asyncio.ensure_future(self.delayed_flush())
+
+    async def delayed_flush(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        if self.flush_task != None:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+        lines, self.lines = self.lines, []
+        if len(lines) == 0:
+            return
+
+        # Channels of guilds on the shards of other processes aren't cached, they are sent to through the REST API
+        channel = self.bot.get_channel(self.channel_id)
+
+        for message in LogChannelSink.pack(lines):
+            try:
+                if channel != None:
+                    await channel.send(message)
+                else:
+                    await self.bot.http.send_message(self.channel_id, message)
+            except Exception as err:
+                logging.error(
+                    f'Sending to logging channel id {self.channel_id} failed: {err}')
+
+    @staticmethod
+    def pack(lines, limit=MESSAGE_LIMIT):
+        '''Joins lines into as few messages of at most limit characters as possible.'''
+        messages = []
+        current = ''
+        for line in lines:
+            # Overlong lines are cut into pieces
+            while len(line) > limit:
+                if current != '':
+                    messages.append(current)
+                    current = ''
+                messages.append(line[:limit])
+                line = line[limit:]
+
+            if current == '':
+                current = line
+            elif len(current) + 1 + len(line) <= limit:
+                current += '\n' + line
+            else:
+                messages.append(current)
+                current = line
+
+        if current != '':
+            messages.append(current)
+        return messages
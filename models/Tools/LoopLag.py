@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import time
+
+from models.Tools import Metrics
+
+LOOP_LAG = Metrics.histogram('tpa_event_loop_lag_seconds',
+                             'Delay of the event loop waking up a sleeping coroutine')
+LAST_LOOP_LAG = Metrics.gauge('tpa_event_loop_last_lag_seconds',
+                              'Last measured event loop lag')
+
+
+class LoopLagMonitor(object):
+    '''Measures how late the event loop wakes up a sleeping coroutine.
+
+    A lag above a few milliseconds means some callback blocked the loop, e.g. a
+    synchronous database query.'''
+
+    def __init__(self, interval=0.5, warn_threshold=0.25, report_interval=300):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.report_interval = report_interval
+        self.last_lag = 0
+        self.max_lag = 0
+        self.samples = 0
+        self.total_lag = 0
+        self.task = None
+
+    def start(self):
+        if self.task == None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+    def average_lag(self):
+        if self.samples == 0:
+            return 0
+        return self.total_lag / self.samples
+
+    async def run(self):
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+
+            self.last_lag = max(0, now - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.samples += 1
+            self.total_lag += self.last_lag
+            LOOP_LAG.observe(self.last_lag)
+            LAST_LOOP_LAG.set(self.last_lag)
+
+            if self.last_lag > self.warn_threshold:
+                logging.warning(
+                    f'Event loop was blocked for {self.last_lag * 1000:.0f} ms')
+
+            if now - last_report > self.report_interval:
+                logging.debug(
+                    f'Event loop lag: avg {self.average_lag() * 1000:.1f} ms, max {self.max_lag * 1000:.1f} ms over {self.samples} samples')
+                last_report = now
+                self.max_lag = 0
+                self.samples = 0
+                self.total_lag = 0
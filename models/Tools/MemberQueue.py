@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+
+from models.Tools import Metrics
+
+HANDLER_DURATION = Metrics.histogram('tpa_discord_handler_duration_seconds',
+                                     'Duration of the Discord member event handlers', ['event'])
+HANDLER_ERRORS = Metrics.counter('tpa_discord_handler_errors',
+                                 'Discord member event handlers which raised', ['event'])
+EVENT_LATENCY = Metrics.histogram('tpa_discord_event_latency_seconds',
+                                  'Time from the first event of a member until its events were handled')
+QUEUE_DEPTH = Metrics.gauge('tpa_discord_event_queue_depth',
+                            'Members with pending events')
+
+
+class MemberEventQueue(object):
+    '''Coalesces member events and processes them with a fixed pool of workers.
+
+    Events of a member are collected for debounce seconds after the first one.
+    Only the latest member state of every kind of event is handled, in the order
+    the kinds occurred last. handlers maps the kind of event ('join', 'remove',
+    'update') to a coroutine function taking the member.'''
+
+    def __init__(self, handlers, debounce=2.0, workers=2):
+        self.handlers = handlers
+        self.debounce = debounce
+        self.workers = workers
+
+        # Pending events by (guild id, member id)
+        self.pending = {}
+        # Members currently handled by a worker
+        self.active = set()
+        self.queue = None
+        self.tasks = []
+
+        # Statistics
+        self.processed = 0
+        self.coalesced = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def start(self):
+        if self.queue == None:
+            self.queue = asyncio.Queue()
+            self.tasks = [asyncio.ensure_future(self.worker())
+                          for _ in range(self.workers)]
+            QUEUE_DEPTH.set_function(self.depth)
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.queue = None
+
+    def push(self, kind, member):
+        '''Adds an event of a member, it is handled after the debounce window.'''
+        key = (member.guild.id, member.id)
+        entry = self.pending.get(key)
+
+        if entry == None:
+            entry = {'enqueued': time.monotonic(), 'events': {}}
+            self.pending[key] = entry
+            asyncio.get_event_loop().call_later(
+                self.debounce, self.queue.put_nowait, key)
+        else:
+            self.coalesced += 1
+
+        # Keep the latest state, ordered by the last occurrence of the kind
+        entry['events'].pop(kind, None)
+        entry['events'][kind] = member
+
+    def depth(self):
+        '''Returns the number of members with pending events.'''
+        return len(self.pending)
+
+    def stats(self):
+        average_latency = self.total_latency / self.processed if self.processed > 0 else 0
+        return {'depth': self.depth(), 'processed': self.processed, 'coalesced': self.coalesced,
+                'average_latency': average_latency, 'max_latency': self.max_latency}
+
+    async def worker(self):
+        while True:
+            key = await self.queue.get()
+
+            # The same member is never handled by two workers at once
+            if key in self.active:
+                asyncio.get_event_loop().call_later(
+                    self.debounce, self.queue.put_nowait, key)
+                continue
+
+            entry = self.pending.pop(key, None)
+            if entry == None:
+                continue
+
+            self.active.add(key)
+            try:
+                for kind, member in entry['events'].items():
+                    started = time.monotonic()
+                    try:
+                        await self.handlers[kind](member)
+                    except Exception as err:
+                        HANDLER_ERRORS.labels(kind).inc()
+                        logging.exception(
+                            f'Handling {kind} event of member {member} failed: {err}')
+                    HANDLER_DURATION.labels(kind).observe(
+                        time.monotonic() - started)
+            finally:
+                self.active.discard(key)
+
+            latency = time.monotonic() - entry['enqueued']
+            EVENT_LATENCY.observe(latency)
+            self.processed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            logging.debug(
+                f"Handled events {list(entry['events'])} of member {key[1]} after {latency:.2f}s, queue depth {self.depth()}")
@@ -0,0 +1,280 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+
+from aiohttp import web
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+
+class Metric(object):
+    '''Base class of the metrics. Labelled children are created once and cached,
+    so recording a value is a dictionary lookup and an addition.'''
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        '''Returns the child for the given label values, in the order of the label names.'''
+        child = self.children.get(values)
+        if child == None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def family(self):
+        '''Name of the metric family in the HELP and TYPE lines, the samples add their suffix to it.'''
+        return self.name
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        family = self.family()
+        lines = [f'# HELP {family} {escape(self.documentation)}',
+                 f'# TYPE {family} {self.kind}']
+        for suffix, values, extra, value in self.samples():
+            lines.append(
+                f'{family}{suffix}{format_labels(self.label_names, values, extra)} {value}')
+        return '\n'.join(lines)
+
+
+class CounterValue(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def family(self):
+        # In the text format the family of a counter has the name of its samples
+        return self.name + '_total'
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield '', values, '', child.value
+
+
+class GaugeValue(object):
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        '''The gauge is read from function when the metrics are rendered.'''
+        self.function = function
+
+    def get(self):
+        if self.function != None:
+            return self.function()
+        return self.value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            try:
+                value = child.get()
+            except Exception as err:
+                logging.debug(f'Reading gauge {self.name} failed: {err}')
+                continue
+            yield '', values, '', value
+
+
+class HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', values, f'le="{bound}"', cumulative
+            cumulative += counts[-1]
+            yield '_bucket', values, 'le="+Inf"', cumulative
+            yield '_sum', values, '', total
+            yield '_count', values, '', cumulative
+
+
+class Timer(object):
+    '''Context manager observing the duration of its block in a histogram child.'''
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.started)
+
+
+class Registry(object):
+    '''Holds the metrics of the process and renders them in the Prometheus text format.'''
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, documentation, labels=(), **kwargs):
+        '''Returns the metric with this name and creates it if necessary.'''
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric == None:
+                metric = cls(name, documentation, labels, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(
+                    f'Metric {name} is already registered as {metric.kind}')
+            return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in list(self.metrics.values())) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return registry.register(Counter, name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    return registry.register(Gauge, name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram, name, documentation, labels, buckets=buckets)
+
+
+JOB_DURATION = histogram('tpa_job_duration_seconds',
+                         'Duration of scheduled jobs', ['job'])
+JOB_RUNS = counter('tpa_job_runs', 'Runs of scheduled jobs by outcome',
+                   ['job', 'outcome'])
+
+
+def job(name, func):
+    '''Wraps a scheduled coroutine function, its duration and outcome ('succeeded' or 'failed') are recorded.'''
+    duration = JOB_DURATION.labels(name)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        outcome = 'failed'
+        try:
+            result = await func(*args, **kwargs)
+            outcome = 'succeeded'
+            return result
+        finally:
+            duration.observe(time.monotonic() - started)
+            JOB_RUNS.labels(name, outcome).inc()
+    return wrapper
+
+
+class MetricsServer(object):
+    '''Serves the registry on http://host:port/metrics.'''
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.port = port
+        self.host = host
+        self.runner = None
+
+    async def metrics(self, request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([web.get('/metrics', self.metrics)])
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(
+            f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.runner != None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -1,22 +1,194 @@
+import asyncio
 import logging
+import os
+import random
+import time
+
+import aiohttp
+from yarl import URL
+
+from models.Limit.Limit import Limit
+from models.Tools import Metrics
+from models.Tools.CircuitBreaker import CircuitBreaker
+
+# Default bounds for a single request
+REQUEST_TIMEOUT = 15
+REQUEST_DEADLINE = 60
+REQUEST_RETRIES = 3
+
+# Backoff settings in seconds
+BACKOFF_BASE = 1
+BACKOFF_CAP = 30
+
+# Base URLs of the APIs, they can be pointed to other servers with tracker_base_url and cv_base_url
+TRACKER_BASE_URL = 'https://public-api.tracker.gg'
+CV_BASE_URL = 'http://cv.thepenguinarmy.de'
+
+
+class NetworkError(Exception):
+    '''Base class of all errors raised for outbound HTTP requests.'''
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class TransientError(NetworkError):
+    '''Temporary failure (timeouts, disconnects, 502/503/504), the request may be retried.'''
+
+
+class UncertainError(TransientError):
+    '''No response after the request was sent (timeout, disconnect), the server may have processed it.'''
+
+
+class RateLimitedError(TransientError):
+    '''HTTP 429, retry_after contains the delay requested by the server.'''
+
+    def __init__(self, message, status=429, retry_after=None):
+        super().__init__(message, status=status)
+        self.retry_after = retry_after
+
+
+class PermanentError(NetworkError):
+    '''Failure that will not go away by retrying, e.g. authentication errors.'''
+
+
+class NotFoundError(PermanentError, LookupError):
+    '''The requested resource does not exist (400, 404, 500 on tracker.gg for renamed players).'''
+
+
+# Status codes which indicate that the resource was not found
+NOT_FOUND_CODES = [400, 404, 500]
+# Status codes which are worth another try
+TRANSIENT_CODES = [408, 502, 503, 504]
+
+
+HTTP_DURATION = Metrics.histogram('tpa_http_request_duration_seconds',
+                                  'Time until the response headers of outbound HTTP requests, per attempt', ['host'])
+HTTP_RESPONSES = Metrics.counter('tpa_http_responses',
+                                 'Outbound HTTP responses by status, or the error without response', ['host', 'status'])
+RATE_LIMIT_WAIT = Metrics.histogram('tpa_rate_limit_wait_seconds',
+                                    'Time spent waiting for a rate limiter token', ['host'])
+RATE_LIMIT_REMAINING = Metrics.gauge('tpa_rate_limit_remaining',
+                                     'Last X-RateLimit-Remaining-minute value of a host', ['host'])
+
+
+def tracker_url(path):
+    return os.getenv('tracker_base_url', TRACKER_BASE_URL) + path
+
+
+def cv_url(path):
+    return os.getenv('cv_base_url', CV_BASE_URL) + path
+
+
+def backoff_delay(attempt):
+    '''Exponential backoff with full jitter.'''
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def classify_response(response, url):
+    '''Raises the matching NetworkError for a non successful response.'''
+    status = response.status
+    message = f'HTTP statuscode {status}, reason: {response.reason} for {url}'
+
+    if status == 429:
+        retry_after = None
+        if 'Retry-After' in response.headers:
+            retry_after = Limit.parse_retry_after(response.headers['Retry-After'])
+        raise RateLimitedError(message, retry_after=retry_after)
+    elif status in NOT_FOUND_CODES:
+        raise NotFoundError(message, status=status)
+    elif status in TRANSIENT_CODES or status >= 500:
+        raise TransientError(message, status=status)
+    else:
+        raise PermanentError(message, status=status)
+
+
+async def request(session, method, url, retries=REQUEST_RETRIES, timeout=REQUEST_TIMEOUT, deadline=REQUEST_DEADLINE, **kwargs):
+    '''Sends a request and returns the response text.
+
+    Every attempt takes a token from the rate limiter of the host and passes its
+    circuit breaker. Transient errors are retried with exponential backoff until
+    retries or the overall deadline are used up. Raises a NetworkError subclass
+    or CircuitOpenError on failure.'''
+    host = URL(url).host
+    breaker = CircuitBreaker.for_host(host)
+    bucket = Limit.buckets.get(host)
+    duration = HTTP_DURATION.labels(host)
+    give_up_at = time.monotonic() + deadline
+
+    attempt = 0
+    while True:
+        breaker.before_request()
+        if bucket != None:
+            waiting_since = time.monotonic()
+            await bucket.acquire()
+            RATE_LIMIT_WAIT.labels(host).observe(
+                time.monotonic() - waiting_since)
+
+        started = time.monotonic()
+        try:
+            async with session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as response:
+                duration.observe(time.monotonic() - started)
+                HTTP_RESPONSES.labels(host, str(response.status)).inc()
+
+                logging.debug(f"HTTP Status for {url}: {response.status}")
+                if 'X-RateLimit-Remaining-minute' in response.headers:
+                    remaining = response.headers['X-RateLimit-Remaining-minute']
+                    logging.debug(
+                        f"Remaining Requests per minute: {remaining}")
+                    if remaining.isdigit():
+                        RATE_LIMIT_REMAINING.labels(host).set(int(remaining))
+
+                # Let the shared limiter of this host adapt to the announced limits
+                Limit.update_from_headers(host, response.headers)
+
+                if 200 <= response.status < 300:
+                    text = await response.text()
+                    breaker.record_success()
+                    return text
+
+                classify_response(response, url)
+
+        except PermanentError:
+            # The host answered properly, so it is healthy
+            breaker.record_success()
+            raise
+        except (TransientError, asyncio.TimeoutError, aiohttp.ClientError) as err:
+            breaker.record_failure()
+
+            if not isinstance(err, TransientError):
+                # No response, so the status wasn't counted yet
+                HTTP_RESPONSES.labels(host, type(err).__name__).inc()
+                # Only a failed connection means the request was never sent
+                error_class = TransientError if isinstance(
+                    err, aiohttp.ClientConnectorError) else UncertainError
+                err = error_class(f'{type(err).__name__} for {url}: {err}')
+
+            delay = backoff_delay(attempt)
+            if isinstance(err, RateLimitedError) and err.retry_after != None:
+                delay = max(delay, err.retry_after)
+
+            if attempt >= retries or time.monotonic() + delay > give_up_at:
+                logging.error(
+                    f'Giving up on {url} after {attempt + 1} attempts: {err}')
+                raise err
+
+            logging.warning(
+                f'Attempt {attempt + 1} for {url} failed ({err}), retrying in {delay:.1f} seconds')
+            await asyncio.sleep(delay)
+            attempt += 1
 
 
 async def fetch(session, url, headers=''):
     # https://docs.aiohttp.org/en/stable/http_request_lifecycle.html#how-to-use-the-clientsession
     '''Allows retrieval of a url with a session added
         '''
-    async with session.get(url, headers=headers) as response:
-        logging.debug(f"HTTP Status for {url}: {response.status}")
-        if 'X-RateLimit-Remaining-minute' in response.headers:
-            logging.debug(
-                f"Remaining Requests per minute: {response.headers['X-RateLimit-Remaining-minute']}")
-
-        # Check the status code
-        # Status codes which indicate an error
-        error_codes = [400, 404, 500]
-        if response.status == 200:
-            # Return the response text
-            return await response.text()
-        elif response.status in error_codes:
-            raise LookupError(
-                f'HTTP statuscode {response.status}, reason: {response.reason} for {url}')
+    return await request(session, 'GET', url, headers=headers or None)
+
+
+async def post(session, url, json=None, auth=None, retries=REQUEST_RETRIES, timeout=REQUEST_TIMEOUT):
+    '''Posts json to a url and returns the response text.
+
+    Posts which must not be sent twice should pass retries=0 and handle UncertainError themselves.'''
+    return await request(session, 'POST', url, retries=retries, timeout=timeout, json=json, auth=auth)
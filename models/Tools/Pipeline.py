@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+
+from models.Tools import Metrics
+
+STEP_DURATION = Metrics.histogram('tpa_pipeline_step_duration_seconds',
+                                  'Duration of the pipeline steps', ['pipeline', 'step'])
+STEP_RUNS = Metrics.counter('tpa_pipeline_step_runs',
+                            'Pipeline steps by outcome', ['pipeline', 'step', 'outcome'])
+PIPELINE_SKIPPED = Metrics.counter('tpa_pipeline_skipped',
+                                   'Pipeline runs skipped because the lock was taken', ['pipeline'])
+
+
+class Step(object):
+    '''A step of a pipeline. func is a coroutine function which gets the results of the previous steps.'''
+
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+
+class Pipeline(object):
+    '''Runs steps once per run in dependency order and shares their results.
+
+    Pipelines with the same lock never run at the same time. A run which finds the
+    lock taken is skipped, unless wait is set: then it waits for the lock, e.g. for a
+    pipeline whose work the other pipelines of the lock don't do.'''
+
+    locks = {}
+
+    def __init__(self, name, steps, lock=None, wait=False):
+        self.name = name
+        self.steps = Pipeline.order(steps)
+        self.lock_name = lock if lock != None else name
+        self.wait = wait
+        self.last_timings = {}
+
+    @staticmethod
+    def order(steps):
+        '''Sorts the steps topologically, raises ValueError for unknown or cyclic dependencies.'''
+        by_name = {step.name: step for step in steps}
+        for step in steps:
+            for required in step.requires:
+                if required not in by_name:
+                    raise ValueError(
+                        f'Step {step.name} requires unknown step {required}')
+
+        ordered = []
+        done = set()
+        remaining = list(steps)
+        while len(remaining) > 0:
+            ready = [step for step in remaining if set(step.requires) <= done]
+            if len(ready) == 0:
+                raise ValueError(
+                    f'Cyclic dependencies between {[step.name for step in remaining]}')
+            for step in ready:
+                ordered.append(step)
+                done.add(step.name)
+                remaining.remove(step)
+        return ordered
+
+    @classmethod
+    def get_lock(cls, name):
+        if name not in cls.locks:
+            cls.locks[name] = asyncio.Lock()
+        return cls.locks[name]
+
+    async def run(self):
+        '''Runs all steps, steps whose requirements failed are skipped. Returns the results by step name.'''
+        lock = Pipeline.get_lock(self.lock_name)
+        if lock.locked() and self.wait:
+            logging.info(
+                f'Pipeline {self.name} waits for {self.lock_name} to finish')
+        elif lock.locked():
+            PIPELINE_SKIPPED.labels(self.name).inc()
+            logging.warning(
+                f'Pipeline {self.name} skipped, {self.lock_name} is still running')
+            return None
+
+        async with lock:
+            results = {}
+            failed = set()
+            timings = {}
+            started = time.monotonic()
+
+            for step in self.steps:
+                if any(required in failed for required in step.requires):
+                    logging.warning(
+                        f'Pipeline {self.name}: skipping {step.name}, a required step failed')
+                    failed.add(step.name)
+                    STEP_RUNS.labels(self.name, step.name, 'skipped').inc()
+                    continue
+
+                step_started = time.monotonic()
+                outcome = 'succeeded'
+                try:
+                    results[step.name] = await step.func(results)
+                except Exception as err:
+                    logging.exception(
+                        f'Pipeline {self.name}: step {step.name} failed: {err}')
+                    failed.add(step.name)
+                    outcome = 'failed'
+                timings[step.name] = time.monotonic() - step_started
+                STEP_DURATION.labels(self.name, step.name).observe(
+                    timings[step.name])
+                STEP_RUNS.labels(self.name, step.name, outcome).inc()
+
+            timings['total'] = time.monotonic() - started
+            self.last_timings = timings
+
+        logging.info(f'Pipeline {self.name} finished in {timings["total"]:.1f}s: ' +
+                     ', '.join(f'{name} {duration:.1f}s' for name, duration in timings.items() if name != 'total') +
+                     (f', failed: {sorted(failed)}' if len(failed) > 0 else ''))
+        return results
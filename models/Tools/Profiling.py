@@ -0,0 +1,152 @@
+import cProfile
+import datetime
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+
+# Profiling mode, switched on by the environment variable profiling, see setup
+enabled = False
+# Name of the running profile, cProfile can't run two profiles at once
+active = None
+# Last peewee query of each thread as (sql, time), recorded while slow callbacks are reported
+last_queries = {}
+
+
+def setup():
+    '''Reads the profiling mode from the environment, has to be called before the jobs are wrapped.'''
+    global enabled
+    enabled = os.getenv('profiling') == 'true'
+    if enabled:
+        logging.warning(
+            f"Profiling mode is on, profiles are saved to {os.getenv('profile_dir', 'profiles')}")
+
+
+def start(name):
+    '''Starts a cProfile session for name, returns None if another one is running.
+
+    The profile covers everything the event loop thread runs meanwhile, so concurrent
+    coroutines show up in it too.'''
+    global active
+    if active != None:
+        logging.warning(
+            f'Profile of {active} is still running, {name} is not profiled')
+        return None
+
+    active = name
+    profile = cProfile.Profile()
+    profile.name = name
+    profile.started = time.monotonic()
+    profile.enable()
+    return profile
+
+
+def stop(profile):
+    '''Stops a session started by start and saves it as .prof file, returns the path of the file.'''
+    global active
+    if profile == None:
+        return None
+
+    profile.disable()
+    active = None
+    duration = time.monotonic() - profile.started
+
+    directory = os.getenv('profile_dir', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(
+        directory, f"{profile.name}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.prof")
+    profile.dump_stats(path)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats(
+            'cumulative').print_stats(15)
+        logging.debug(summary.getvalue())
+
+    logging.info(f'Profiled {profile.name} for {duration:.1f}s, saved to {path}')
+    return path
+
+
+async def run_profiled(name, func, *args, **kwargs):
+    '''Awaits func under cProfile, returns its result and the path of the profile.'''
+    profile = start(name)
+    try:
+        result = await func(*args, **kwargs)
+    finally:
+        path = stop(profile)
+    return result, path
+
+
+def job(name, func):
+    '''Wraps a scheduled coroutine function, so every run is profiled in profiling mode.
+
+    Without profiling mode func is returned as it is.'''
+    if not enabled:
+        return func
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        result, _ = await run_profiled(name, func, *args, **kwargs)
+        return result
+    return wrapper
+
+
+class SlowCallbackFilter(logging.Filter):
+    '''Adds the peewee query which ran during a slow callback to the report of asyncio.'''
+
+    def __init__(self, thread_id):
+        super().__init__()
+        self.thread_id = thread_id
+
+    def filter(self, record):
+        # asyncio reports with 'Executing %s took %.3f seconds'
+        if 'took' in str(record.msg) and isinstance(record.args, tuple) and len(record.args) == 2:
+            query = last_queries.get(self.thread_id)
+            if query != None and query[1] >= record.created - record.args[1]:
+                record.msg = f'{record.getMessage()}, last peewee query: {query[0]}'
+                record.args = ()
+        return True
+
+
+slow_callback_filter = None
+
+
+def enable_slow_callbacks(loop, database, threshold=0.1):
+    '''Lets asyncio report callbacks blocking the loop longer than threshold seconds.
+
+    The report names the coroutine, the last query the loop thread sent to the database is added.'''
+    global slow_callback_filter
+    if slow_callback_filter != None:
+        return
+
+    loop.set_debug(True)
+    loop.slow_callback_duration = threshold
+
+    execute_sql = database.execute_sql
+
+    def recording_execute_sql(sql, *args, **kwargs):
+        last_queries[threading.get_ident()] = (sql[:500], time.time())
+        return execute_sql(sql, *args, **kwargs)
+
+    database.execute_sql = recording_execute_sql
+
+    slow_callback_filter = SlowCallbackFilter(threading.get_ident())
+    logging.getLogger('asyncio').addFilter(slow_callback_filter)
+    logging.warning(
+        f'Reporting callbacks blocking the event loop longer than {threshold * 1000:.0f} ms')
+
+
+def disable_slow_callbacks(loop, database):
+    global slow_callback_filter
+    if slow_callback_filter == None:
+        return
+
+    loop.set_debug(False)
+    # Removes the recording wrapper of the instance, the method of the class is used again
+    del database.execute_sql
+    logging.getLogger('asyncio').removeFilter(slow_callback_filter)
+    slow_callback_filter = None
+    last_queries.clear()
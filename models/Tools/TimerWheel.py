@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import math
+import time
+
+
+class TimerWheel(object):
+    '''Hashed timing wheel for many long running timers.
+
+    The wheel has slots, one per tick seconds. Scheduling and cancelling a timer
+    costs O(1) and every tick only looks at the timers of one slot. Timers
+    further away than one revolution wait for the number of remaining rounds.'''
+
+    def __init__(self, tick=30, slots=2880):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        # Slot of every timer by key
+        self.timers = {}
+        self.position = 0
+        self.task = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, when, callback):
+        '''Calls callback() at the unix timestamp when, replaces an existing timer with the same key.
+
+        Coroutine functions are run as tasks.'''
+        self.cancel(key)
+
+        ticks = max(1, math.ceil((when - time.time()) / self.tick))
+        slot = (self.position + ticks) % len(self.slots)
+        rounds = (ticks - 1) // len(self.slots)
+
+        self.slots[slot][key] = [rounds, callback]
+        self.timers[key] = slot
+
+    def cancel(self, key):
+        slot = self.timers.pop(key, None)
+        if slot != None:
+            self.slots[slot].pop(key, None)
+
+    def start(self):
+        if self.task == None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+    def advance(self):
+        '''Moves the wheel one slot forward and fires the due timers.'''
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+
+        for key, entry in list(slot.items()):
+            if entry[0] > 0:
+                entry[0] -= 1
+                continue
+
+            del slot[key]
+            self.timers.pop(key, None)
+            try:
+                result = entry[1]()
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception as err:
+                logging.exception(f'Timer {key} failed: {err}')
+
+    async def run(self):
+        # The ticks are aligned to the start, so the wheel doesn't drift
+        started = time.monotonic()
+        ticks = 0
+        while True:
+            ticks += 1
+            await asyncio.sleep(max(0, started + ticks * self.tick - time.monotonic()))
+            self.advance()
@@ -0,0 +1,223 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+
+import aiohttp
+from peewee import AutoField, DateTimeField, IntegerField, TextField
+
+from models.BaseModel import BaseModel
+from models.Tools.CircuitBreaker import CircuitOpenError
+from models.Tools.Database import run_read, run_write
+from models.Tools.Network import (NetworkError, PermanentError, UncertainError,
+                                   cv_url, post)
+
+# Backoff between the attempts of an upload, doubled per attempt up to the cap
+RETRY_BASE = datetime.timedelta(minutes=1)
+RETRY_CAP = datetime.timedelta(hours=1)
+
+# Sent uploads are kept this long, their keys prevent uploading a week twice
+RETENTION = datetime.timedelta(days=60)
+
+# Attempts of an upload the CV refuses, e.g. 400 for an unknown ubi id or 401, before it is given up
+MAX_PERMANENT_ATTEMPTS = 3
+
+
+class UploadOutbox(BaseModel.BaseModel):
+    '''Weekly xp uploads to the CV, stored before sending and retried until they succeed.
+
+    Uploads the CV keeps refusing are given up (failed_at) and kept for RETENTION like sent ones.
+    An upload without answer after it was sent may be stored by the CV already. It is given
+    up as well, as sending it again could count the xp twice.'''
+    outbox_id = AutoField(null=True)
+    # Ubisoft id and week, one upload per player and week
+    idempotency_key = TextField(unique=True)
+    player_name = TextField(null=True)
+    # The JSON body, the dateTime is the time of the enqueue, not of the send
+    payload = TextField()
+    created_at = DateTimeField(default=datetime.datetime.now)
+    attempts = IntegerField(default=0)
+    next_attempt_at = DateTimeField(default=datetime.datetime.now, index=True)
+    sent_at = DateTimeField(null=True, index=True)
+    last_error = TextField(null=True)
+    # Set when the upload was given up after permanent errors
+    failed_at = DateTimeField(null=True)
+
+    class Meta:
+        table_name = 'upload_outbox'
+
+    # Only one drain at a time, otherwise two drains could send the same row
+    drain_lock = None
+
+    def __str__(self):
+        return f'Upload {self.idempotency_key} for {self.player_name}, {self.attempts} attempts'
+
+    @staticmethod
+    def week_key(t):
+        year, week, _ = t.isocalendar()
+        return f'{year}-W{week:02d}'
+
+    @staticmethod
+    def enqueue(uploads, now=None):
+        '''Stores (player, xp_value) pairs as pending uploads of the current week.
+
+        Uploads which are already stored for the week are ignored. Returns the number of new uploads.'''
+        now = now if now != None else datetime.datetime.now()
+        week = UploadOutbox.week_key(now)
+
+        rows = []
+        for player, xp_value in uploads:
+            # Required Parameters:
+            # Value: Weekly XP Value
+            # GameID: 1
+            # accountTypName: Ubisoft
+            # officialAccountId: Account ID
+            payload = {
+                'gameId': 1,
+                'officialAccountId': player.player_ubi_id,
+                'accountTypName': 'Ubisoft',
+                'value': xp_value,
+                'dateTime': now.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            rows.append({'idempotency_key': f'{player.player_ubi_id}:{week}',
+                         'player_name': player.player_name,
+                         'payload': json.dumps(payload),
+                         'created_at': now,
+                         'next_attempt_at': now})
+
+        if len(rows) == 0:
+            return 0
+
+        with UploadOutbox._meta.database.atomic():
+            before = UploadOutbox.select().count()
+            UploadOutbox.insert_many(rows).on_conflict_ignore().execute()
+            return UploadOutbox.select().count() - before
+
+    @staticmethod
+    def due(limit=500, now=None):
+        now = now if now != None else datetime.datetime.now()
+        return list(UploadOutbox.select().where(
+            UploadOutbox.sent_at.is_null(),
+            UploadOutbox.failed_at.is_null(),
+            UploadOutbox.next_attempt_at <= now).order_by(UploadOutbox.next_attempt_at).limit(limit))
+
+    @staticmethod
+    def pending_count():
+        return UploadOutbox.select().where(UploadOutbox.sent_at.is_null(),
+                                           UploadOutbox.failed_at.is_null()).count()
+
+    @staticmethod
+    def mark_sent(outbox_id):
+        UploadOutbox.update(sent_at=datetime.datetime.now(), last_error=None).where(
+            UploadOutbox.outbox_id == outbox_id).execute()
+
+    @staticmethod
+    def mark_failed(outbox_id, attempts, error, permanent=False):
+        '''Schedules the next attempt of an upload. Returns True if the upload was given up,
+        which happens after MAX_PERMANENT_ATTEMPTS attempts if the error is permanent.'''
+        now = datetime.datetime.now()
+        if permanent and attempts >= MAX_PERMANENT_ATTEMPTS:
+            UploadOutbox.update(attempts=attempts, last_error=str(error), failed_at=now).where(
+                UploadOutbox.outbox_id == outbox_id).execute()
+            return True
+
+        delay = min(RETRY_CAP, RETRY_BASE * 2 ** (attempts - 1))
+        UploadOutbox.update(attempts=attempts, last_error=str(error),
+                            next_attempt_at=now + delay).where(
+            UploadOutbox.outbox_id == outbox_id).execute()
+        return False
+
+    @staticmethod
+    def mark_uncertain(outbox_id, attempts, error):
+        '''Gives up an upload which may have reached the CV, it has to be checked by hand.'''
+        UploadOutbox.update(attempts=attempts, last_error=f'Uncertain: {error}',
+                            failed_at=datetime.datetime.now()).where(
+            UploadOutbox.outbox_id == outbox_id).execute()
+
+    @staticmethod
+    def prune(now=None):
+        now = now if now != None else datetime.datetime.now()
+        return UploadOutbox.delete().where((UploadOutbox.sent_at < now - RETENTION) |
+                                           (UploadOutbox.failed_at < now - RETENTION)).execute()
+
+    @classmethod
+    async def drain(cls, session, concurrency=None):
+        '''Sends all due uploads with a bounded number of concurrent workers.
+
+        The concurrency defaults to the environment variable cv_upload_concurrency, the
+        CV rate limit is still enforced by its shared bucket. Every row is posted once per
+        drain, retries are left to the outbox. Returns the counts of the drain.'''
+        if cls.drain_lock == None:
+            cls.drain_lock = asyncio.Lock()
+        if cls.drain_lock.locked():
+            logging.debug('Upload outbox is already being drained')
+            return None
+
+        if concurrency == None:
+            concurrency = int(os.getenv('cv_upload_concurrency', 4))
+        concurrency = max(1, concurrency)
+
+        async with cls.drain_lock:
+            totals = {'sent': 0, 'failed': 0, 'given_up': 0, 'uncertain': 0, 'pruned': 0}
+            timeout = float(os.getenv('cv_upload_timeout', 15))
+
+            # Basic Auth from env file
+            auth = aiohttp.BasicAuth(login=os.getenv('member_username'),
+                                     password=os.getenv('member_pw'))
+            circuit_open = asyncio.Event()
+
+            async def worker(queue):
+                while not queue.empty():
+                    row = queue.get_nowait()
+                    # The CV is down, the remaining rows stay due for the next drain
+                    if circuit_open.is_set():
+                        continue
+
+                    try:
+                        await post(session, cv_url('/BotRequest/Activity'), json=json.loads(row.payload), auth=auth,
+                                   retries=0, timeout=timeout)
+                    except UncertainError as upload_error:
+                        await run_write(UploadOutbox.mark_uncertain, row.outbox_id, row.attempts + 1, upload_error)
+                        totals['uncertain'] += 1
+                        logging.error(f'Upload of weekly XP for player {row.player_name} got no answer, it may have '
+                                      f'reached the CV and is not sent again. Check the CV: {upload_error}')
+                        continue
+                    except (NetworkError, CircuitOpenError) as upload_error:
+                        attempts = row.attempts + 1
+                        given_up = await run_write(UploadOutbox.mark_failed, row.outbox_id, attempts, upload_error,
+                                                   permanent=isinstance(upload_error, PermanentError))
+                        totals['failed'] += 1
+
+                        if given_up:
+                            totals['given_up'] += 1
+                            logging.error(f'Upload of weekly XP for player {row.player_name} given up after '
+                                          f'{attempts} attempts, last error: {upload_error}')
+                        else:
+                            logging.warning(f'Upload of weekly XP failed for player {row.player_name} '
+                                            f'(attempt {attempts}) with error: {upload_error}')
+                        if isinstance(upload_error, CircuitOpenError):
+                            circuit_open.set()
+                        continue
+
+                    # Marked right after the send, a restart doesn't send it again
+                    await run_write(UploadOutbox.mark_sent, row.outbox_id)
+                    totals['sent'] += 1
+
+            # Due rows are loaded in batches until none is left, failed rows are due again later
+            while not circuit_open.is_set():
+                rows = await run_read(UploadOutbox.due)
+                if len(rows) == 0:
+                    break
+
+                queue = asyncio.Queue()
+                for row in rows:
+                    queue.put_nowait(row)
+                await asyncio.gather(*(worker(queue) for _ in range(min(concurrency, len(rows)))))
+
+            totals['pruned'] = await run_write(UploadOutbox.prune)
+
+        pending = await run_read(UploadOutbox.pending_count)
+        logging.info(f"Upload outbox drained: {totals['sent']} sent, {totals['failed']} failed, "
+                     f"{totals['given_up']} given up, {totals['uncertain']} uncertain, {pending} pending (concurrency {concurrency})")
+        return totals
@@ -0,0 +1,119 @@
+import datetime
+import logging
+import os
+
+from peewee import (AutoField, DateTimeField, IntegerField, SmallIntegerField,
+                    chunked, fn)
+
+from models.BaseModel import BaseModel
+
+# Resolution of a sample, raw samples are rolled up into hours and hours into days
+RAW = 0
+HOUR = 1
+DAY = 2
+
+
+class XpHistory(BaseModel.BaseModel):
+    '''Append only clan xp samples of the players.
+
+    Every refresh adds a raw sample. Old samples are rolled up into one sample per
+    player and hour, later per player and day, holding the highest xp of the period.'''
+    history_id = AutoField(null=True)
+    player_id = IntegerField()
+    ts = DateTimeField(index=True)
+    # Clan xp of the player at ts, for rollups the highest xp of the period
+    xp = IntegerField()
+    resolution = SmallIntegerField(default=RAW)
+    # Number of raw samples behind the row
+    samples = IntegerField(default=1)
+
+    class Meta:
+        table_name = 'xp_history'
+        indexes = (
+            (('player_id', 'ts'), False),
+        )
+
+    def __str__(self):
+        return f'XP history of player {self.player_id} at {self.ts}: {self.xp}'
+
+    @staticmethod
+    def record(players, ts=None, batch_size=100):
+        '''Adds a raw sample for each of the given players in one transaction.'''
+        ts = ts if ts != None else datetime.datetime.now()
+        rows = [{'player_id': player.player_id, 'ts': ts, 'xp': player.player_weekly_xp}
+                for player in players if player.player_weekly_xp != None]
+        if len(rows) == 0:
+            return 0
+
+        with XpHistory._meta.database.atomic():
+            for batch in chunked(rows, batch_size):
+                XpHistory.insert_many(batch).execute()
+        return len(rows)
+
+    @staticmethod
+    def rollup_period(source, target, cutoff, bucket_format):
+        '''Replaces the source samples before cutoff with one target sample per player and bucket.'''
+        bucket = fn.strftime(bucket_format, XpHistory.ts)
+        query = (XpHistory
+                 .select(XpHistory.player_id, bucket, fn.MAX(XpHistory.xp), fn.SUM(XpHistory.samples), target)
+                 .where(XpHistory.resolution == source, XpHistory.ts < cutoff)
+                 .group_by(XpHistory.player_id, bucket))
+
+        with XpHistory._meta.database.atomic():
+            inserted = query.count()
+            XpHistory.insert_from(query, fields=[XpHistory.player_id, XpHistory.ts, XpHistory.xp,
+                                                 XpHistory.samples, XpHistory.resolution]).execute()
+            deleted = XpHistory.delete().where(XpHistory.resolution == source,
+                                               XpHistory.ts < cutoff).execute()
+        return inserted, deleted
+
+    @staticmethod
+    def rollup(now=None):
+        '''Rolls up old samples and deletes the ones older than the retention.
+
+        Raw samples are kept for xp_history_raw_hours (48), hourly samples for
+        xp_history_hourly_days (30) and daily samples for xp_history_retention_days (365).'''
+        now = now if now != None else datetime.datetime.now()
+        raw_hours = int(os.getenv('xp_history_raw_hours', 48))
+        hourly_days = int(os.getenv('xp_history_hourly_days', 30))
+        retention_days = int(os.getenv('xp_history_retention_days', 365))
+
+        # Cutoffs start a bucket, so only complete buckets are rolled up
+        hour_cutoff = (now - datetime.timedelta(hours=raw_hours)
+                       ).replace(minute=0, second=0, microsecond=0)
+        day_cutoff = (now - datetime.timedelta(days=hourly_days)
+                      ).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        hours, raw = XpHistory.rollup_period(
+            RAW, HOUR, hour_cutoff, '%Y-%m-%d %H:00:00')
+        days, hourly = XpHistory.rollup_period(
+            HOUR, DAY, day_cutoff, '%Y-%m-%d 00:00:00')
+        expired = XpHistory.delete().where(
+            XpHistory.ts < now - datetime.timedelta(days=retention_days)).execute()
+
+        logging.info(f'XP history rollup: {raw} raw samples into {hours} hourly, '
+                     f'{hourly} hourly samples into {days} daily, {expired} expired')
+        return {'hourly': hours, 'daily': days, 'expired': expired}
+
+    @staticmethod
+    def player_range(player_id, start, end):
+        '''Returns the (ts, xp) samples of a player between start and end, oldest first.'''
+        query = (XpHistory
+                 .select(XpHistory.ts, XpHistory.xp)
+                 .where(XpHistory.player_id == player_id, XpHistory.ts.between(start, end))
+                 .order_by(XpHistory.ts))
+        return [(row.ts, row.xp) for row in query]
+
+    @staticmethod
+    def top_gains(start, end, limit=10):
+        '''Returns (player_id, gained xp) of the players who gained the most xp between start and end.
+
+        The gain is the difference between the highest and the lowest sample of the period.'''
+        gain = (fn.MAX(XpHistory.xp) - fn.MIN(XpHistory.xp)).alias('gain')
+        query = (XpHistory
+                 .select(XpHistory.player_id, gain)
+                 .where(XpHistory.ts.between(start, end))
+                 .group_by(XpHistory.player_id)
+                 .order_by(gain.desc())
+                 .limit(limit))
+        return [(row.player_id, row.gain) for row in query]
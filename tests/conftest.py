@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The tests import the bot's packages from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.BaseModel import Migrations  # noqa: E402
+from models.BaseModel.BaseModel import database  # noqa: E402
+from models.CalendarEvent import CalendarEvent  # noqa: E402
+from models.GuildConfig import GuildConfig  # noqa: E402
+from models.Message import Message  # noqa: E402
+from models.Player import Player  # noqa: E402
+from models.SyncState import SyncState  # noqa: E402
+from models.Tools import Database  # noqa: E402
+from models.Tools.CircuitBreaker import CircuitBreaker  # noqa: E402
+from models.UploadOutbox import UploadOutbox  # noqa: E402
+from models.XpHistory import XpHistory  # noqa: E402
+
+MODELS = [Player, Message, SyncState, CalendarEvent,
+          UploadOutbox, XpHistory, GuildConfig]
+
+
+@pytest.fixture(scope='session')
+def schema(tmp_path_factory):
+    '''One database file for the whole run, the worker threads of Database keep their connections.'''
+    database.init(str(tmp_path_factory.mktemp('db') / 'tpa.db'), timeout=10)
+    Migrations.setup_schema(database, models=MODELS)
+    yield database
+    Database.shutdown()
+
+
+@pytest.fixture
+def db(schema, monkeypatch):
+    '''Empties all tables and resets the class level caches of the models.'''
+    for model in MODELS:
+        model.delete().execute()
+
+    monkeypatch.setattr(Player, 'data_version', 0)
+    monkeypatch.setattr(Player, 'ranking_cache', {})
+    monkeypatch.setattr(Player, 'member_snapshot', None)
+    monkeypatch.setattr(GuildConfig, 'cache', {})
+    monkeypatch.setattr(UploadOutbox, 'drain_lock', None)
+    monkeypatch.setattr(CircuitBreaker, 'breakers', {})
+    return schema
+
+
+@pytest.fixture
+def run():
+    '''Runs a coroutine on a fresh event loop.'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    loop.close()
+    asyncio.set_event_loop(None)
@@ -0,0 +1,136 @@
+import discord
+
+
+class FakeHttp(object):
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, channel_id, content, embed=None):
+        self.calls.append(('send', channel_id, content, embed))
+        return {'id': str(100 + len(self.calls))}
+
+    async def add_reaction(self, channel_id, message_id, emoji):
+        self.calls.append(('react', channel_id, message_id, emoji))
+
+
+def rest_only_bot(monkeypatch):
+    '''Patches the bot as if the calendar channel was on the shards of another process.'''
+    import discord_bot
+
+    http = FakeHttp()
+    monkeypatch.setattr(discord_bot.bot, 'http', http)
+    monkeypatch.setattr(discord_bot.bot, 'get_channel', lambda channel_id: None)
+    return discord_bot, http
+
+
+def test_events_of_uncached_channels_are_posted_through_rest(run, monkeypatch):
+    discord_bot, http = rest_only_bot(monkeypatch)
+
+    message_ids = run(discord_bot.send_with_reactions(
+        7, [discord.Embed(title='Raid')], reactions=('✅', '🤷')))
+
+    assert message_ids == [101]
+    assert http.calls[0][:3] == ('send', 7, None)
+    assert http.calls[1:] == [('react', 7, 101, '✅'), ('react', 7, 101, '🤷')]
+
+
+def test_reminders_of_uncached_channels_are_sent_through_rest(run, db, monkeypatch):
+    discord_bot, http = rest_only_bot(monkeypatch)
+    monkeypatch.setattr(discord_bot, 'calendar_channel_id', lambda guild_id=None: 7)
+
+    import datetime
+    run(discord_bot.send_reminder('event', 'Raid', datetime.datetime(2030, 1, 2, 20, 0)))
+
+    assert len(http.calls) == 1
+    assert http.calls[0][1] == 7 and 'Raid' in http.calls[0][2]
+
+
+def test_only_the_process_of_shard_0_runs_the_jobs(run, monkeypatch):
+    import discord_bot
+
+    monkeypatch.setattr(discord_bot.bot, 'shard_ids', None)
+    assert discord_bot.runs_jobs()
+    monkeypatch.setattr(discord_bot.bot, 'shard_ids', [0, 1])
+    assert discord_bot.runs_jobs()
+    monkeypatch.setattr(discord_bot.bot, 'shard_ids', [2, 3])
+    assert not discord_bot.runs_jobs()
+
+
+class FakeCalendar(object):
+    '''Returns the queued changes from take_changes like the calendar cache after a refresh.'''
+
+    def __init__(self):
+        self.changes = []
+
+    async def refresh(self):
+        pass
+
+    def take_changes(self):
+        changes, self.changes = self.changes, []
+        return changes
+
+    @staticmethod
+    def create_embed(event):
+        return discord.Embed(title=event['summary'])
+
+
+def event(event_id, summary='Raid'):
+    return {'id': event_id, 'summary': summary, 'start': {'dateTime': '2030-01-02T20:00:00+01:00'}}
+
+
+def calendar_feed(monkeypatch):
+    discord_bot, http = rest_only_bot(monkeypatch)
+    calendar = FakeCalendar()
+    monkeypatch.setattr(discord_bot, 'get_calendar', lambda: calendar)
+    monkeypatch.setattr(discord_bot, 'calendar_channel_id', lambda guild_id=None: 7)
+    monkeypatch.setattr(discord_bot, 'reminders', discord_bot.TimerWheel())
+    return discord_bot, http, calendar
+
+
+def posted(http):
+    return [call for call in http.calls if call[0] == 'send']
+
+
+def test_first_poll_only_seeds_the_events(run, db, monkeypatch):
+    discord_bot, http, calendar = calendar_feed(monkeypatch)
+
+    calendar.changes = [event('a'), event('b')]
+    run(discord_bot.poll_calendar())
+    assert posted(http) == []
+
+    calendar.changes = [event('c')]
+    run(discord_bot.poll_calendar())
+    assert len(posted(http)) == 1
+
+
+def test_events_after_deleting_all_events_are_posted(run, db, monkeypatch):
+    discord_bot, http, calendar = calendar_feed(monkeypatch)
+
+    calendar.changes = [event('a')]
+    run(discord_bot.poll_calendar())
+    calendar.changes = [{'id': 'a', 'status': 'cancelled'}]
+    run(discord_bot.poll_calendar())
+
+    # The table is empty again, but this isn't the first poll
+    calendar.changes = [event('b')]
+    run(discord_bot.poll_calendar())
+    assert len(posted(http)) == 1
+
+
+def test_empty_first_poll_seeds_too(run, db, monkeypatch):
+    discord_bot, http, calendar = calendar_feed(monkeypatch)
+
+    run(discord_bot.poll_calendar())
+    calendar.changes = [event('a')]
+    run(discord_bot.poll_calendar())
+    assert len(posted(http)) == 1
+
+
+def test_events_stored_before_the_seeded_flag_are_not_seeded_again(run, db, monkeypatch):
+    discord_bot, http, calendar = calendar_feed(monkeypatch)
+    from models.CalendarEvent import CalendarEvent
+    CalendarEvent.store_changes([event('a')])
+
+    calendar.changes = [event('b')]
+    run(discord_bot.poll_calendar())
+    assert len(posted(http)) == 1
@@ -0,0 +1,55 @@
+import pytest
+
+from models.Tools.CircuitBreaker import CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def breaker():
+    circuit = CircuitBreaker('cv.example', failure_threshold=3, reset_timeout=60)
+    circuit.now = 0
+    circuit.clock = lambda: circuit.now
+    return circuit
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_half_open_lets_one_trial_through(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+
+    breaker.now = 60
+    breaker.before_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # A second request waits for the outcome of the trial
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_request()
+
+
+def test_failed_trial_reopens(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+
+    breaker.now = 60
+    breaker.before_request()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opened_at == 60
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
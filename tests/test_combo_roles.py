@@ -0,0 +1,61 @@
+from models.Tools.ComboRoles import ComboRoleEngine
+
+TPA, DIV, BF, COMBO_DIV, COMBO_BF = 1, 2, 3, 10, 11
+
+
+class FakeRole(object):
+    def __init__(self, role_id, guild=None):
+        self.id = role_id
+        self.guild = guild
+
+    def is_default(self):
+        return self.id == 0
+
+
+class FakeGuild(object):
+    id = 100
+    name = 'Test'
+
+    def __init__(self, role_ids):
+        self.roles = [FakeRole(role_id, self) for role_id in role_ids]
+
+
+class FakeMember(object):
+    name = 'Agent'
+
+    def __init__(self, guild, role_ids):
+        self.guild = guild
+        self.roles = [role for role in guild.roles if role.id in role_ids]
+        self.edits = []
+
+    async def edit(self, roles, reason=None):
+        self.edits.append(sorted(role.id for role in roles))
+
+
+def engine():
+    return ComboRoleEngine([[COMBO_DIV, [TPA, DIV]], [COMBO_BF, [TPA, BF]]])
+
+
+def test_desired_combo_roles_need_all_required_roles():
+    assert engine().desired_combo_roles({TPA, DIV}) == {COMBO_DIV}
+    assert engine().desired_combo_roles({DIV, BF}) == set()
+    assert engine().desired_combo_roles({TPA, DIV, BF}) == {COMBO_DIV, COMBO_BF}
+
+
+def test_apply_edits_the_roles_once(run):
+    guild = FakeGuild([0, TPA, DIV, BF, COMBO_DIV, COMBO_BF])
+    combo_roles = engine()
+    combo_roles.index_guild(guild)
+
+    # Lost BF, gained DIV
+    member = FakeMember(guild, {0, TPA, DIV, COMBO_BF})
+    assert run(combo_roles.apply(member)) == True
+    assert member.edits == [[TPA, DIV, COMBO_DIV]]
+
+
+def test_apply_leaves_correct_members_alone(run):
+    guild = FakeGuild([0, TPA, DIV, COMBO_DIV])
+    member = FakeMember(guild, {0, TPA, DIV, COMBO_DIV})
+
+    assert run(engine().apply(member)) == False
+    assert member.edits == []
@@ -0,0 +1,63 @@
+from models.GuildConfig import GuildConfig
+
+
+def old_env(monkeypatch):
+    monkeypatch.setenv('log_channel_id', '5')
+    monkeypatch.setenv('calender_channel_id', '6')
+    monkeypatch.setenv('role_id_TPA', '1')
+    monkeypatch.setenv('role_id_Div', '2')
+    monkeypatch.setenv('combi_role_idDiv', '9')
+
+
+def test_load_seeds_the_guild_of_guild_id(db, monkeypatch):
+    old_env(monkeypatch)
+    monkeypatch.setenv('guild_id', '111')
+
+    GuildConfig.load()
+
+    assert GuildConfig.channel_id(None, 'log_channel_id') == 5
+    assert GuildConfig.channel_id(111, 'calendar_channel_id') == 6
+    assert GuildConfig.for_guild(111).get_combo_roles() == [[9, [1, 2]]]
+    assert GuildConfig.select().count() == 1
+
+
+def test_seed_without_guild_id_makes_the_guild_the_default(db, monkeypatch):
+    old_env(monkeypatch)
+    monkeypatch.delenv('guild_id', raising=False)
+
+    GuildConfig.load()
+    assert GuildConfig.default_guild_id() == None
+    assert GuildConfig.channel_id(None, 'log_channel_id') == None
+
+    GuildConfig.seed(222)
+    assert GuildConfig.default_guild_id() == 222
+    assert GuildConfig.channel_id(None, 'log_channel_id') == 5
+
+
+def test_set_value_keeps_the_other_settings(db, monkeypatch):
+    old_env(monkeypatch)
+    monkeypatch.setenv('guild_id', '111')
+    GuildConfig.load()
+
+    GuildConfig.set_value(111, 'log_channel_id', 42)
+    GuildConfig.set_value(333, 'info_channel_id', 43)
+
+    assert GuildConfig.channel_id(111, 'log_channel_id') == 42
+    assert GuildConfig.channel_id(111, 'calendar_channel_id') == 6
+    assert GuildConfig.channel_id(333, 'info_channel_id') == 43
+
+
+def test_reload_reports_changes_of_other_processes(db, monkeypatch):
+    monkeypatch.setenv('guild_id', '111')
+    GuildConfig.load()
+    assert GuildConfig.reload() == []
+
+    # Written by another process, the cache of this one doesn't know it yet
+    GuildConfig.update(log_channel_id=42).where(
+        GuildConfig.guild_id == 111).execute()
+    GuildConfig.insert(guild_id=333).execute()
+    assert GuildConfig.channel_id(111, 'log_channel_id') != 42
+
+    assert sorted(GuildConfig.reload()) == [111, 333]
+    assert GuildConfig.channel_id(111, 'log_channel_id') == 42
+    assert GuildConfig.for_guild(333) != None
@@ -0,0 +1,81 @@
+import email.utils
+import time
+
+from models.Limit.Limit import Limit, TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def bucket(calls, period):
+    clock = FakeClock()
+    token_bucket = TokenBucket(calls=calls, period=period)
+    token_bucket.clock = clock
+    token_bucket.updated = clock.now
+    return token_bucket, clock
+
+
+def test_bucket_refills_at_its_rate():
+    token_bucket, clock = bucket(calls=2, period=1)
+    token_bucket.tokens = 0
+
+    assert token_bucket.wait_time() == 0.5
+    clock.now += 0.5
+    assert token_bucket.wait_time() == 0
+    # Never more than the capacity
+    clock.now += 60
+    token_bucket.wait_time()
+    assert token_bucket.tokens == 2
+
+
+def test_acquire_takes_a_token(run):
+    token_bucket, clock = bucket(calls=3, period=1)
+
+    run(token_bucket.acquire())
+    run(token_bucket.acquire())
+
+    assert token_bucket.tokens == 1
+
+
+def test_headers_replace_the_rate_and_cap_the_tokens():
+    token_bucket, clock = bucket(calls=5, period=1)
+
+    token_bucket.update_from_headers({'X-RateLimit-Limit-minute': '30',
+                                      'X-RateLimit-Remaining-minute': '2'})
+
+    assert token_bucket.capacity == 30
+    assert token_bucket.rate == 0.5
+    assert token_bucket.tokens == 2
+
+
+def test_retry_after_blocks_the_bucket():
+    token_bucket, clock = bucket(calls=5, period=1)
+
+    token_bucket.update_from_headers({'Retry-After': '10'})
+
+    assert token_bucket.wait_time() == 10
+    assert token_bucket.tokens == 0
+    # The bucket refills during the pause
+    clock.now += 10
+    assert token_bucket.wait_time() == 0
+
+
+def test_parse_retry_after():
+    assert Limit.parse_retry_after('7') == 7
+    assert Limit.parse_retry_after('soon') == None
+
+    in_a_minute = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < Limit.parse_retry_after(in_a_minute) <= 60
+
+
+def test_hosts_share_one_bucket(monkeypatch):
+    monkeypatch.setattr(Limit, 'buckets', {})
+
+    first = Limit.get_bucket('cv.example', calls=10, period=60)
+    assert Limit.get_bucket('cv.example', calls=1, period=1) is first
+    assert Limit.wait_time('unknown.example') == 0
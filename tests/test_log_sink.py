@@ -0,0 +1,62 @@
+from models.Tools.LogSink import LogChannelSink
+
+
+def test_pack_joins_lines_up_to_the_limit():
+    assert LogChannelSink.pack(['a' * 4, 'b' * 4, 'c' * 4], limit=10) == ['aaaa\nbbbb', 'cccc']
+    assert LogChannelSink.pack([]) == []
+
+
+def test_pack_cuts_overlong_lines():
+    assert LogChannelSink.pack(['ab', 'x' * 25, 'cd'], limit=10) == \
+        ['ab', 'x' * 10, 'x' * 10, 'x' * 5 + '\ncd']
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+class FakeHttp(object):
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, channel_id, content):
+        self.sent.append((channel_id, content))
+
+
+class FakeBot(object):
+    def __init__(self, channels):
+        self.channels = channels
+        self.http = FakeHttp()
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+def test_flush_sends_buffered_lines_together(run):
+    channel = FakeChannel()
+    sink = LogChannelSink(FakeBot({1: channel}), 1, window=60)
+
+    async def add_and_flush():
+        sink.add('joined')
+        sink.add('left')
+        await sink.flush()
+
+    run(add_and_flush())
+    assert channel.sent == ['joined\nleft']
+    assert sink.flush_task == None
+
+
+def test_flush_uses_rest_for_channels_of_other_shards(run):
+    bot = FakeBot({})
+    sink = LogChannelSink(bot, 2, window=60)
+
+    async def add_and_flush():
+        sink.add('renamed')
+        await sink.flush()
+
+    run(add_and_flush())
+    assert bot.http.sent == [(2, 'renamed')]
@@ -0,0 +1,99 @@
+import aiohttp
+import pytest
+from aiohttp import web
+
+from benchmarks.stubs import CvStub, StubConfig, make_roster
+from models.Player import Player
+from models.XpHistory import XpHistory
+
+
+class LeaverCvStub(CvStub):
+    '''The member endpoint reports the players in leavers as former members.'''
+
+    leavers = set()
+
+    async def member(self, request):
+        body = await request.json()
+        if body.get('officialAccountId') in self.leavers:
+            return web.json_response([{'Ubisoft': {'games': {'1': {'characters': {'1': {'isMember': False}}}}}}])
+        return await super().member(request)
+
+
+@pytest.fixture
+def cv(run, monkeypatch):
+    roster = make_roster(3)
+    stub = run(LeaverCvStub(roster, StubConfig(latency=0, jitter=0)).start())
+    monkeypatch.setenv('cv_base_url', stub.base_url)
+    monkeypatch.setenv('member_username', 'test')
+    monkeypatch.setenv('member_pw', 'test')
+    yield stub
+    run(stub.stop())
+
+
+def test_sync_upserts_and_keeps_unlisted_players(db):
+    Player.create(player_name='Old', player_ubi_id='old', player_xp=0)
+    members = [CvStub.entry(member) for member in make_roster(3)]
+
+    counts = Player.sync_members(members)
+    assert counts == {'inserted': 3, 'updated': 0, 'unchanged': 0}
+
+    # Renamed in the CV
+    members[0]['Ubisoft']['nickname'] = 'Renamed'
+    counts = Player.sync_members(members)
+    assert counts == {'inserted': 0, 'updated': 1, 'unchanged': 2}
+
+    names = sorted(player.player_name for player in Player.select())
+    assert names == ['Agent_00001', 'Agent_00002', 'Old', 'Renamed']
+
+
+def test_unlisted_players_are_confirmed_before_they_are_deleted(db, run, cv):
+    async def sync_and_check():
+        async with aiohttp.ClientSession() as session:
+            await Player.get_members(session, full=True)
+            return await Player.check_memberships(session)
+
+    # Missing from AllMember: one has left, the CV doesn't know anything about the other one
+    left = Player.create(player_name='Left', player_ubi_id='left', player_xp=0)
+    Player.create(player_name='Unknown', player_ubi_id='unknown', player_xp=0)
+    XpHistory.record([Player(player_id=left.player_id, player_weekly_xp=10)])
+    cv.leavers = {'left'}
+
+    members, deleted = run(sync_and_check())
+
+    assert deleted == 1
+    names = sorted(player.player_name for player in members)
+    assert names == ['Agent_00000', 'Agent_00001', 'Agent_00002', 'Unknown']
+    assert Player.get_or_none(Player.player_ubi_id == 'left') == None
+    assert XpHistory.select().where(XpHistory.player_id == left.player_id).count() == 0
+
+
+class OddCvStub(CvStub):
+    '''The member endpoint answers with the given payload.'''
+
+    payload = []
+
+    async def member(self, request):
+        return web.json_response(self.payload)
+
+
+@pytest.mark.parametrize('payload', [[], [{'Ubisoft': {'games': {'1': {'characters': {}}}}}],
+                                     [{'Ubisoft': None}], {'error': 'unknown'}])
+def test_unexpected_member_answers_keep_the_player(db, run, monkeypatch, payload):
+    stub = run(OddCvStub(make_roster(1), StubConfig(latency=0, jitter=0)).start())
+    stub.payload = payload
+    monkeypatch.setenv('cv_base_url', stub.base_url)
+    monkeypatch.setenv('member_username', 'test')
+    monkeypatch.setenv('member_pw', 'test')
+    Player.create(player_name='Unlisted', player_ubi_id='unlisted', player_xp=0)
+
+    async def check():
+        async with aiohttp.ClientSession() as session:
+            return await Player.check_memberships(session)
+
+    try:
+        members, deleted = run(check())
+    finally:
+        run(stub.stop())
+
+    assert deleted == 0
+    assert [player.player_name for player in members] == ['Unlisted']
@@ -0,0 +1,43 @@
+import pytest
+
+from models.Tools.Metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_family_has_the_name_of_its_samples():
+    counter = Counter('tpa_test_responses', 'Responses', ['status'])
+    counter.labels('200').inc()
+    counter.labels('200').inc(2)
+
+    assert counter.render().split('\n') == ['# HELP tpa_test_responses_total Responses',
+                                            '# TYPE tpa_test_responses_total counter',
+                                            'tpa_test_responses_total{status="200"} 3']
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('tpa_test_seconds', 'Durations', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+
+    lines = histogram.render().split('\n')
+    assert lines[1] == '# TYPE tpa_test_seconds histogram'
+    assert lines[2:] == ['tpa_test_seconds_bucket{le="0.1"} 1',
+                         'tpa_test_seconds_bucket{le="1"} 3',
+                         'tpa_test_seconds_bucket{le="+Inf"} 4',
+                         'tpa_test_seconds_sum 6.05',
+                         'tpa_test_seconds_count 4']
+
+
+def test_gauge_function_and_label_escaping():
+    gauge = Gauge('tpa_test_depth', 'Depth', ['queue'])
+    gauge.labels('a"b').set_function(lambda: 7)
+
+    assert gauge.render().split('\n')[2] == 'tpa_test_depth{queue="a\\"b"} 7'
+
+
+def test_registry_returns_the_registered_metric():
+    registry = Registry()
+    counter = registry.register(Counter, 'tpa_test_runs', 'Runs')
+
+    assert registry.register(Counter, 'tpa_test_runs', 'Runs') is counter
+    with pytest.raises(ValueError):
+        registry.register(Gauge, 'tpa_test_runs', 'Runs')
@@ -0,0 +1,67 @@
+import pytest
+from peewee import SqliteDatabase
+
+from conftest import MODELS
+from models.BaseModel import Migrations
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    '''A database of the first release, before the schema versions.'''
+    database = SqliteDatabase(str(tmp_path / 'old.db'))
+    database.execute_sql('CREATE TABLE players (player_id INTEGER PRIMARY KEY, player_name TEXT UNIQUE, '
+                         'player_xp INTEGER, player_ubi_id TEXT UNIQUE, player_weekly_xp INTEGER, '
+                         'player_discord_id INTEGER)')
+    database.execute_sql('CREATE TABLE discord_messages (message_id INTEGER PRIMARY KEY, discord_message_id INTEGER, '
+                         'description TEXT, discord_channel_id INTEGER)')
+    database.execute_sql("INSERT INTO players VALUES (1, 'Agent', 100, 'u1', 250, 10)")
+    database.execute_sql("INSERT INTO discord_messages VALUES (1, 5, 'member_clan_xp', 6)")
+    yield database
+    database.close()
+
+
+def columns(database, table):
+    return [column.name for column in database.get_columns(table)]
+
+
+def indexes(database, table):
+    return [index.name for index in database.get_indexes(table)]
+
+
+def test_new_database_gets_the_current_schema(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'new.db'))
+
+    Migrations.setup_schema(database, models=MODELS)
+
+    assert Migrations.get_schema_version(database) == Migrations.SCHEMA_VERSION
+    assert set(model._meta.table_name for model in MODELS) <= set(database.get_tables())
+    database.close()
+
+
+def test_old_database_is_migrated_and_backfilled(old_database, monkeypatch):
+    monkeypatch.setenv('guild_id', '111')
+
+    Migrations.setup_schema(old_database, models=MODELS)
+
+    assert Migrations.get_schema_version(old_database) == Migrations.SCHEMA_VERSION
+    assert {'player_weekly_delta', 'guild_id'} <= set(columns(old_database, 'players'))
+    assert {'content_hash', 'guild_id'} <= set(columns(old_database, 'discord_messages'))
+    assert 'failed_at' in columns(old_database, 'upload_outbox')
+    assert old_database.execute_sql(
+        'SELECT player_weekly_delta, guild_id FROM players').fetchone() == (150, 111)
+    assert old_database.execute_sql('SELECT guild_id FROM discord_messages').fetchone() == (111,)
+
+    # The indexes have the names peewee gives them, creating the tables adds no second one
+    player_indexes = indexes(old_database, 'players')
+    assert {'player_player_discord_id', 'player_player_weekly_delta', 'player_guild_id'} <= set(player_indexes)
+    assert len(player_indexes) == len(set(player_indexes))
+
+
+def test_current_schema_is_left_alone(old_database):
+    Migrations.setup_schema(old_database, models=MODELS)
+    old_database.execute_sql('UPDATE players SET player_weekly_delta = NULL')
+
+    Migrations.setup_schema(old_database, models=MODELS)
+
+    # The migrations didn't run again
+    assert old_database.execute_sql('SELECT player_weekly_delta FROM players').fetchone() == (None,)
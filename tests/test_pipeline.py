@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from models.Tools.Pipeline import Pipeline, Step
+
+
+async def noop(results):
+    return None
+
+
+def names(steps):
+    return [step.name for step in steps]
+
+
+def test_order_follows_the_requirements():
+    steps = [Step('render', noop, requires=['rollover']),
+             Step('upload', noop, requires=['xp']),
+             Step('rollover', noop, requires=['upload']),
+             Step('xp', noop)]
+
+    assert names(Pipeline.order(steps)) == ['xp', 'upload', 'rollover', 'render']
+
+
+def test_order_rejects_unknown_and_cyclic_requirements():
+    with pytest.raises(ValueError):
+        Pipeline.order([Step('a', noop, requires=['missing'])])
+    with pytest.raises(ValueError):
+        Pipeline.order([Step('a', noop, requires=['b']), Step('b', noop, requires=['a'])])
+
+
+def test_steps_of_a_failed_step_are_skipped(run):
+    calls = []
+
+    async def sync(results):
+        calls.append('sync')
+        return 3
+
+    async def xp(results):
+        calls.append('xp')
+        raise RuntimeError('tracker down')
+
+    async def upload(results):
+        calls.append('upload')
+
+    async def count(results):
+        calls.append('count')
+        return results['sync'] * 2
+
+    pipeline = Pipeline('test_failed', [Step('sync', sync), Step('xp', xp, requires=['sync']),
+                                        Step('upload', upload, requires=['xp']),
+                                        Step('count', count, requires=['sync'])])
+    results = run(pipeline.run())
+
+    assert calls == ['sync', 'xp', 'count']
+    assert results == {'sync': 3, 'count': 6}
+    assert set(pipeline.last_timings) == {'sync', 'xp', 'count', 'total'}
+
+
+def test_pipelines_sharing_a_lock_skip_each_other(run):
+    async def slow(results):
+        await asyncio.sleep(0.05)
+        return 'done'
+
+    first = Pipeline('test_first', [Step('slow', slow)], lock='test_lock')
+    second = Pipeline('test_second', [Step('slow', slow)], lock='test_lock')
+
+    async def both():
+        return await asyncio.gather(first.run(), second.run())
+
+    Pipeline.locks.pop('test_lock', None)
+    assert run(both()) == [{'slow': 'done'}, None]
+
+
+def test_waiting_pipeline_runs_after_the_lock_is_released(run):
+    calls = []
+
+    async def upload(results):
+        calls.append('upload')
+        return 'uploaded'
+
+    Pipeline.locks.pop('test_players', None)
+    weekly = Pipeline('test_weekly', [Step('upload', upload)], lock='test_players', wait=True)
+
+    async def refresh_then_weekly():
+        lock = Pipeline.get_lock('test_players')
+        # A player update is still running when the weekly run starts
+        await lock.acquire()
+        weekly_run = asyncio.ensure_future(weekly.run())
+        await asyncio.sleep(0.01)
+        assert calls == []
+        lock.release()
+        return await weekly_run
+
+    assert run(refresh_then_weekly()) == {'upload': 'uploaded'}
+    assert calls == ['upload']
+
+
+def test_weekly_pipeline_waits_for_the_player_updates(run):
+    # The bot module creates its objects on the current event loop
+    import discord_bot
+
+    assert discord_bot.weekly_pipeline.wait
+    assert discord_bot.weekly_pipeline.lock_name == discord_bot.player_update_pipeline.lock_name
+    assert not discord_bot.player_update_pipeline.wait
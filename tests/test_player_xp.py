@@ -0,0 +1,41 @@
+import aiohttp
+from aiohttp import web
+
+from benchmarks.stubs import StubConfig, TrackerStub, make_roster
+from models.Player import Player
+
+
+class BrokenTrackerStub(TrackerStub):
+    '''The profile endpoint answers with an HTML error page instead of JSON.'''
+
+    async def profile(self, request):
+        return web.Response(text='<html>Bad gateway</html>', content_type='text/html')
+
+
+def refresh(run, monkeypatch, stub_class, player):
+    stub = run(stub_class(make_roster(1), StubConfig(latency=0, jitter=0)).start())
+    monkeypatch.setenv('tracker_base_url', stub.base_url)
+    monkeypatch.setenv('TRN_API', 'test')
+
+    async def refresh_player():
+        async with aiohttp.ClientSession() as session:
+            return await player.refresh_player(None, session)
+
+    try:
+        return run(refresh_player())
+    finally:
+        run(stub.stop())
+
+
+def test_refresh_reads_the_clan_xp(db, run, monkeypatch):
+    player = Player(player_name='Agent_00000', player_xp=0, player_weekly_xp=0)
+
+    assert refresh(run, monkeypatch, TrackerStub, player) == 'refreshed'
+    assert player.player_weekly_xp > 0
+
+
+def test_answers_which_arent_json_fail_the_refresh(db, run, monkeypatch):
+    player = Player(player_name='Agent_00000', player_xp=10, player_weekly_xp=20)
+
+    assert refresh(run, monkeypatch, BrokenTrackerStub, player) == 'failed'
+    assert (player.player_xp, player.player_weekly_xp) == (10, 20)
@@ -0,0 +1,57 @@
+import time
+
+from models.Tools.TimerWheel import TimerWheel
+
+
+def test_timers_fire_in_their_slot():
+    wheel = TimerWheel(tick=10, slots=4)
+    fired = []
+    wheel.schedule('soon', time.time() + 15, lambda: fired.append('soon'))
+    wheel.schedule('now', time.time() - 5, lambda: fired.append('now'))
+
+    wheel.advance()
+    assert fired == ['now']
+    wheel.advance()
+    assert fired == ['now', 'soon']
+    assert len(wheel) == 0
+
+
+def test_timers_beyond_one_revolution_wait_for_their_rounds():
+    wheel = TimerWheel(tick=10, slots=4)
+    fired = []
+    # 10 ticks away, the wheel passes the slot twice before
+    wheel.schedule('later', time.time() + 95, lambda: fired.append('later'))
+
+    for _ in range(9):
+        wheel.advance()
+    assert fired == []
+    wheel.advance()
+    assert fired == ['later']
+
+
+def test_rescheduling_replaces_and_cancel_removes():
+    wheel = TimerWheel(tick=10, slots=4)
+    fired = []
+    wheel.schedule('event', time.time() + 5, lambda: fired.append('first'))
+    wheel.schedule('event', time.time() + 15, lambda: fired.append('second'))
+    wheel.schedule('cancelled', time.time() + 5, lambda: fired.append('cancelled'))
+    wheel.cancel('cancelled')
+    assert len(wheel) == 1
+
+    for _ in range(4):
+        wheel.advance()
+    assert fired == ['second']
+
+
+def test_failing_timer_doesnt_stop_the_others():
+    wheel = TimerWheel(tick=10, slots=4)
+    fired = []
+
+    def fail():
+        raise RuntimeError('broken reminder')
+
+    wheel.schedule('failing', time.time(), fail)
+    wheel.schedule('working', time.time(), lambda: fired.append('working'))
+    wheel.advance()
+
+    assert fired == ['working']
@@ -0,0 +1,174 @@
+import asyncio
+import datetime
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from benchmarks.stubs import CvStub, StubConfig
+from models.Player import Player
+from models.Tools.Database import run_write
+from models.UploadOutbox import MAX_PERMANENT_ATTEMPTS, RETENTION, UploadOutbox
+
+
+@pytest.fixture
+def cv(run, monkeypatch):
+    stub = run(CvStub([], StubConfig(latency=0, jitter=0)).start())
+    monkeypatch.setenv('cv_base_url', stub.base_url)
+    monkeypatch.setenv('member_username', 'test')
+    monkeypatch.setenv('member_pw', 'test')
+    yield stub
+    run(stub.stop())
+
+
+def test_upload_skips_players_without_xp(db, run, cv):
+    async def upload():
+        await run_write(Player.create, player_name='Refreshed', player_ubi_id='u1',
+                        player_xp=100, player_weekly_xp=250)
+        # A new member whose tracker lookup failed, the sync stores it without xp
+        await run_write(Player.create, player_name='New', player_ubi_id='u2',
+                        player_xp=0, player_weekly_xp=None)
+        async with aiohttp.ClientSession() as session:
+            return await Player.upload_player_data(session)
+
+    totals = run(upload())
+
+    assert totals['sent'] == 1
+    assert [upload['officialAccountId'] for upload in cv.uploads] == ['u1']
+    assert cv.uploads[0]['value'] == 150
+    assert UploadOutbox.pending_count() == 0
+
+
+class RefusingCvStub(CvStub):
+    '''Answers every upload with 401, like the CV does for wrong credentials.'''
+
+    async def activity(self, request):
+        self.uploads.append(await request.json())
+        return web.Response(status=401)
+
+
+def test_permanently_refused_uploads_are_given_up(db, run, monkeypatch):
+    stub = run(RefusingCvStub([], StubConfig(latency=0, jitter=0)).start())
+    monkeypatch.setenv('cv_base_url', stub.base_url)
+    monkeypatch.setenv('member_username', 'test')
+    monkeypatch.setenv('member_pw', 'test')
+
+    player = Player(player_name='Refused', player_ubi_id='u1')
+    UploadOutbox.enqueue([(player, 100)])
+
+    async def drain():
+        async with aiohttp.ClientSession() as session:
+            return await UploadOutbox.drain(session)
+
+    try:
+        for attempt in range(1, MAX_PERMANENT_ATTEMPTS + 1):
+            # The backoff is over
+            UploadOutbox.update(next_attempt_at=datetime.datetime.now()).execute()
+            totals = run(drain())
+            assert totals['failed'] == 1
+            assert totals['given_up'] == (1 if attempt == MAX_PERMANENT_ATTEMPTS else 0)
+    finally:
+        run(stub.stop())
+
+    row = UploadOutbox.get()
+    assert row.attempts == MAX_PERMANENT_ATTEMPTS
+    assert row.failed_at != None
+    assert UploadOutbox.pending_count() == 0
+
+    # Given up uploads are never due again and are pruned like sent ones
+    UploadOutbox.update(next_attempt_at=datetime.datetime.now()).execute()
+    assert UploadOutbox.due() == []
+    assert UploadOutbox.prune(now=datetime.datetime.now() + RETENTION * 2) == 1
+    assert len(stub.uploads) == MAX_PERMANENT_ATTEMPTS
+
+
+def test_a_week_is_queued_once_per_player(db):
+    thursday = datetime.datetime(2026, 10, 15, 10)
+    player = Player(player_name='Agent', player_ubi_id='u1')
+
+    assert UploadOutbox.enqueue([(player, 100)], now=thursday) == 1
+    assert UploadOutbox.enqueue([(player, 120)], now=thursday + datetime.timedelta(hours=2)) == 0
+    assert UploadOutbox.enqueue([(player, 90)], now=thursday + datetime.timedelta(days=7)) == 1
+
+    assert [row.idempotency_key for row in UploadOutbox.select().order_by(UploadOutbox.outbox_id)] == \
+        ['u1:2026-W42', 'u1:2026-W43']
+
+
+def test_drain_sends_all_batches(db, run, cv, monkeypatch):
+    due = UploadOutbox.due
+    monkeypatch.setattr(UploadOutbox, 'due', staticmethod(lambda: due(limit=2)))
+    UploadOutbox.enqueue([(Player(player_name=f'Agent {i}', player_ubi_id=f'u{i}'), 10 + i)
+                          for i in range(5)])
+
+    async def drain():
+        async with aiohttp.ClientSession() as session:
+            return await UploadOutbox.drain(session, concurrency=2)
+
+    totals = run(drain())
+
+    assert totals['sent'] == 5
+    assert sorted(upload['officialAccountId'] for upload in cv.uploads) == [f'u{i}' for i in range(5)]
+    assert UploadOutbox.pending_count() == 0
+
+
+class SlowCvStub(CvStub):
+    '''Stores every upload, but answers only after the client gave up.'''
+
+    async def activity(self, request):
+        self.uploads.append(await request.json())
+        await asyncio.sleep(1)
+        return web.Response(text='OK')
+
+
+def test_upload_without_answer_is_not_sent_again(db, run, monkeypatch):
+    stub = run(SlowCvStub([], StubConfig(latency=0, jitter=0)).start())
+    monkeypatch.setenv('cv_base_url', stub.base_url)
+    monkeypatch.setenv('cv_upload_timeout', '0.2')
+    monkeypatch.setenv('member_username', 'test')
+    monkeypatch.setenv('member_pw', 'test')
+
+    UploadOutbox.enqueue([(Player(player_name='Agent', player_ubi_id='u1'), 100)])
+
+    async def drain():
+        async with aiohttp.ClientSession() as session:
+            return await UploadOutbox.drain(session)
+
+    try:
+        totals = run(drain())
+        UploadOutbox.update(next_attempt_at=datetime.datetime.now()).execute()
+        run(drain())
+    finally:
+        run(stub.stop())
+
+    assert totals['uncertain'] == 1
+    assert len(stub.uploads) == 1
+    row = UploadOutbox.get()
+    assert row.failed_at != None
+    assert row.last_error.startswith('Uncertain')
+    assert UploadOutbox.pending_count() == 0
+
+
+def test_unavailable_cv_is_retried_by_the_outbox(db, run, monkeypatch):
+    stub = run(CvStub([], StubConfig(latency=0, jitter=0, error_rate=1)).start())
+    monkeypatch.setenv('cv_base_url', stub.base_url)
+    monkeypatch.setenv('member_username', 'test')
+    monkeypatch.setenv('member_pw', 'test')
+
+    UploadOutbox.enqueue([(Player(player_name='Agent', player_ubi_id='u1'), 100)])
+
+    async def drain():
+        async with aiohttp.ClientSession() as session:
+            return await UploadOutbox.drain(session)
+
+    try:
+        totals = run(drain())
+    finally:
+        run(stub.stop())
+
+    # One request per drain, the next attempt waits for the backoff of the outbox
+    assert totals['failed'] == 1
+    assert stub.requests == 1
+    row = UploadOutbox.get()
+    assert row.failed_at == None
+    assert row.next_attempt_at > datetime.datetime.now()
+    assert UploadOutbox.pending_count() == 1
@@ -0,0 +1,57 @@
+import datetime
+
+from models.Player import Player
+from models.XpHistory import DAY, HOUR, RAW, XpHistory
+
+
+def sample(player_id, ts, xp, resolution=RAW):
+    XpHistory.create(player_id=player_id, ts=ts, xp=xp, resolution=resolution)
+
+
+def test_record_skips_players_without_xp(db):
+    assert XpHistory.record([Player(player_id=1, player_weekly_xp=10),
+                             Player(player_id=2, player_weekly_xp=None)]) == 1
+    assert [row.player_id for row in XpHistory.select()] == [1]
+
+
+def test_rollup_keeps_the_highest_xp_of_complete_buckets(db):
+    now = datetime.datetime(2026, 10, 17, 12, 30)
+    old_hour = datetime.datetime(2026, 10, 14, 9)
+    for minute, xp in [(0, 100), (20, 300), (40, 200)]:
+        sample(1, old_hour + datetime.timedelta(minutes=minute), xp)
+    sample(2, old_hour, 50)
+    # Newer than xp_history_raw_hours, stays raw
+    sample(1, now - datetime.timedelta(hours=1), 400)
+
+    counts = XpHistory.rollup(now=now)
+
+    assert counts == {'hourly': 2, 'daily': 0, 'expired': 0}
+    hourly = {row.player_id: row for row in XpHistory.select().where(XpHistory.resolution == HOUR)}
+    assert hourly[1].xp == 300
+    assert hourly[1].samples == 3
+    assert str(hourly[1].ts).startswith('2026-10-14 09:00:00')
+    assert hourly[2].xp == 50
+    assert XpHistory.select().where(XpHistory.resolution == RAW).count() == 1
+
+
+def test_rollup_into_days_and_expiry(db):
+    now = datetime.datetime(2026, 10, 17, 12, 30)
+    sample(1, datetime.datetime(2026, 8, 1, 10), 100, HOUR)
+    sample(1, datetime.datetime(2026, 8, 1, 18), 180, HOUR)
+    sample(1, datetime.datetime(2024, 1, 1), 10, DAY)
+
+    counts = XpHistory.rollup(now=now)
+
+    assert counts == {'hourly': 0, 'daily': 1, 'expired': 1}
+    daily = XpHistory.get(XpHistory.resolution == DAY)
+    assert (daily.xp, daily.samples) == (180, 2)
+
+
+def test_top_gains(db):
+    start = datetime.datetime(2026, 10, 1)
+    for day, xp_1, xp_2 in [(1, 100, 1000), (2, 500, 1100), (3, 900, 1150)]:
+        sample(1, start + datetime.timedelta(days=day), xp_1)
+        sample(2, start + datetime.timedelta(days=day), xp_2)
+
+    assert XpHistory.top_gains(start, start + datetime.timedelta(days=7)) == [(1, 800), (2, 150)]
+    assert [xp for _, xp in XpHistory.player_range(2, start, start + datetime.timedelta(days=2))] == [1000, 1100]